@@ -5,12 +5,34 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from PIL import Image
 import io
-import tempfile
-import shutil
+import json
+import time
+import itertools
+import click
 from datetime import datetime
+from sqlalchemy import event
 from config import Config
+import metrics
+from response_cache import response_cache
+from related_products import related_engine
+from copurchase import copurchase_index
+from reports import sales_reports, parse_range
+from catalog_model import catalog_model
+from popularity import popularity
+from guest_cart import guest_cart, GuestCartItem
+from reservations import reservations, OutOfStock
+from sqlite_profile import sqlite_profile, immediate_transaction
+from replicas import replica_router, RoutingSession
+from maintenance import cleanup_stale_carts, compact_table, collect_orphan_images
+from inventory import inventory
+from jobs import job_queue
+from autocomplete import autocomplete
+from profiling import request_profiler
+from assets import assets, build_assets
+from images import open_image, process_image, delete_renditions, product_image, content_filename, IMAGE_FIELDS
+from order_archive import archive_orders, ensure_monotonic_ids, months_ago, partition_by_range
+from bulk_ops import delete_orders, delete_users, transition_orders, ORDER_TRANSITIONS
 
 app = Flask(__name__,
             template_folder='templates',
@@ -18,32 +40,36 @@ app = Flask(__name__,
 app.config.from_object(Config)
 
 # Initialize extensions
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Пожалуйста, войдите для доступа к этой странице.'
 
-# Временная папка для загрузок
-TEMP_UPLOAD_FOLDER = None
-_db_initialized = False
+# Метрики запросов, SQL и шаблонов (/metrics)
+metrics.init_app(app)
 
-def get_upload_folder():
-    """Получает или создает временную папку для загрузок"""
-    global TEMP_UPLOAD_FOLDER
-    
-    if TEMP_UPLOAD_FOLDER is None or not os.path.exists(TEMP_UPLOAD_FOLDER):
-        # Создаем временную папку
-        TEMP_UPLOAD_FOLDER = tempfile.mkdtemp()
-        # Создаем подпапку для продуктов
-        products_path = os.path.join(TEMP_UPLOAD_FOLDER, 'products')
-        os.makedirs(products_path, exist_ok=True)
-        print(f"📁 Создана временная папка для загрузок: {TEMP_UPLOAD_FOLDER}")
-    
-    return TEMP_UPLOAD_FOLDER
+# PRAGMA и BEGIN IMMEDIATE для SQLite (до первого соединения с базой)
+sqlite_profile.init_app(app, db)
+
+# Чтение витрины с реплик, запись и чтение своих записей - в основной базе
+replica_router.init_app(app, db)
+
+# Профилирование запросов по требованию администратора и выборкой (/admin/profiler).
+# Подключается раньше остальных хуков, чтобы их время попадало в профиль
+request_profiler.init_app(app, db)
+
+_db_initialized = False
+_app_prepared = False
 
 # ==== MODELS (ИСПРАВЛЕННАЯ ВЕРСИЯ) ====
-def save_product_image(file):
-    """Сохраняет изображение товара и возвращает имя файла"""
+def save_product_image(file, product=None):
+    """Сохраняет изображение товара и возвращает имя файла.
+
+    Имя - хеш содержимого загруженного файла, поэтому одно и то же фото,
+    загруженное для нескольких товаров, хранится один раз. Если передан
+    product, в нем заполняются размеры; копии и заглушку делает фоновая
+    задача images.process, поставленная в транзакции сессии.
+    """
     if not file or file.filename == '':
         return None
     
@@ -51,9 +77,10 @@ def save_product_image(file):
     if not allowed_file(file.filename):
         return None
     
-    # Генерируем уникальное имя файла
+    # Имя файла по содержимому
     ext = file.filename.rsplit('.', 1)[1].lower()
-    filename = f"{uuid.uuid4().hex}.{ext}"
+    data = file.read()
+    filename = content_filename(data, ext)
     
     # Создаем пути
     upload_folder = app.config['PRODUCT_IMAGE_FOLDER']
@@ -64,32 +91,64 @@ def save_product_image(file):
     filepath = os.path.join(upload_folder, filename)
     
     try:
-        # Открываем изображение с PIL для проверки
-        image = Image.open(file.stream)
-        
-        # Оптимизируем размер (макс. 800x800)
-        image.thumbnail((800, 800))
-        
-        # Сохраняем с оптимизацией
-        if ext in ['jpg', 'jpeg']:
-            image.save(filepath, 'JPEG', quality=85, optimize=True)
-        elif ext == 'png':
-            image.save(filepath, 'PNG', optimize=True)
+        if os.path.exists(filepath):
+            # Такое фото уже есть: берем метаданные у товара с ним, если копии уже нарезаны
+            same = Product.query.filter_by(image_filename=filename).first()
+            if same and same.image_renditions is not None:
+                info = {field: getattr(same, field) for field in IMAGE_FIELDS}
+            else:
+                with open_image(filepath) as image:
+                    info = {'image_width': image.width, 'image_height': image.height,
+                            'image_renditions': None, 'image_placeholder': None}
+                job_queue.enqueue('images.process', {'filename': filename})
+            metrics.registry.inc('shop_product_image_dedup_total')
         else:
-            file.save(filepath)
-        
+            # Открываем изображение с PIL для проверки
+            image = open_image(io.BytesIO(data))
+
+            # Оптимизируем размер (макс. 800x800)
+            image.thumbnail((800, 800))
+
+            # Пишем во временный файл и переименовываем: параллельная загрузка
+            # того же фото не увидит недописанный файл
+            tmp_path = f'{filepath}.tmp-{uuid.uuid4().hex}'
+            if ext in ['jpg', 'jpeg']:
+                image.save(tmp_path, 'JPEG', quality=85, optimize=True)
+            elif ext == 'png':
+                image.save(tmp_path, 'PNG', optimize=True)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+            os.replace(tmp_path, filepath)
+
+            # Размеры сразу (место под картинку), копии для srcset и заглушка - в фоне
+            info = {'image_width': image.width, 'image_height': image.height,
+                    'image_renditions': None, 'image_placeholder': None}
+            job_queue.enqueue('images.process', {'filename': filename})
+
+        if product is not None:
+            for field, value in info.items():
+                setattr(product, field, value)
+
         return filename
     except Exception as e:
         app.logger.error(f"Error saving image: {e}")
         return None
 
 def delete_product_image(filename):
-    """Удаляет изображение товара"""
+    """Удаляет изображение товара, если на него больше не ссылается ни один товар.
+
+    Вызывать после commit: ссылки считаются по product.image_filename в БД.
+    Что не удалилось здесь, подберет flask gc-images.
+    """
     if filename:
         try:
+            if Product.query.filter_by(image_filename=filename).first() is not None:
+                return
             filepath = os.path.join(app.config['PRODUCT_IMAGE_FOLDER'], filename)
             if os.path.exists(filepath):
                 os.remove(filepath)
+            delete_renditions(app.config['PRODUCT_IMAGE_FOLDER'], filename, app.config.get('PRODUCT_IMAGE_WIDTHS', []))
         except Exception as e:
             app.logger.error(f"Error deleting image: {e}")
 
@@ -121,8 +180,23 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(100))
     stock = db.Column(db.Integer, default=0)
-    image_filename = db.Column(db.String(200))
+    # Сколько единиц удержано в корзинах (см. reservations.py); к продаже доступно stock - reserved
+    reserved = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Имя по хешу содержимого; индекс - для подсчета ссылок и сборки мусора
+    image_filename = db.Column(db.String(200), index=True)
+    # Размеры исходника, ширины нарезанных копий ("160,320,480") и data URI заглушки
+    image_width = db.Column(db.Integer)
+    image_height = db.Column(db.Integer)
+    image_renditions = db.Column(db.String(100))
+    image_placeholder = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Время последнего изменения через ORM; по нему индекс подсказок подтягивает правки других процессов
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        # Поиск соседей по цене внутри категории (похожие товары, фильтры каталога)
+        db.Index('ix_product_category_price', 'category', 'price'),
+    )
 
     # Отношения
     cart_items = db.relationship('CartItem', backref='product_ref', lazy=True)
@@ -131,19 +205,25 @@ class Product(db.Model):
 
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, default=1)
-    added_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Время последнего изменения строки: по нему cleanup-carts находит брошенные корзины
+    added_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Явные relationship с foreign_keys
     user = db.relationship('User', foreign_keys=[user_id])
     product = db.relationship('Product', foreign_keys=[product_id])
 
+    __table_args__ = (
+        # Одна строка на товар в корзине пользователя; нужен для upsert
+        db.Index('uq_cart_item_user_product', 'user_id', 'product_id', unique=True),
+    )
+
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     order_number = db.Column(db.String(50), unique=True, nullable=False)
     status = db.Column(db.String(50), default='pending')
     total_amount = db.Column(db.Float, nullable=False)
@@ -159,6 +239,9 @@ class Order(db.Model):
     user = db.relationship('User', foreign_keys=[user_id])
     items = db.relationship('OrderItem', backref='order_ref', lazy=True, cascade='all, delete-orphan')
 
+    # id не выдаются повторно после удаления последних заказов: их занимают архивные (order_archive.py)
+    __table_args__ = {'sqlite_autoincrement': True}
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -169,11 +252,13 @@ class Order(db.Model):
             'created_at': self.created_at.strftime('%d.%m.%Y %H:%M')
         }
 
+    archived = False
+
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id', ondelete='CASCADE'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     product_name = db.Column(db.String(200), nullable=False)
     product_price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
@@ -191,6 +276,325 @@ class OrderItem(db.Model):
             'subtotal': self.product_price * self.quantity
         }
 
+class ArchivedOrder(db.Model):
+    """Заказ, перенесенный в архив (см. order_archive.py); на PostgreSQL - секции по месяцам"""
+    __tablename__ = 'order_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Ключ секционирования обязан входить в первичный ключ
+    created_at = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    order_number = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(50))
+    total_amount = db.Column(db.Float, nullable=False)
+    shipping_address = db.Column(db.Text)
+    billing_address = db.Column(db.Text)
+    payment_method = db.Column(db.String(100))
+    payment_status = db.Column(db.String(50))
+    notes = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    user = db.relationship('User', primaryjoin='foreign(ArchivedOrder.user_id) == User.id', viewonly=True)
+    items = db.relationship('ArchivedOrderItem', viewonly=True, lazy=True,
+                            primaryjoin='and_(ArchivedOrder.id == foreign(ArchivedOrderItem.order_id), '
+                                        'ArchivedOrder.created_at == foreign(ArchivedOrderItem.order_created_at))')
+
+    archived = True
+    to_dict = Order.to_dict
+
+    __table_args__ = (
+        db.Index('ix_order_archive_user_created', 'user_id', 'created_at'),
+        db.Index('ix_order_archive_order_number', 'order_number'),
+    )
+
+
+class ArchivedOrderItem(db.Model):
+    """Строка архивного заказа; order_created_at - копия created_at заказа для секционирования"""
+    __tablename__ = 'order_item_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_created_at = db.Column(db.DateTime, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    product_name = db.Column(db.String(200), nullable=False)
+    product_price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    product = db.relationship('Product', primaryjoin='foreign(ArchivedOrderItem.product_id) == Product.id',
+                              viewonly=True)
+
+    to_dict = OrderItem.to_dict
+
+    __table_args__ = (
+        db.Index('ix_order_item_archive_order', 'order_id'),
+    )
+
+
+partition_by_range(ArchivedOrder.__table__, 'created_at')
+partition_by_range(ArchivedOrderItem.__table__, 'order_created_at')
+
+
+class CacheVersion(db.Model):
+    """Счетчики версий для инвалидации кешей (например, версия каталога)"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class RelatedProducts(db.Model):
+    """Предрасчитанные похожие товары: id через запятую, одна строка на товар"""
+    __tablename__ = 'related_products'
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    related_ids = db.Column(db.String(255), nullable=False, default='')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class StockHold(db.Model):
+    """Удержание товара в корзине пользователя до expires_at"""
+    __tablename__ = 'stock_hold'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('uq_stock_hold_user_product', 'user_id', 'product_id', unique=True),
+    )
+
+
+class InventoryMovement(db.Model):
+    """Движение товара (только дополняется): delta > 0 - приход, < 0 - расход"""
+    __tablename__ = 'inventory_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)
+    ref_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_inventory_movement_product_created', 'product_id', 'created_at'),
+    )
+
+
+class Job(db.Model):
+    """Фоновая задача (см. jobs.py)"""
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+
+class RequestProfile(db.Model):
+    """Профиль запроса cProfile (см. profiling.py); stats - JSON с деревом вызовов и топом функций"""
+    __tablename__ = 'request_profile'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), nullable=False, unique=True)
+    endpoint = db.Column(db.String(100), nullable=False)
+    method = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.Integer)
+    duration_ms = db.Column(db.Float, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)  # admin, sample
+    worker = db.Column(db.String(100))
+    stats = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_request_profile_endpoint_created', 'endpoint', 'created_at'),
+    )
+
+
+class ProductStats(db.Model):
+    """Счетчики товара; score - популярность, приведенная к эпохе из cache_version (см. popularity.py)"""
+    __tablename__ = 'product_stats'
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    cart_adds = db.Column(db.Integer, nullable=False, default=0)
+    score = db.Column(db.Float, nullable=False, default=0.0, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CoPurchase(db.Model):
+    """Индекс совместных покупок: top-K товаров строкой id:count через запятую"""
+    __tablename__ = 'copurchase'
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    pairs = db.Column(db.Text, nullable=False, default='')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def merge_duplicate_cart_items():
+    """Перед созданием уникального индекса оставляет одну строку на (пользователь, товар)"""
+    from sqlalchemy import inspect
+    if any(index['name'] == 'uq_cart_item_user_product' for index in inspect(db.engine).get_indexes('cart_item')):
+        return
+    table = CartItem.__table__
+    with db.engine.begin() as conn:
+        keep = db.select(db.func.min(table.c.id)).group_by(table.c.user_id, table.c.product_id)
+        removed = conn.execute(table.delete().where(table.c.id.notin_(keep))).rowcount
+    if removed:
+        print(f"🧹 Удалено дублей в корзинах: {removed}")
+
+
+def upsert_statement(table, index_elements, update_columns):
+    """INSERT ... ON CONFLICT DO UPDATE (SQLite, PostgreSQL) / ON DUPLICATE KEY UPDATE (MySQL)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_columns})
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(index_elements=index_elements,
+                                      set_={c: stmt.excluded[c] for c in update_columns})
+
+
+# Чем заполнить новый столбец в уже существующих строках
+COLUMN_BACKFILL = {
+    # Без отметки времени товар не виден инкрементальной синхронизации подсказок
+    ('product', 'updated_at'): lambda t: db.func.coalesce(t.c.created_at, datetime.utcnow()),
+}
+
+
+def ensure_columns():
+    """Добавляет в существующие таблицы новые столбцы моделей (create_all их не добавляет)"""
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql(f'ALTER TABLE {db.engine.dialect.identifier_preparer.quote(table.name)} ADD COLUMN {ddl}')
+                print(f"➕ Добавлен столбец {table.name}.{column.name}")
+                backfill = COLUMN_BACKFILL.get((table.name, column.name))
+                if backfill is not None:
+                    with db.engine.begin() as conn:
+                        filled = conn.execute(
+                            table.update().where(column.is_(None)).values({column.name: backfill(table)})
+                        ).rowcount
+                    print(f"   заполнено строк: {filled}")
+
+
+def ensure_indexes():
+    """Создает индексы, которых нет в существующей базе (create_all их не добавляет)"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+# ==== ВЕРСИЯ КАТАЛОГА ====
+# Увеличивается при любом изменении товаров; по ней сбрасываются кеши страниц
+_catalog_version_cache = {'value': None, 'checked_at': 0.0}
+
+
+def get_catalog_version():
+    """Возвращает (версия, время изменения) каталога, перечитывая БД не чаще CATALOG_VERSION_TTL"""
+    now = time.monotonic()
+    if (_catalog_version_cache['value'] is not None
+            and now - _catalog_version_cache['checked_at'] < app.config.get('CATALOG_VERSION_TTL', 1)):
+        return _catalog_version_cache['value']
+
+    row = db.session.execute(
+        db.select(CacheVersion.version, CacheVersion.updated_at).where(CacheVersion.name == 'catalog')
+    ).first()
+    value = (row.version, row.updated_at) if row else (0, None)
+
+    _catalog_version_cache['value'] = value
+    _catalog_version_cache['checked_at'] = now
+    return value
+
+
+def bump_catalog_version(connection=None):
+    """Увеличивает версию каталога в текущей транзакции"""
+    connection = connection or db.session.connection()
+    table = CacheVersion.__table__
+    now = datetime.utcnow()
+
+    result = connection.execute(
+        table.update()
+        .where(table.c.name == 'catalog')
+        .values(version=table.c.version + 1, updated_at=now)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(name='catalog', version=1, updated_at=now))
+
+    _catalog_version_cache['value'] = None
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_catalog_changes(session, flush_context):
+    """Поднимает версию каталога, если во flush попали изменения товаров"""
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Product):
+            bump_catalog_version(session.connection())
+            break
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_related_changes(session, flush_context):
+    """Обновляет похожие товары, затронутые изменениями товаров, и ставит задачу по новым заказам"""
+    conn = session.connection()
+    affected = set()
+
+    def add_neighbors(category, price):
+        affected.update(row.id for row in related_engine.price_neighbors(conn, category, price))
+
+    for obj in itertools.chain(session.new, session.deleted):
+        if isinstance(obj, Product):
+            affected.add(obj.id)
+            add_neighbors(obj.category, obj.price)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Product):
+            continue
+        state = db.inspect(obj)
+        price_history = state.attrs.price.history
+        category_history = state.attrs.category.history
+        if not (price_history.has_changes() or category_history.has_changes()):
+            continue
+        affected.add(obj.id)
+        add_neighbors(obj.category, obj.price)
+        old_category = category_history.deleted[0] if category_history.deleted else obj.category
+        old_price = price_history.deleted[0] if price_history.deleted else obj.price
+        add_neighbors(old_category, old_price)
+
+    if affected:
+        related_engine.refresh(conn, affected)
+
+    # Новые заказы пополняют индекс совместных покупок фоновой задачей, не задерживая оформление
+    orders = {}
+    for obj in session.new:
+        if isinstance(obj, OrderItem):
+            orders.setdefault(obj.order_id, set()).add(obj.product_id)
+    baskets = [sorted(product_ids) for product_ids in orders.values() if len(product_ids) > 1]
+    if baskets:
+        job_queue.enqueue('copurchase.apply_orders', {'baskets': baskets}, conn=conn)
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -212,14 +616,15 @@ def utility_processor():
 
     def get_cart_count():
         if current_user.is_authenticated:
-            return sum(item.quantity for item in current_user.cart_items)
+            return cart_count_for(current_user.id)
         return 0
 
-    return dict(format_price=format_price, get_cart_count=get_cart_count)
+    return dict(format_price=format_price, get_cart_count=get_cart_count, product_image=product_image)
 
 
 # Routes
 @app.route('/')
+@response_cache.cached
 def index():
     """Главная страница"""
     # Берем товары из разных категорий
@@ -231,8 +636,8 @@ def index():
     # Новинки (последние добавленные товары)
     new_products = Product.query.order_by(Product.created_at.desc()).limit(8).all()
 
-    # Горячие предложения (товары с акцией) - берем случайные
-    featured_products = Product.query.order_by(db.func.random()).limit(8).all()
+    # Горячие предложения - популярные товары, выбранные с весом по популярности
+    featured_products = popular_products(8)
 
     # Новинки электроники (первые 2 товара)
     new_electronics = Product.query.filter_by(category='Электроника') \
@@ -249,15 +654,8 @@ def index():
                            new_electronics=new_electronics)
 
 
-@app.route('/catalog')
-def catalog():
-    """Страница каталога товаров"""
-    category = request.args.get('category')
-    search = request.args.get('search')
-    sort = request.args.get('sort', 'newest')
-    min_price = request.args.get('min_price')
-    max_price = request.args.get('max_price')
-
+def catalog_page_sql(category, search, min_price, max_price, sort, page, per_page):
+    """Страница каталога через SQL: (товары, сколько всего найдено)"""
     query = Product.query
 
     # Фильтрация по категории
@@ -276,78 +674,153 @@ def catalog():
         )
 
     # Фильтрация по цене
-    if min_price:
-        try:
-            query = query.filter(Product.price >= float(min_price))
-        except:
-            pass
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
 
-    if max_price:
-        try:
-            query = query.filter(Product.price <= float(max_price))
-        except:
-            pass
+    found = query.order_by(None).count()
 
     # Сортировка
     if sort == 'price_asc':
-        query = query.order_by(Product.price.asc())
+        query = query.order_by(Product.price.asc(), Product.id.asc())
     elif sort == 'price_desc':
-        query = query.order_by(Product.price.desc())
+        query = query.order_by(Product.price.desc(), Product.id.asc())
     elif sort == 'name':
-        query = query.order_by(Product.name.asc())
+        # Порядок кодовых точек, как у модели каталога в памяти: BINARY в SQLite, "C" в PostgreSQL
+        name = Product.name.collate('C') if db.engine.dialect.name == 'postgresql' else Product.name
+        query = query.order_by(name.asc(), Product.id.asc())
+    elif sort == 'popular':
+        query = query.outerjoin(ProductStats, ProductStats.product_id == Product.id) \
+            .order_by(db.func.coalesce(ProductStats.score, 0).desc(), Product.created_at.desc())
     else:  # newest по умолчанию
-        query = query.order_by(Product.created_at.desc())
+        query = query.order_by(Product.created_at.desc(), Product.id.asc())
+
+    products = query.offset((page - 1) * per_page).limit(per_page).all()
+    return products, found
 
-    products = query.all()
 
-    # Получаем все категории для фильтра
-    all_categories = db.session.query(Product.category).distinct().all()
-    categories = [c[0] for c in all_categories if c[0]]
+def popular_products(count):
+    """Популярные товары (взвешенная случайная выборка); если статистики мало - добираем случайными"""
+    ids = popularity.weighted_sample(db.session.connection(), count)
+    by_id = {p.id: p for p in Product.query.filter(Product.id.in_(ids)).all()} if ids else {}
+    products = [by_id[i] for i in ids if i in by_id]
+    if len(products) < count:
+        products += Product.query.filter(Product.id.notin_(list(by_id))) \
+            .order_by(db.func.random()).limit(count - len(products)).all()
+    return products
 
-    # Подсчет товаров по категориям
-    category_counts = {}
-    for cat in categories:
-        count = Product.query.filter_by(category=cat).count()
-        category_counts[cat] = count
 
-    # Общее количество товаров
-    total_products = Product.query.count()
+def catalog_category_counts():
+    """Количество товаров по категориям одним GROUP BY и общее количество"""
+    rows = db.session.query(Product.category, db.func.count(Product.id)).group_by(Product.category).all()
+    category_counts = {category: count for category, count in rows if category}
+    return category_counts, sum(count for _, count in rows)
+
+
+@app.route('/catalog')
+@response_cache.cached
+def catalog():
+    """Страница каталога товаров"""
+    category = request.args.get('category')
+    search = request.args.get('search')
+    sort = request.args.get('sort', 'newest')
+    min_price = request.args.get('min_price')
+    max_price = request.args.get('max_price')
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config.get('CATALOG_PAGE_SIZE', 24)
+
+    try:
+        min_price = float(min_price) if min_price else None
+    except ValueError:
+        min_price = None
+    try:
+        max_price = float(max_price) if max_price else None
+    except ValueError:
+        max_price = None
+
+    # Поиск и сортировка по популярности (счетчики меняются без смены версии каталога) всегда идут через SQL,
+    # остальные фильтры и сортировки - через модель в памяти, если включена
+    snapshot = None if search or sort == 'popular' else catalog_model.current(db.session.connection())
+    if snapshot is not None:
+        page_ids, found = snapshot.query(category, min_price, max_price, sort,
+                                         offset=(page - 1) * per_page, limit=per_page)
+        category_counts, total_products = snapshot.counts()
+        by_id = {p.id: p for p in Product.query.filter(Product.id.in_(page_ids)).all()} if page_ids else {}
+        products = [by_id[i] for i in page_ids if i in by_id]
+    else:
+        products, found = catalog_page_sql(category, search, min_price, max_price, sort, page, per_page)
+        category_counts, total_products = catalog_category_counts()
+
+    categories = sorted(category_counts)
+    pages = max((found + per_page - 1) // per_page, 1)
 
     # Популярные товары для боковой панели
-    featured_products = Product.query.order_by(db.func.random()).limit(6).all()
+    featured_products = popular_products(6)
 
     # Функция для удаления фильтров из URL
     def remove_filter(filter_name):
         args = request.args.copy()
         args.pop(filter_name, None)
+        args.pop('page', None)
         return args
 
+    def page_url(number):
+        args = request.args.to_dict()
+        args['page'] = number
+        return url_for('catalog', **args)
+
     return render_template('catalog.html',
                            products=products,
                            categories=categories,
                            category_counts=category_counts,
                            total_products=total_products,
+                           found=found,
+                           page=page,
+                           pages=pages,
+                           page_url=page_url,
                            featured_products=featured_products,
                            remove_filter=remove_filter)
 
 
+@app.after_request
+def count_product_views(response):
+    """Учитывает просмотр товара, в том числе отданный из кеша страниц"""
+    if request.endpoint == 'product_detail' and response.status_code in (200, 304):
+        popularity.record_view(request.view_args['product_id'])
+    return response
+
+
 @app.route('/product/<int:product_id>', methods=['GET'])
+@response_cache.cached
 def product_detail(product_id):
     """Страница с подробной информацией о товаре"""
     product = Product.query.get_or_404(product_id)
 
-    # Похожие товары из той же категории
-    related_products = Product.query.filter(
-        Product.category == product.category,
-        Product.id != product.id
-    ).limit(4).all()
+    # Похожие товары: предрасчитанный список, при его отсутствии считаем на лету
+    conn = db.session.connection()
+    related_ids = related_engine.lookup(conn, product.id)
+    if related_ids is None:
+        related_ids = related_engine.compute(conn, product.id) or []
+
+    # С этим товаром покупают
+    bought_together_ids = [i for i, _ in copurchase_index.lookup(conn, product.id)][:4]
+
+    # Обе подборки загружаем одним запросом
+    wanted = set(related_ids) | set(bought_together_ids)
+    by_id = {p.id: p for p in Product.query.filter(Product.id.in_(wanted)).all()} if wanted else {}
+    related_products = [by_id[i] for i in related_ids if i in by_id]
+    bought_together = [by_id[i] for i in bought_together_ids if i in by_id]
 
     return render_template('product_detail.html',
                            product=product,
-                           related_products=related_products)
+                           related_products=related_products,
+                           bought_together=bought_together)
 
 
 @app.route('/about')
+@response_cache.cached
 def about():
     """Страница о компании"""
     return render_template('about.html')
@@ -379,6 +852,9 @@ def register():
         db.session.add(user)
         db.session.commit()
 
+        # Корзина, собранная до регистрации, будет ждать после входа
+        merge_guest_cart(user.id)
+
         flash('Регистрация успешна! Теперь вы можете войти.', 'success')
         return redirect(url_for('login'))
 
@@ -399,6 +875,7 @@ def login():
 
         if user and user.check_password(password):
             login_user(user)
+            merge_guest_cart(user.id)
             next_page = request.args.get('next')
             flash(f'Добро пожаловать, {username}!', 'success')
             return redirect(next_page or url_for('index'))
@@ -418,16 +895,29 @@ def logout():
 
 
 @app.route('/cart')
-@login_required
 def cart():
     """Корзина товаров"""
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    if current_user.is_authenticated:
+        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    else:
+        cart_items = guest_cart_items()
     total = sum(item.product.price * item.quantity for item in cart_items if item.product)
-    return render_template('cart.html', cart_items=cart_items, total=total)
+
+    # С товарами из корзины покупают
+    recommended = []
+    if cart_items:
+        recommended_ids = copurchase_index.recommend(db.session.connection(),
+                                                     [item.product_id for item in cart_items])
+        if recommended_ids:
+            by_id = {p.id: p for p in Product.query.filter(Product.id.in_(recommended_ids)).all()}
+            recommended = [by_id[i] for i in recommended_ids if i in by_id]
+
+    return render_template('cart.html', cart_items=cart_items, total=total, recommended=recommended)
 
 
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
+@immediate_transaction()
 def checkout():
     """Оформление заказа"""
     cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
@@ -436,11 +926,14 @@ def checkout():
         flash('Ваша корзина пуста', 'warning')
         return redirect(url_for('cart'))
 
-    # Проверяем наличие всех товаров
-    unavailable_items = []
-    for item in cart_items:
-        if item.product and item.product.stock < item.quantity:
-            unavailable_items.append(item.product.name)
+    # Проверяем наличие всех товаров: продлеваем удержания корзины (или ставим заново, если истекли)
+    quantities = {item.product_id: item.quantity for item in cart_items if item.product}
+    granted = reservations.hold(db.session.connection(), current_user.id, quantities)
+    unavailable_items = [item.product.name for item in cart_items
+                         if item.product and granted.get(item.product_id, 0) < item.quantity]
+    # При POST продление уходит одной транзакцией с заказом
+    if request.method == 'GET' or unavailable_items:
+        db.session.commit()
 
     if unavailable_items:
         flash(f'Следующие товары недоступны в нужном количестве: {", ".join(unavailable_items)}', 'danger')
@@ -489,8 +982,12 @@ def checkout():
                     )
                     db.session.add(order_item)
 
-                    # Уменьшаем количество товара на складе
-                    cart_item.product.stock -= cart_item.quantity
+            # Списываем со склада условным UPDATE, превращая удержания в продажу
+            conn = db.session.connection()
+            reservations.consume(conn, current_user.id, quantities)
+            inventory.record(db.session, {product_id: -quantity for product_id, quantity in quantities.items()},
+                             'sale', order.id)
+            bump_catalog_version(conn)
 
             # Очищаем корзину
             CartItem.query.filter_by(user_id=current_user.id).delete()
@@ -501,6 +998,12 @@ def checkout():
             flash(f'Заказ #{order.order_number} успешно оформлен!', 'success')
             return redirect(url_for('order_confirmation', order_id=order.id))
 
+        except OutOfStock as e:
+            db.session.rollback()
+            product = db.session.get(Product, e.product_id)
+            flash(f'Товар "{product.name if product else e.product_id}" закончился, пока оформлялся заказ', 'danger')
+            return redirect(url_for('cart'))
+
         except Exception as e:
             db.session.rollback()
             app.logger.error(f'Ошибка при оформлении заказа: {e}')
@@ -512,6 +1015,21 @@ def checkout():
                            user=current_user)
 
 
+def find_order(order_id):
+    """Заказ по id из рабочей таблицы или архива; 404, если его нет нигде"""
+    order = db.session.get(Order, order_id)
+    if order is None:
+        order = ArchivedOrder.query.filter_by(id=order_id).first_or_404()
+    return order
+
+
+def user_order_history(user_id):
+    """Все заказы пользователя, новые первыми: рабочие и архивные"""
+    orders = Order.query.filter_by(user_id=user_id).all()
+    orders.extend(ArchivedOrder.query.filter_by(user_id=user_id).all())
+    return sorted(orders, key=lambda order: order.created_at or datetime.min, reverse=True)
+
+
 @app.route('/order/confirmation/<int:order_id>')
 @login_required
 def order_confirmation(order_id):
@@ -530,7 +1048,7 @@ def order_confirmation(order_id):
 @login_required
 def user_orders():
     """Список заказов пользователя"""
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    orders = user_order_history(current_user.id)
     return render_template('orders.html', orders=orders)
 
 
@@ -538,7 +1056,7 @@ def user_orders():
 @login_required
 def order_detail(order_id):
     """Детальная информация о заказе"""
-    order = Order.query.get_or_404(order_id)
+    order = find_order(order_id)
 
     # Проверяем, что заказ принадлежит пользователю
     if order.user_id != current_user.id and not current_user.is_admin:
@@ -549,7 +1067,7 @@ def order_detail(order_id):
 
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
-@login_required
+@immediate_transaction(authenticated_only=True)
 def add_to_cart(product_id):
     """Добавление товара в корзину"""
     try:
@@ -565,31 +1083,53 @@ def add_to_cart(product_id):
             flash(f'Товар "{product.name}" закончился', 'warning')
             return redirect(request.referrer or url_for('catalog'))
 
-        # Ищем товар в корзине пользователя
-        cart_item = CartItem.query.filter_by(
-            user_id=current_user.id,
-            product_id=product_id
-        ).first()
-
-        if cart_item:
-            # Проверяем, не превышаем ли остаток на складе
-            if cart_item.quantity < product.stock:
-                cart_item.quantity += 1
+        if current_user.is_authenticated:
+            # Ищем товар в корзине пользователя
+            cart_item = CartItem.query.filter_by(
+                user_id=current_user.id,
+                product_id=product_id
+            ).first()
+            quantity = cart_item.quantity if cart_item else 0
+        else:
+            # Гость: корзина в cookie, в БД ничего не пишем
+            cart_item = None
+            quantity = guest_cart.get().get(product_id, 0)
+
+        if quantity >= product.stock:
+            message = f'Невозможно добавить больше товара "{product.name}". На складе осталось только {product.stock} шт.'
+            success = False
+        elif current_user.is_authenticated and reservations.hold(
+                db.session.connection(), current_user.id, {product_id: quantity + 1})[product_id] <= quantity:
+            message = f'Товар "{product.name}" сейчас зарезервирован другими покупателями. Попробуйте позже.'
+            success = False
+        else:
+            if quantity:
                 message = f'Количество товара "{product.name}" в корзине увеличено'
-                success = True
             else:
-                message = f'Невозможно добавить больше товара "{product.name}". На складе осталось только {product.stock} шт.'
-                success = False
-        else:
-            cart_item = CartItem(user_id=current_user.id, product_id=product_id)
-            db.session.add(cart_item)
-            message = f'Товар "{product.name}" добавлен в корзину'
+                message = f'Товар "{product.name}" добавлен в корзину'
             success = True
 
-        db.session.commit()
+            if not current_user.is_authenticated:
+                cart = dict(guest_cart.get())
+                cart[product_id] = quantity + 1
+                try:
+                    guest_cart.save(cart)
+                except ValueError as e:
+                    message = str(e)
+                    success = False
+            elif cart_item:
+                cart_item.quantity += 1
+            else:
+                db.session.add(CartItem(user_id=current_user.id, product_id=product_id))
+
+        if current_user.is_authenticated:
+            db.session.commit()
+
+        if success:
+            popularity.record_cart_add(product_id)
 
         # Подсчитываем общее количество товаров в корзине
-        cart_count = sum(item.quantity for item in current_user.cart_items)
+        cart_count = cart_count_for(current_user.id) if current_user.is_authenticated else guest_cart.count
 
         # Проверяем AJAX запрос
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -618,10 +1158,225 @@ def add_to_cart(product_id):
         return redirect(request.referrer or url_for('catalog'))
 
 
+def cart_count_for(user_id):
+    """Количество единиц товара в корзине одним SUM"""
+    return db.session.query(db.func.coalesce(db.func.sum(CartItem.quantity), 0)) \
+        .filter(CartItem.user_id == user_id).scalar()
+
+
+def cart_summary(user_id):
+    """Состав и итоги корзины одним запросом"""
+    rows = db.session.query(CartItem.product_id, CartItem.quantity, Product.name, Product.price, Product.stock) \
+        .join(Product, Product.id == CartItem.product_id) \
+        .filter(CartItem.user_id == user_id) \
+        .order_by(CartItem.id).all()
+    items = [
+        {
+            'product_id': row.product_id,
+            'name': row.name,
+            'price': row.price,
+            'quantity': row.quantity,
+            'stock': row.stock,
+            'subtotal': round(row.price * row.quantity, 2)
+        }
+        for row in rows
+    ]
+    return {
+        'items': items,
+        'positions': len(items),
+        'cart_count': sum(item['quantity'] for item in items),
+        'total': round(sum(item['subtotal'] for item in items), 2)
+    }
+
+
+def parse_cart_operations(payload):
+    """Разбирает {"items": [{"product_id": 1, "quantity": 2}, ...]} в {product_id: quantity}"""
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('Ожидается непустой список items')
+    if len(items) > app.config.get('CART_BATCH_MAX_ITEMS', 100):
+        raise ValueError('Слишком много позиций в одном запросе')
+
+    quantities = {}
+    for item in items:
+        try:
+            product_id = int(item['product_id'])
+            quantity = int(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Каждая позиция должна содержать целые product_id и quantity')
+        if quantity < 0:
+            raise ValueError('Количество не может быть отрицательным')
+        # Повтор товара в пачке - действует последнее значение
+        quantities[product_id] = quantity
+    return quantities
+
+
+def check_cart_quantities(quantities):
+    """Проверяет остатки одним запросом: (допустимые количества, поправки, ошибки).
+
+    Количество урезается до остатка на складе, несуществующие товары пропускаются.
+    """
+    stock = dict(db.session.query(Product.id, Product.stock).filter(Product.id.in_(list(quantities))).all())
+
+    allowed = {}
+    adjusted = []
+    errors = []
+    for product_id, quantity in quantities.items():
+        if product_id not in stock:
+            errors.append({'product_id': product_id, 'message': 'Товар не найден'})
+            continue
+        available = max(stock[product_id] or 0, 0)
+        if quantity > available:
+            adjusted.append({'product_id': product_id, 'requested': quantity, 'quantity': available,
+                             'message': f'На складе осталось только {available} шт.'})
+            quantity = available
+        allowed[product_id] = quantity
+    return allowed, adjusted, errors
+
+
+def set_cart_quantities(user_id, quantities):
+    """Устанавливает количества пачкой: одна проверка остатков, резервирование, один upsert, один delete"""
+    allowed, adjusted, errors = check_cart_quantities(quantities)
+
+    granted = reservations.hold(db.session.connection(), user_id, allowed)
+    for product_id, quantity in granted.items():
+        if quantity < allowed[product_id]:
+            adjusted.append({'product_id': product_id, 'requested': quantities[product_id], 'quantity': quantity,
+                             'message': f'Доступно только {quantity} шт., остальное зарезервировано другими покупателями'})
+    allowed = granted
+    to_set = {product_id: quantity for product_id, quantity in allowed.items() if quantity > 0}
+    to_delete = [product_id for product_id, quantity in allowed.items() if quantity == 0]
+
+    table = CartItem.__table__
+    now = datetime.utcnow()
+    if to_set:
+        db.session.execute(
+            # ON CONFLICT DO UPDATE не применяет onupdate столбца - added_at обновляем явно
+            upsert_statement(table, ['user_id', 'product_id'], ['quantity', 'added_at']),
+            [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity, 'added_at': now}
+             for product_id, quantity in to_set.items()]
+        )
+    if to_delete:
+        db.session.execute(table.delete().where(table.c.user_id == user_id, table.c.product_id.in_(to_delete)))
+    db.session.commit()
+    return adjusted, errors
+
+
+def set_guest_cart_quantities(quantities):
+    """То же для гостя: проверка остатков в БД, запись только в cookie"""
+    allowed, adjusted, errors = check_cart_quantities(quantities)
+    cart = dict(guest_cart.get())
+    cart.update(allowed)
+    guest_cart.save(cart)
+    return adjusted, errors
+
+
+def guest_cart_items():
+    """Позиции гостевой корзины с товарами (один запрос); пропавшие товары отбрасываются"""
+    cart = guest_cart.get()
+    if not cart:
+        return []
+    by_id = {p.id: p for p in Product.query.filter(Product.id.in_(list(cart))).all()}
+    return [GuestCartItem(by_id[product_id], quantity) for product_id, quantity in cart.items() if product_id in by_id]
+
+
+def guest_cart_summary():
+    """Итоги гостевой корзины в том же формате, что cart_summary()"""
+    items = [
+        {
+            'product_id': item.product_id,
+            'name': item.product.name,
+            'price': item.product.price,
+            'quantity': item.quantity,
+            'stock': item.product.stock,
+            'subtotal': round(item.product.price * item.quantity, 2)
+        }
+        for item in guest_cart_items()
+    ]
+    return {
+        'items': items,
+        'positions': len(items),
+        'cart_count': sum(item['quantity'] for item in items),
+        'total': round(sum(item['subtotal'] for item in items), 2)
+    }
+
+
+def merge_guest_cart(user_id):
+    """Переносит корзину гостя в CartItem: количества складываются и урезаются по остаткам"""
+    cart = guest_cart.get()
+    if not cart:
+        return
+    try:
+        existing = dict(db.session.query(CartItem.product_id, CartItem.quantity)
+                        .filter(CartItem.user_id == user_id, CartItem.product_id.in_(list(cart))).all())
+        set_cart_quantities(user_id, {
+            product_id: existing.get(product_id, 0) + quantity for product_id, quantity in cart.items()
+        })
+        guest_cart.clear()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка переноса корзины гостя: {e}')
+
+
+@app.route('/api/cart', methods=['GET', 'POST'])
+@immediate_transaction(methods=['POST'], authenticated_only=True)
+def api_cart():
+    """JSON API корзины: GET - состав, POST - пачка установок количества.
+
+    Для гостя корзина читается и пишется в cookie, БД только читается.
+    """
+    is_guest = not current_user.is_authenticated
+
+    if request.method == 'GET':
+        return jsonify({'success': True, 'cart': guest_cart_summary() if is_guest else cart_summary(current_user.id)})
+
+    try:
+        quantities = parse_cart_operations(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        if is_guest:
+            adjusted, errors = set_guest_cart_quantities(quantities)
+        else:
+            adjusted, errors = set_cart_quantities(current_user.id, quantities)
+    except ValueError as e:
+        # Переполнение гостевой корзины
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка обновления корзины: {e}')
+        return jsonify({'success': False, 'message': 'Не удалось обновить корзину'}), 500
+
+    return jsonify({
+        'success': not errors,
+        'adjusted': adjusted,
+        'errors': errors,
+        'cart': guest_cart_summary() if is_guest else cart_summary(current_user.id)
+    })
+
+
 @app.route('/update_cart/<int:item_id>', methods=['POST'])
-@login_required
+@immediate_transaction(authenticated_only=True)
 def update_cart(item_id):
     """Обновление количества товара в корзине"""
+    if not current_user.is_authenticated:
+        # У гостя item_id - это id товара в корзине из cookie
+        cart = dict(guest_cart.get())
+        quantity = cart.get(item_id, 0)
+        action = request.form.get('action')
+        if action == 'increment':
+            adjusted, _ = set_guest_cart_quantities({item_id: quantity + 1})
+            if adjusted:
+                flash(f'Невозможно добавить больше товара. {adjusted[0]["message"]}', 'warning')
+        elif action == 'decrement':
+            cart[item_id] = quantity - 1
+            guest_cart.save(cart)
+        elif action == 'remove':
+            cart.pop(item_id, None)
+            guest_cart.save(cart)
+        return redirect(url_for('cart'))
+
     cart_item = CartItem.query.get_or_404(item_id)
 
     if cart_item.user_id != current_user.id:
@@ -629,18 +1384,24 @@ def update_cart(item_id):
         return redirect(url_for('cart'))
 
     action = request.form.get('action')
+    conn = db.session.connection()
 
     if action == 'increment':
-        if cart_item.product and cart_item.quantity < cart_item.product.stock:
+        if (cart_item.product and cart_item.quantity < cart_item.product.stock
+                and reservations.hold(conn, current_user.id,
+                                      {cart_item.product_id: cart_item.quantity + 1})[cart_item.product_id] > cart_item.quantity):
             cart_item.quantity += 1
         else:
             flash(f'Невозможно добавить больше товара "{cart_item.product.name if cart_item.product else ""}". Недостаточно на складе.', 'warning')
     elif action == 'decrement':
         if cart_item.quantity > 1:
             cart_item.quantity -= 1
+            reservations.hold(conn, current_user.id, {cart_item.product_id: cart_item.quantity})
         else:
+            reservations.release(conn, current_user.id, [cart_item.product_id])
             db.session.delete(cart_item)
     elif action == 'remove':
+        reservations.release(conn, current_user.id, [cart_item.product_id])
         db.session.delete(cart_item)
 
     db.session.commit()
@@ -648,11 +1409,15 @@ def update_cart(item_id):
 
 
 @app.route('/clear_cart')
-@login_required
+@immediate_transaction(authenticated_only=True)
 def clear_cart():
     """Очистка корзины"""
-    CartItem.query.filter_by(user_id=current_user.id).delete()
-    db.session.commit()
+    if current_user.is_authenticated:
+        CartItem.query.filter_by(user_id=current_user.id).delete()
+        reservations.release(db.session.connection(), current_user.id)
+        db.session.commit()
+    else:
+        guest_cart.clear()
     flash('Корзина очищена', 'info')
     return redirect(url_for('cart'))
 
@@ -745,7 +1510,7 @@ def add_product():
             if 'image' in request.files:
                 file = request.files['image']
                 if file and file.filename != '':
-                    filename = save_product_image(file)
+                    filename = save_product_image(file, product)
                     if filename:
                         product.image_filename = filename
                         flash('Изображение успешно загружено', 'success')
@@ -786,21 +1551,22 @@ def edit_product(id):
             product.stock = int(request.form.get('stock'))
 
             # Обработка нового изображения
+            old_image = product.image_filename
             if 'image' in request.files:
                 file = request.files['image']
                 if file and file.filename != '':
-                    # Удаляем старое изображение если есть
-                    if product.image_filename:
-                        delete_product_image(product.image_filename)
-                    
                     # Сохраняем новое
-                    filename = save_product_image(file)
+                    filename = save_product_image(file, product)
                     if filename:
                         product.image_filename = filename
                         flash('Изображение успешно обновлено', 'success')
                     else:
                         flash('Ошибка при загрузке изображения', 'warning')
 
+            # Старое изображение удалит фоновая задача после commit, если на него никто больше не ссылается
+            if old_image and old_image != product.image_filename:
+                job_queue.enqueue('images.delete', {'filename': old_image})
+
             db.session.commit()
             flash('Товар успешно обновлен', 'success')
             return redirect(url_for('admin_products'))
@@ -825,14 +1591,18 @@ def delete_product(id):
     product = Product.query.get_or_404(id)
 
     try:
-        # Удаляем изображение если есть
-        if product.image_filename:
-            delete_product_image(product.image_filename)
+        image_filename = product.image_filename
 
         # Удаляем связанные записи в корзине
         CartItem.query.filter_by(product_id=id).delete()
+        StockHold.query.filter_by(product_id=id).delete()
 
         db.session.delete(product)
+
+        # Изображение удалит фоновая задача после commit, если другие товары его не используют
+        if image_filename:
+            job_queue.enqueue('images.delete', {'filename': image_filename})
+
         db.session.commit()
         flash('Товар успешно удален', 'success')
     
@@ -882,15 +1652,10 @@ def delete_user(id):
         return redirect(url_for('admin_users'))
 
     try:
-        # Удаляем корзину пользователя
-        CartItem.query.filter_by(user_id=id).delete()
-        
-        # Удаляем заказы пользователя
-        orders = Order.query.filter_by(user_id=id).all()
-        for order in orders:
-            db.session.delete(order)
-
-        db.session.delete(user)
+        connection = db.session.connection()
+        reservations.release(connection, id)
+        # Корзина, удержания, заказы и сам пользователь - несколько DELETE без загрузки объектов
+        delete_users(connection, db.metadata, [id])
         db.session.commit()
         flash('Пользователь успешно удален', 'success')
     
@@ -961,8 +1726,9 @@ def admin_order_detail(order_id):
         flash('Доступ запрещен', 'danger')
         return redirect(url_for('index'))
 
-    order = Order.query.get_or_404(order_id)
-    return render_template('admin/order_detail.html', order=order)
+    order = find_order(order_id)
+    allowed_statuses = () if order.archived else ORDER_TRANSITIONS.get(order.status, ())
+    return render_template('admin/order_detail.html', order=order, allowed_statuses=allowed_statuses)
 
 
 @app.route('/admin/order/update_status/<int:order_id>', methods=['POST'])
@@ -976,21 +1742,27 @@ def update_order_status(order_id):
     order = Order.query.get_or_404(order_id)
     new_status = request.form.get('status')
 
-    if new_status in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']:
-        order.status = new_status
-        order.updated_at = datetime.utcnow()
+    if new_status not in ORDER_TRANSITIONS:
+        flash('Недопустимый статус', 'danger')
+        return redirect(url_for('admin_order_detail', order_id=order_id))
 
-        # Если заказ отменен, возвращаем товары на склад
-        if new_status == 'cancelled' and order.status != 'cancelled':
-            for item in order.items:
-                product = Product.query.get(item.product_id)
-                if product:
-                    product.stock += item.quantity
+    if new_status == order.status:
+        flash(f'Заказ #{order.order_number} уже в статусе "{new_status}"', 'info')
+        return redirect(url_for('admin_order_detail', order_id=order_id))
 
+    try:
+        changed = apply_order_status([order_id], new_status)[0]
         db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка смены статуса заказа: {e}')
+        flash(f'Ошибка при смене статуса: {str(e)}', 'danger')
+        return redirect(url_for('admin_order_detail', order_id=order_id))
+
+    if changed:
         flash(f'Статус заказа #{order.order_number} обновлен на "{new_status}"', 'success')
     else:
-        flash('Недопустимый статус', 'danger')
+        flash(f'Нельзя перевести заказ #{order.order_number} из "{order.status}" в "{new_status}"', 'danger')
 
     return redirect(url_for('admin_order_detail', order_id=order_id))
 
@@ -1029,14 +1801,11 @@ def delete_order(order_id):
     order_number = order.order_number
 
     try:
-        # Возвращаем товары на склад если заказ не был отменен ранее
-        if order.status != 'cancelled':
-            for item in order.items:
-                product = Product.query.get(item.product_id)
-                if product:
-                    product.stock += item.quantity
-
-        db.session.delete(order)
+        # Товары возвращаются на склад, если заказ не был отменен ранее
+        connection = db.session.connection()
+        _, restored = delete_orders(connection, db.metadata, [order_id])
+        if restored:
+            bump_catalog_version(connection)
         db.session.commit()
         flash(f'Заказ #{order_number} успешно удален', 'success')
     except Exception as e:
@@ -1046,6 +1815,207 @@ def delete_order(order_id):
     return redirect(url_for('admin_orders'))
 
 
+def apply_order_status(order_ids, new_status):
+    """Переводит заказы в новый статус в текущей транзакции; возвращает (переведенные, пропущенные)"""
+    connection = db.session.connection()
+    changed, skipped = transition_orders(connection, db.metadata, order_ids, new_status)
+    if new_status == 'cancelled' and changed:
+        # Товары вернулись на склад Core-запросом, мимо after_flush
+        bump_catalog_version(connection)
+    return changed, skipped
+
+
+def parse_order_ids(values):
+    """Список id заказов из формы или JSON; ValueError при мусоре и превышении лимита"""
+    if not isinstance(values, list):
+        raise ValueError('Ожидается список id заказов')
+    try:
+        order_ids = sorted({int(value) for value in values})
+    except (TypeError, ValueError):
+        raise ValueError('id заказа должен быть числом')
+    limit = app.config.get('ORDER_BULK_MAX_ITEMS', 1000)
+    if len(order_ids) > limit:
+        raise ValueError(f'За один раз можно обработать не больше {limit} заказов')
+    return order_ids
+
+
+@app.route('/admin/orders/bulk', methods=['POST'])
+@login_required
+def bulk_orders():
+    """Массовые действия над выбранными заказами"""
+    if not current_user.is_admin:
+        flash('Доступ запрещен', 'danger')
+        return redirect(url_for('index'))
+
+    action = request.form.get('action')
+    back = url_for('admin_orders', status=request.form.get('status_filter', 'all'),
+                   search=request.form.get('search', ''))
+    try:
+        order_ids = parse_order_ids(request.form.getlist('order_ids'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(back)
+
+    if not order_ids:
+        flash('Не выбрано ни одного заказа', 'warning')
+        return redirect(back)
+
+    new_status = request.form.get('status')
+    if action == 'status' and new_status not in ORDER_TRANSITIONS:
+        flash('Недопустимый статус', 'danger')
+        return redirect(back)
+    if action not in ('delete', 'status'):
+        flash('Неизвестное действие', 'danger')
+        return redirect(back)
+
+    try:
+        if action == 'delete':
+            connection = db.session.connection()
+            deleted, restored = delete_orders(connection, db.metadata, order_ids)
+            if restored:
+                bump_catalog_version(connection)
+            db.session.commit()
+            flash(f'Удалено заказов: {deleted}', 'success')
+        else:
+            changed, skipped = apply_order_status(order_ids, new_status)
+            db.session.commit()
+            flash(f'Статус "{new_status}" установлен для заказов: {len(changed)}', 'success')
+            if skipped:
+                flash(f'Пропущено заказов (переход недопустим): {len(skipped)}', 'warning')
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка массовой операции над заказами: {e}')
+        flash(f'Ошибка при обработке заказов: {str(e)}', 'danger')
+
+    return redirect(back)
+
+
+@app.route('/admin/api/orders/status', methods=['POST'])
+@login_required
+def admin_orders_status_api():
+    """Массовая смена статуса заказов: {"order_ids": [...], "status": "shipped"}"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    payload = request.get_json(silent=True) or {}
+    new_status = payload.get('status')
+    if new_status not in ORDER_TRANSITIONS:
+        return jsonify({'success': False, 'message': 'Недопустимый статус'}), 400
+    try:
+        order_ids = parse_order_ids(payload.get('order_ids'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        changed, skipped = apply_order_status(order_ids, new_status)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Ошибка массовой смены статуса: {e}')
+        return jsonify({'success': False, 'message': 'Не удалось обновить заказы'}), 500
+
+    return jsonify({
+        'success': True,
+        'status': new_status,
+        'updated': changed,
+        'skipped': {str(order_id): status for order_id, status in skipped.items()}
+    })
+
+
+@app.route('/admin/reports')
+@login_required
+def admin_reports():
+    """Отчеты о продажах"""
+    if not current_user.is_admin:
+        flash('Доступ запрещен', 'danger')
+        return redirect(url_for('index'))
+
+    start_date, end_date = parse_range(request.args.get('start'), request.args.get('end'))
+    report = sales_reports.build(db.session.connection(), start_date, end_date)
+    pending_orders = Order.query.filter_by(status='pending').count()
+
+    return render_template('admin/reports.html',
+                           report=report,
+                           max_day_revenue=max(report['revenue_by_day'] or [0]),
+                           pending_orders=pending_orders)
+
+
+@app.route('/admin/api/reports')
+@login_required
+def admin_reports_api():
+    """Отчет о продажах в формате JSON"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    start_date, end_date = parse_range(request.args.get('start'), request.args.get('end'))
+    try:
+        top_n = min(max(int(request.args.get('top', 10)), 1), 100)
+    except ValueError:
+        top_n = 10
+    return jsonify(sales_reports.build(db.session.connection(), start_date, end_date, top_n))
+
+
+@app.route('/admin/profiler')
+@login_required
+def admin_profiler():
+    """Последние профили запросов по маршрутам"""
+    if not current_user.is_admin:
+        flash('Доступ запрещен', 'danger')
+        return redirect(url_for('index'))
+
+    route = request.args.get('route')
+    query = db.select(RequestProfile.token, RequestProfile.endpoint, RequestProfile.method, RequestProfile.path,
+                      RequestProfile.status, RequestProfile.duration_ms, RequestProfile.reason,
+                      RequestProfile.worker, RequestProfile.created_at)
+    if route:
+        query = query.where(RequestProfile.endpoint == route)
+    profiles = db.session.execute(query.order_by(RequestProfile.id.desc()).limit(100)).all()
+    routes = request_profiler.summary_by_endpoint(db.session.connection())
+    pending_orders = Order.query.filter_by(status='pending').count()
+
+    return render_template('admin/profiler.html',
+                           profiles=profiles,
+                           routes=routes,
+                           route=route,
+                           sample_rate=request_profiler.sample_rate,
+                           pending_orders=pending_orders)
+
+
+@app.route('/admin/profiler/<token>')
+@login_required
+def admin_profile_detail(token):
+    """Дерево вызовов и самые тяжелые функции одного профиля"""
+    if not current_user.is_admin:
+        flash('Доступ запрещен', 'danger')
+        return redirect(url_for('index'))
+
+    profile = RequestProfile.query.filter_by(token=token).first_or_404()
+    pending_orders = Order.query.filter_by(status='pending').count()
+    return render_template('admin/profile_detail.html',
+                           profile=profile,
+                           stats=json.loads(profile.stats),
+                           pending_orders=pending_orders)
+
+
+@app.route('/admin/api/profiler/memory', methods=['GET', 'POST'])
+@login_required
+def admin_profiler_memory():
+    """tracemalloc воркера, обслужившего запрос: start, snapshot (разница с прошлым снимком), stop"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Доступ запрещен'}), 403
+
+    action = request.values.get('action') if request.method == 'POST' else None
+    key_type = request.values.get('key_type', 'lineno')
+    if key_type not in ('lineno', 'filename', 'traceback'):
+        return jsonify({'error': 'key_type: lineno, filename или traceback'}), 400
+    try:
+        frames = min(max(int(request.values.get('frames', app.config.get('PROFILER_TRACEMALLOC_FRAMES', 1))), 1), 50)
+        limit = min(max(int(request.values.get('limit', 20)), 1), 200)
+    except ValueError:
+        return jsonify({'error': 'frames и limit - целые числа'}), 400
+    return jsonify(request_profiler.memory(action, frames, key_type, limit))
+
+
 # API для получения товаров в формате JSON
 @app.route('/api/products')
 def api_products():
@@ -1061,6 +2031,26 @@ def api_product(id):
     return jsonify(product.to_dict())
 
 
+@app.route('/api/autocomplete')
+def api_autocomplete():
+    """Подсказки для строки поиска: категории и товары по началу слов"""
+    query = request.args.get('q', '')[:100]
+    try:
+        limit = min(max(int(request.args.get('limit', 8)), 1), 20)
+    except ValueError:
+        limit = 8
+
+    suggestions = autocomplete.suggest(query, limit)
+    for suggestion in suggestions:
+        if suggestion['type'] == 'product':
+            suggestion['url'] = url_for('product_detail', product_id=suggestion['id'])
+        else:
+            suggestion['url'] = url_for('catalog', category=suggestion['name'])
+    response = jsonify({'query': query, 'suggestions': suggestions})
+    response.headers['Cache-Control'] = f"public, max-age={app.config.get('AUTOCOMPLETE_MAX_AGE', 60)}"
+    return response
+
+
 @app.route('/uploads/products/<filename>')
 def uploaded_file(filename):
     """Отдает загруженные файлы"""
@@ -1082,14 +2072,18 @@ def uploaded_file(filename):
         app.logger.error(f'Error serving file {filename}: {e}')
         return redirect('https://via.placeholder.com/500x300?text=Error+Loading+Image')
 
-@app.before_request
-def initialize_database_on_first_request():
-    """Инициализация базы данных при первом запросе"""
+def prepare_database():
+    """Проверяет схему БД: создает таблицы или добавляет недостающие столбцы и индексы.
+
+    Вызывается из create_app при запуске процесса (с preload_app gunicorn -
+    один раз в мастере) и, если приложение импортировано без create_app,
+    перед первым запросом.
+    """
     global _db_initialized
     
     if not _db_initialized:
         try:
-            print("🔄 Проверяем базу данных при первом запросе...")
+            print("🔄 Проверяем базу данных...")
             
             with app.app_context():
                 # Проверяем существует ли таблица product
@@ -1125,6 +2119,22 @@ def initialize_database_on_first_request():
                     db.session.commit()
                     print("✅ База данных инициализирована!")
                 else:
+                    # Журнал остатков появился позже товаров - при его создании переносим в него текущие остатки
+                    new_ledger = 'inventory_movement' not in inspector.get_table_names()
+
+                    # Создаем только недостающие таблицы (новые модели) и индексы
+                    db.create_all()
+                    ensure_columns()
+                    merge_duplicate_cart_items()
+                    ensure_indexes()
+
+                    if ensure_monotonic_ids(db.engine, Order.__table__, ArchivedOrder.__table__):
+                        print("🔢 Таблица order перестроена с AUTOINCREMENT: id архивных заказов не повторятся")
+
+                    if new_ledger:
+                        with db.engine.begin() as conn:
+                            seeded = inventory.seed_from_stock(conn)
+                        print(f"📒 Журнал остатков: перенесены остатки {seeded} товаров")
                     print("✅ Таблицы уже существуют")
             
             _db_initialized = True
@@ -1134,6 +2144,13 @@ def initialize_database_on_first_request():
             # Не помечаем как инициализированную, чтобы попробовать снова
 
 
+@app.before_request
+def initialize_database_on_first_request():
+    """Инициализация базы данных при первом запросе"""
+    if not _db_initialized:
+        prepare_database()
+
+
 # Функция для инициализации базы данных
 def init_database():
     with app.app_context():
@@ -1202,6 +2219,238 @@ def init_database():
             print(f"❌ Ошибка при инициализации базы данных: {e}")
 
 
+# Кеш публичных страниц (ETag/304, Cache-Control)
+response_cache.init_app(app, get_catalog_version)
+
+# Похожие товары и совместные покупки
+copurchase_index.init_app(app, db)
+related_engine.init_app(app, db)
+
+# Отчеты о продажах
+sales_reports.init_app(app, db)
+
+# Модель каталога в памяти (CATALOG_ENGINE=memory)
+catalog_model.init_app(app, db, get_catalog_version)
+
+# Счетчики просмотров и популярность
+popularity.init_app(app, db)
+
+# Корзина гостя в cookie
+guest_cart.init_app(app)
+
+# Резервирование товара в корзинах
+reservations.init_app(app, db)
+
+# Журнал движения товара
+inventory.init_app(app, db, Product)
+
+# Статика с хешем в имени и предсжатыми копиями (после flask build-assets)
+assets.init_app(app)
+
+# Фоновые задачи (python worker.py или после ответа в веб-процессе)
+job_queue.init_app(app, db)
+
+# Подсказки поиска (индекс строится при первом запросе)
+autocomplete.init_app(app, db, Product, get_catalog_version)
+
+
+@job_queue.task('images.process', concurrency=1)
+def process_image_job(conn, payload):
+    """Нарезка копий и заглушка для загруженного изображения всех товаров с ним"""
+    filename = payload['filename']
+    folder = app.config['PRODUCT_IMAGE_FOLDER']
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        return
+    with open_image(path) as image:
+        info = process_image(image, folder, filename, app.config.get('PRODUCT_IMAGE_WIDTHS', []))
+    table = Product.__table__
+    if conn.execute(table.update().where(table.c.image_filename == filename).values(**info)).rowcount:
+        bump_catalog_version(conn)
+
+
+@job_queue.task('images.delete')
+def delete_image_job(conn, payload):
+    """Удаление изображения, на которое больше не ссылаются товары"""
+    delete_product_image(payload['filename'])
+
+
+@job_queue.task('copurchase.apply_orders', immediate=True)
+def apply_orders_job(conn, payload):
+    """Пополняет индекс совместных покупок новыми заказами и обновляет похожие товары"""
+    baskets = [set(basket) for basket in payload['baskets']]
+    copurchase_index.apply_orders(conn, baskets)
+    related_engine.refresh(conn, set(itertools.chain.from_iterable(baskets)), copurchase_only=True)
+
+
+@app.cli.command('rebuild-copurchase')
+def rebuild_copurchase_command():
+    """Полная сборка индекса совместных покупок по истории заказов"""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        counter = copurchase_index.rebuild(conn)
+    print(f"✅ Обработано заказов: {counter.orders}, строк: {counter.lines}, "
+          f"пар: {counter.pairs} (отброшено редких: {counter.pruned}) за {time.perf_counter() - started:.1f} с")
+    print("   Чтобы учесть новые данные в похожих товарах, выполните flask rebuild-related")
+
+
+@app.cli.command('cleanup-carts')
+@click.option('--days', type=int, default=None, help='Возраст брошенной корзины в днях (по умолчанию CART_MAX_AGE_DAYS)')
+@click.option('--batch-size', type=int, default=None, help='Строк в одной транзакции (по умолчанию CART_CLEANUP_BATCH)')
+@click.option('--vacuum', is_flag=True, help='После удаления вернуть место на диске (VACUUM)')
+def cleanup_carts_command(days, batch_size, vacuum):
+    """Удаляет брошенные корзины пачками (для cron)"""
+    days = days or app.config.get('CART_MAX_AGE_DAYS', 30)
+    batch_size = batch_size or app.config.get('CART_CLEANUP_BATCH', 1000)
+    # Индекс по added_at мог еще не создаться, если приложение не запускалось после обновления
+    ensure_indexes()
+
+    started = time.perf_counter()
+    removed = cleanup_stale_carts(db.engine, CartItem.__table__, max_age_days=days, batch_size=batch_size,
+                                  pause=app.config.get('CART_CLEANUP_PAUSE', 0.05))
+    print(f"🧹 Удалено строк корзин старше {days} дн.: {removed} за {time.perf_counter() - started:.1f} с")
+
+    if removed or vacuum:
+        compact_table(db.engine, CartItem.__tablename__, vacuum=vacuum)
+        print("✅ Статистика обновлена" + (", место на диске возвращено" if vacuum else ""))
+
+
+@app.cli.command('archive-orders')
+@click.option('--months', type=int, default=None, help='Возраст заказа в месяцах (по умолчанию ORDER_ARCHIVE_MONTHS)')
+@click.option('--batch-size', type=int, default=None, help='Заказов в одной транзакции (по умолчанию ORDER_ARCHIVE_BATCH)')
+@click.option('--max-batches', type=int, default=None, help='Остановиться после стольких пачек')
+def archive_orders_command(months, batch_size, max_batches):
+    """Переносит доставленные и отмененные заказы старше N месяцев в архив (для cron)"""
+    months = months or app.config.get('ORDER_ARCHIVE_MONTHS', 12)
+    batch_size = batch_size or app.config.get('ORDER_ARCHIVE_BATCH', 500)
+    cutoff = months_ago(months)
+
+    started = time.perf_counter()
+    moved_orders, moved_items = archive_orders(db.engine, db.metadata, cutoff, batch_size=batch_size,
+                                               pause=app.config.get('ORDER_ARCHIVE_PAUSE', 0.05),
+                                               max_batches=max_batches)
+    print(f"📦 В архив перенесено заказов до {cutoff:%d.%m.%Y}: {moved_orders} (строк: {moved_items}) "
+          f"за {time.perf_counter() - started:.1f} с")
+
+    if moved_orders:
+        for table in (Order.__tablename__, OrderItem.__tablename__):
+            compact_table(db.engine, table)
+        print("✅ Статистика обновлена")
+
+
+@app.cli.command('expire-holds')
+@click.option('--recount', is_flag=True, help='Пересчитать product.reserved по активным удержаниям')
+def expire_holds_command(recount):
+    """Снимает истекшие удержания товара (для cron)"""
+    with db.engine.begin() as conn:
+        expired = reservations.sweep(conn)
+        if recount:
+            reservations.recount(conn)
+    print(f"✅ Снято истекших удержаний: {expired}" + (", резервы пересчитаны" if recount else ""))
+
+
+@app.cli.command('inventory-reconcile')
+@click.option('--fix', is_flag=True, help='Закрыть расхождения корректирующими движениями')
+@click.option('--show', type=int, default=20, help='Сколько расхождений вывести')
+def inventory_reconcile_command(fix, show):
+    """Сверяет остатки товаров с журналом движения"""
+    ensure_indexes()
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        discrepancies = inventory.reconcile(conn, fix=fix)
+    elapsed = time.perf_counter() - started
+
+    if not discrepancies:
+        print(f"✅ Остатки сходятся с журналом ({elapsed:.1f} с)")
+        return
+    print(f"⚠️ Расхождений: {len(discrepancies)} ({elapsed:.1f} с)")
+    for product_id, stock, balance in discrepancies[:show]:
+        print(f"   товар #{product_id}: остаток {stock}, по журналу {balance} ({stock - balance:+d})")
+    if fix:
+        print("✅ Добавлены корректирующие движения")
+
+
+@app.cli.command('build-assets')
+@click.option('--no-minify', is_flag=True, help='Не минифицировать CSS и JS')
+@click.option('--clean', is_flag=True, help='Удалить файлы прошлых сборок')
+def build_assets_command(no_minify, clean):
+    """Собирает статику с хешами в именах и сжатыми копиями в static/dist"""
+    started = time.perf_counter()
+    manifest = build_assets(app.static_folder, minify=not no_minify, clean=clean)
+    assets.load()
+    print(f"✅ Собрано файлов: {len(manifest)} за {time.perf_counter() - started:.1f} с")
+    for logical, hashed in sorted(manifest.items()):
+        print(f"   {logical} -> {hashed}")
+
+
+@app.cli.command('rebuild-images')
+def rebuild_images_command():
+    """Нарезает копии и заглушки для уже загруженных изображений товаров"""
+    folder = app.config['PRODUCT_IMAGE_FOLDER']
+    widths = app.config.get('PRODUCT_IMAGE_WIDTHS', [])
+    done = missing = 0
+    for product in Product.query.filter(Product.image_filename.isnot(None)).yield_per(200):
+        path = os.path.join(folder, product.image_filename)
+        if not os.path.exists(path):
+            missing += 1
+            continue
+        with open_image(path) as image:
+            for field, value in process_image(image, folder, product.image_filename, widths).items():
+                setattr(product, field, value)
+        done += 1
+    db.session.commit()
+    print(f"✅ Обработано изображений: {done}" + (f", файлов не найдено: {missing}" if missing else ""))
+
+
+@app.cli.command('gc-images')
+@click.option('--batch-size', type=int, default=1000, help='Файлов на один запрос к БД')
+@click.option('--min-age', type=int, default=3600, help='Не трогать файлы моложе стольких секунд')
+@click.option('--dry-run', is_flag=True, help='Только посчитать, ничего не удалять')
+def gc_images_command(batch_size, min_age, dry_run):
+    """Удаляет изображения, на которые не ссылается ни один товар"""
+    ensure_indexes()
+    started = time.perf_counter()
+    removed, reclaimed = collect_orphan_images(db.engine, Product.__table__, app.config['PRODUCT_IMAGE_FOLDER'],
+                                               batch_size=batch_size, min_age=min_age, dry_run=dry_run)
+    action = 'Можно удалить' if dry_run else 'Удалено'
+    print(f"🧹 {action} файлов: {removed}, {reclaimed / 1024 / 1024:.1f} МБ за {time.perf_counter() - started:.1f} с")
+
+
+@app.cli.command('rebuild-related')
+def rebuild_related_command():
+    """Полный пересчет похожих товаров"""
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        total = related_engine.rebuild_all(conn)
+    print(f"✅ Похожие товары пересчитаны для {total} товаров за {time.perf_counter() - started:.1f} с")
+
+
+@app.cli.command('jobs-status')
+def jobs_status_command():
+    """Очередь фоновых задач: количество по задачам и статусам, последние ошибки"""
+    with db.engine.connect() as conn:
+        stats = job_queue.stats(conn)
+        failed = conn.execute(
+            db.select(Job.id, Job.name, Job.attempts, Job.last_error)
+            .where(Job.status == 'failed').order_by(Job.id.desc()).limit(10)
+        ).all()
+    if not stats:
+        print("✅ Очередь пуста")
+    for (name, status), count in sorted(stats.items()):
+        print(f"   {name:<28} {status:<8} {count}")
+    for job in failed:
+        print(f"❌ #{job.id} {job.name} ({job.attempts} попыток): {job.last_error}")
+
+
+@app.cli.command('jobs-retry')
+@click.option('--name', default=None, help='Только задачи с этим именем')
+def jobs_retry_command(name):
+    """Возвращает задачи со статусом failed в очередь"""
+    with db.engine.begin() as conn:
+        count = job_queue.retry_failed(conn, name)
+    print(f"✅ В очередь возвращено задач: {count}")
+
+
 # Обработчики ошибок
 @app.errorhandler(404)
 def page_not_found(e):
@@ -1222,26 +2471,24 @@ def handle_exception(e):
     return render_template('500.html', error=str(e)), 500
 
 
-# Создание конфигурационного файла если его нет
-def create_config_if_not_exists():
-    config_path = 'config.py'
-    if not os.path.exists(config_path):
-        with open(config_path, 'w') as f:
-            f.write("""import os
+def create_app():
+    """Готовит приложение к работе и возвращает его (wsgi.py, worker.py).
 
-class Config:
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here-change-in-production'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///shop.db'
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = 'static/uploads'
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-""")
-        print("📄 Создан файл config.py")
+    Импорт app.py только объявляет модели, маршруты и расширения - без
+    запросов к БД, без Pillow и numpy (они загружаются при первой
+    обработке картинки или отчета). Папки и проверка схемы - здесь, один
+    раз на процесс; с preload_app gunicorn - один раз в мастере до fork
+    (см. gunicorn_config.py).
+    """
+    global _app_prepared
+    if not _app_prepared:
+        Config.init_app(app)
+        prepare_database()
+        _app_prepared = True
+    return app
 
 
-# Вызываем инициализацию при запуске
 if __name__ == '__main__':
-    create_config_if_not_exists()
+    create_app()
     init_database()
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 10000)))
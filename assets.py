@@ -0,0 +1,178 @@
+"""Сборка статики: минификация, хеш содержимого в имени и предсжатые копии.
+
+flask build-assets раскладывает файлы из static/ (кроме загрузок) в
+static/dist/ под именами вида css/style.3f9a1c2b7e.css, рядом кладет
+.gz и, если установлен пакет brotli, .br, и пишет manifest.json
+{исходный путь: путь с хешем}.
+
+После сборки url_for('static', filename='css/style.css') через
+url_defaults выдает адрес с хешем. Такие адреса никогда не меняют
+содержимое, поэтому отдаются с Cache-Control: immutable на год и
+повторный визит не скачивает их вовсе, а сжатая копия выбирается по
+Accept-Encoding без сжатия на лету. Без сборки все работает как раньше.
+"""
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import mimetypes
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+SKIP_DIRS = {'uploads', DIST_DIR}
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.xml'}
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def minify_css(source):
+    """Убирает комментарии и лишние пробелы; пробел перед ':' не трогает (a :hover != a:hover)"""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    source = re.sub(r':\s+', ':', source)
+    return source.replace(';}', '}').strip()
+
+
+def minify_js(source):
+    """Осторожная минификация без парсера: убирает отступы, пустые строки и строки-комментарии.
+
+    Внутри многострочных шаблонных строк (`...`) строки не меняются.
+    """
+    lines = []
+    in_template = False
+    for line in source.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('//'):
+                lines.append(stripped)
+        if line.count('`') % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def build_assets(static_folder, minify=True, clean=False):
+    """Собирает static/dist и манифест; возвращает манифест.
+
+    Файлы прошлых сборок по умолчанию остаются: на них могут ссылаться
+    закешированные страницы и открытые вкладки. clean=True удаляет их.
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    if clean and os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.relpath(root, static_folder) == '.':
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for name in sorted(files):
+            source_path = os.path.join(root, name)
+            logical = os.path.relpath(source_path, static_folder).replace(os.sep, '/')
+            base, ext = os.path.splitext(logical)
+
+            with open(source_path, 'rb') as f:
+                data = f.read()
+            if minify and ext in MINIFIERS:
+                data = MINIFIERS[ext](data.decode('utf-8')).encode('utf-8')
+
+            hashed = f'{DIST_DIR}/{base}.{content_hash(data)}{ext}'
+            target = os.path.join(static_folder, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            if ext in COMPRESSIBLE:
+                # mtime=0: одинаковый вход дает побайтно одинаковый .gz
+                variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+                if brotli is not None:
+                    variants.append(('.br', brotli.compress(data, quality=11)))
+                for suffix, compressed in variants:
+                    if os.path.exists(target + suffix):
+                        os.remove(target + suffix)
+                    if len(compressed) < len(data):
+                        with open(target + suffix, 'wb') as f:
+                            f.write(compressed)
+
+            manifest[logical] = hashed
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class AssetPipeline:
+
+    def __init__(self):
+        self.manifest = {}
+        self.static_folder = None
+        self.max_age = 365 * 24 * 3600
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.max_age = app.config.get('ASSETS_MAX_AGE', 365 * 24 * 3600)
+        if app.config.get('ASSETS_ENABLED', True):
+            self.load()
+
+        @app.url_defaults
+        def hashed_static_url(endpoint, values):
+            if endpoint == 'static' and self.manifest:
+                hashed = self.manifest.get(values.get('filename'))
+                if hashed:
+                    values['filename'] = hashed
+
+        default_static = app.view_functions['static']
+
+        def static(filename):
+            # Все в dist/, кроме манифеста, названо по хешу содержимого, включая прошлые сборки
+            if filename.startswith(DIST_DIR + '/') and filename != f'{DIST_DIR}/{MANIFEST_NAME}':
+                return self.send_hashed(filename)
+            return default_static(filename=filename)
+
+        app.view_functions['static'] = static
+
+    def load(self):
+        """Читает манифест сборки, если он есть"""
+        path = os.path.join(self.static_folder, DIST_DIR, MANIFEST_NAME)
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def send_hashed(self, filename):
+        """Отдает файл с хешем: предсжатую копию по Accept-Encoding, кеш навсегда"""
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        path = filename
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(os.path.join(self.static_folder, filename + suffix)):
+                encoding, path = name, filename + suffix
+                break
+
+        response = send_from_directory(self.static_folder, path, mimetype=mimetype, max_age=self.max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+assets = AssetPipeline()
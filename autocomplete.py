@@ -0,0 +1,392 @@
+"""Подсказки поиска по мере ввода (/api/autocomplete).
+
+Индекс в памяти воркера: отсортированный список слов из названий
+товаров (keys) и параллельный список массивов id товаров с этим словом
+(postings). Слова с префиксом p лежат в keys подряд, их диапазон находит
+bisect. Нормализация - casefold и ё -> е, так что "Ёлка", "ЕЛКА" и "елк"
+совпадают. Несколько слов запроса - пересечение множеств по каждому
+префиксу, начиная с самого длинного.
+
+Опечатки: если у слова из 3+ букв нет ни одного совпадения, проверяются
+варианты на расстоянии редактирования 1 (удаление, перестановка
+соседних, замена, вставка). Для замен и вставок перебираются не все
+буквы алфавита, а только те, что реально идут в индексе за префиксом
+(по одному bisect на букву), поэтому вариантов - сотни, а не тысячи.
+
+Обновление: изменения товаров через сессию этого процесса применяются
+сразу после commit. Изменения из других процессов подтягиваются, когда
+меняется версия каталога, не чаще AUTOCOMPLETE_SYNC_INTERVAL: по
+product.updated_at с запасом AUTOCOMPLETE_SYNC_OVERLAP на часы разных
+серверов и долгие транзакции. Если число товаров разошлось (удаление в
+другом процессе), индекс пересобирается целиком.
+"""
+import re
+import time
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, func, inspect
+
+import metrics
+
+WORD_RE = re.compile(r'\w+')
+MAX_CHAR = '\U0010ffff'
+FUZZY_MIN_LENGTH = 3
+
+
+def normalize(text):
+    return (text or '').casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    return WORD_RE.findall(normalize(text))
+
+
+class AutocompleteIndex:
+
+    def __init__(self):
+        self.metadata = None
+        self.engine_getter = None
+        self.version_getter = None
+        self.product_class = None
+        self.keys = []
+        self.postings = []
+        self.products = {}
+        self.categories = {}
+        self.version = None
+        self.watermark = None
+        self.loaded = False
+        self.last_sync = 0.0
+        self.sync_interval = 5.0
+        self.sync_overlap = timedelta(seconds=60)
+        self.candidates_cap = 500
+        self.min_chars = 2
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+
+    def init_app(self, app, db, product_class, version_getter):
+        self.metadata = db.metadata
+        self.engine_getter = lambda: db.engine
+        self.version_getter = version_getter
+        self.product_class = product_class
+        self.sync_interval = app.config.get('AUTOCOMPLETE_SYNC_INTERVAL', 5)
+        self.sync_overlap = timedelta(seconds=app.config.get('AUTOCOMPLETE_SYNC_OVERLAP', 60))
+        self.candidates_cap = app.config.get('AUTOCOMPLETE_CANDIDATES', 500)
+        self.min_chars = app.config.get('AUTOCOMPLETE_MIN_CHARS', 2)
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._apply_changes)
+        event.listen(db.session, 'after_soft_rollback', self._drop_changes)
+
+    # ---- изменения через сессию этого процесса ----
+
+    def _collect_changes(self, session, flush_context):
+        if not self.loaded:
+            return
+        changes = session.info.setdefault('autocomplete_changes', {})
+        for obj in session.new:
+            if isinstance(obj, self.product_class):
+                changes[obj.id] = (obj.name, obj.category)
+        for obj in session.dirty:
+            if not isinstance(obj, self.product_class):
+                continue
+            attrs = inspect(obj).attrs
+            # Остаток и цена меняются часто, а на подсказки не влияют
+            if attrs.name.history.has_changes() or attrs.category.history.has_changes():
+                changes[obj.id] = (obj.name, obj.category)
+        for obj in session.deleted:
+            if isinstance(obj, self.product_class):
+                changes[obj.id] = None
+
+    def _apply_changes(self, session):
+        changes = session.info.pop('autocomplete_changes', None)
+        if changes:
+            with self._lock:
+                for product_id, values in changes.items():
+                    self.remove(product_id)
+                    if values is not None:
+                        self.add(product_id, *values)
+                # Свои изменения уже в индексе; updated_at у них не позже текущего момента
+                now = datetime.utcnow()
+                if self.watermark is None or now > self.watermark:
+                    self.watermark = now
+
+    @staticmethod
+    def _drop_changes(session, previous_transaction):
+        session.info.pop('autocomplete_changes', None)
+
+    # ---- сборка и обновление ----
+
+    def _order(self, product_id, word):
+        """Порядок товара в списке слова: сначала названия, начинающиеся с него, потом короткие"""
+        name, normalized, _, tokens = self.products[product_id]
+        return (tokens[0] != word, len(name), normalized, product_id)
+
+    def load(self):
+        """Полная сборка индекса из таблицы product"""
+        p = self.metadata.tables['product']
+        started = time.perf_counter()
+        version = self.version_getter()[0]
+        words = {}
+        products = {}
+        categories = {}
+        with self.engine_getter().connect() as conn:
+            watermark = conn.execute(select(func.max(p.c.updated_at))).scalar()
+            result = conn.execution_options(stream_results=True, yield_per=10000).execute(
+                select(p.c.id, p.c.name, p.c.category)
+            )
+            for product_id, name, category in result:
+                tokens = tuple(tokenize(name)) or ('',)
+                products[product_id] = (name, normalize(name), category, tokens)
+                for word in set(tokens):
+                    words.setdefault(word, []).append(product_id)
+                if category:
+                    categories[category] = categories.get(category, 0) + 1
+
+        keys = sorted(words)
+        with self._lock:
+            self.products = products
+            self.postings = [
+                array('l', sorted(words[key], key=lambda product_id: self._order(product_id, key)))
+                for key in keys
+            ]
+            self.keys, self.categories = keys, categories
+            self.version = version
+            self.watermark = watermark
+            self.loaded = True
+            self.last_sync = time.monotonic()
+        metrics.registry.set_gauge('shop_autocomplete_terms', len(keys))
+        metrics.registry.inc('shop_autocomplete_rebuilds_total')
+        return time.perf_counter() - started
+
+    def add(self, product_id, name, category):
+        tokens = tuple(tokenize(name)) or ('',)
+        self.products[product_id] = (name, normalize(name), category, tokens)
+        for word in set(tokens):
+            i = bisect_left(self.keys, word)
+            if i < len(self.keys) and self.keys[i] == word:
+                insort(self.postings[i], product_id, key=lambda pid: self._order(pid, word))
+            else:
+                self.keys.insert(i, word)
+                self.postings.insert(i, array('l', [product_id]))
+        if category:
+            self.categories[category] = self.categories.get(category, 0) + 1
+
+    def remove(self, product_id):
+        entry = self.products.get(product_id)
+        if entry is None:
+            return
+        _, _, category, tokens = entry
+        for word in set(tokens):
+            i = bisect_left(self.keys, word)
+            if i < len(self.keys) and self.keys[i] == word:
+                ids = self.postings[i]
+                j = bisect_left(ids, self._order(product_id, word), key=lambda pid: self._order(pid, word))
+                if j < len(ids) and ids[j] == product_id:
+                    del ids[j]
+                if not ids:
+                    del self.keys[i]
+                    del self.postings[i]
+        del self.products[product_id]
+        if category and category in self.categories:
+            self.categories[category] -= 1
+            if not self.categories[category]:
+                del self.categories[category]
+
+    def sync(self):
+        """Подтягивает изменения других процессов по updated_at"""
+        if self.watermark is None:
+            # Ни у одного товара нет updated_at (или таблица пуста) - сравнивать не с чем
+            self.load()
+            return
+        p = self.metadata.tables['product']
+        version = self.version_getter()[0]
+        since = self.watermark - self.sync_overlap
+        with self.engine_getter().connect() as conn:
+            total = conn.execute(select(func.count()).select_from(p)).scalar()
+            rows = conn.execute(
+                select(p.c.id, p.c.name, p.c.category, p.c.updated_at).where(p.c.updated_at > since)
+            ).all()
+        with self._lock:
+            for row in rows:
+                self.remove(row.id)
+                self.add(row.id, row.name, row.category)
+                if self.watermark is None or row.updated_at > self.watermark:
+                    self.watermark = row.updated_at
+            self.version = version
+            self.last_sync = time.monotonic()
+            consistent = len(self.products) == total
+        if not consistent:
+            self.load()
+
+    def ensure_fresh(self):
+        if not self.loaded:
+            with self._sync_lock:
+                if not self.loaded:
+                    self.load()
+            return
+        if time.monotonic() - self.last_sync < self.sync_interval:
+            return
+        if self.version_getter()[0] == self.version:
+            self.last_sync = time.monotonic()
+            return
+        # Синхронизирует один поток; остальные отвечают по текущему индексу
+        if self._sync_lock.acquire(blocking=False):
+            try:
+                self.sync()
+            finally:
+                self._sync_lock.release()
+
+    # ---- поиск ----
+
+    def _range(self, prefix):
+        keys = self.keys
+        start = bisect_left(keys, prefix)
+        return start, bisect_left(keys, prefix + MAX_CHAR, start)
+
+    def _top_ids(self, ranges, limit):
+        """Лучшие товары для одного слова: из каждого слова в диапазонах - первые limit"""
+        ids = set()
+        scanned = 0
+        for start, end in ranges:
+            for i in range(start, end):
+                ids.update(self.postings[i][:limit])
+                scanned += 1
+                if scanned >= self.candidates_cap:
+                    return ids
+        return ids
+
+    def _range_ids(self, ranges):
+        """Все товары в диапазонах (не больше AUTOCOMPLETE_CANDIDATES)"""
+        ids = set()
+        for start, end in ranges:
+            for i in range(start, end):
+                ids.update(self.postings[i])
+                if len(ids) >= self.candidates_cap:
+                    return ids
+        return ids
+
+    def _estimate(self, ranges):
+        """Сколько товаров в диапазонах; считать дальше нескольких лимитов незачем"""
+        bound = self.candidates_cap * 4
+        total = 0
+        for start, end in ranges:
+            for i in range(start, end):
+                total += len(self.postings[i])
+                if total >= bound:
+                    return total
+        return total
+
+    def _has_prefix(self, prefix):
+        start, end = self._range(prefix)
+        return end > start
+
+    def _next_chars(self, prefix):
+        """Буквы, которые идут в индексе сразу за prefix: по одному bisect на букву"""
+        keys = self.keys
+        n = len(prefix)
+        i, end = self._range(prefix)
+        chars = []
+        while i < end:
+            if len(keys[i]) > n:
+                char = keys[i][n]
+                chars.append(char)
+                i = bisect_left(keys, prefix + char + MAX_CHAR, i, end)
+            else:
+                i += 1
+        return chars
+
+    def fuzzy_prefixes(self, word):
+        """Префиксы из индекса на расстоянии редактирования 1 от word"""
+        variants = set()
+        for i in range(len(word)):
+            head, tail = word[:i], word[i + 1:]
+            variants.add(head + tail)
+            if tail:
+                variants.add(head + tail[0] + word[i] + tail[1:])
+            for char in self._next_chars(head):
+                if char != word[i]:
+                    variants.add(head + char + tail)
+                variants.add(head + char + word[i:])
+        variants.discard(word)
+        return [v for v in variants if len(v) >= FUZZY_MIN_LENGTH - 1 and self._has_prefix(v)]
+
+    def _word_prefixes(self, word):
+        """Префиксы для слова запроса: оно само или его варианты с одной опечаткой"""
+        if self._has_prefix(word) or len(word) < FUZZY_MIN_LENGTH:
+            return [word], False
+        return self.fuzzy_prefixes(word), True
+
+    @staticmethod
+    def _matches(tokens, prefixes):
+        """Начинается ли какое-то слово названия с prefixes (строка или кортеж)"""
+        for token in tokens:
+            if token.startswith(prefixes):
+                return True
+        return False
+
+    def suggest(self, query, limit=8, categories_limit=3):
+        """Подсказки: категории, все слова которых начинаются с введенных, и товары.
+
+        Одно слово: списки товаров уже упорядочены так же, как выдача,
+        поэтому из каждого подходящего слова индекса достаточно первых
+        limit. Несколько слов: кандидаты берутся по самому узкому слову
+        и проверяются на остальные по словам названия.
+        """
+        words = tokenize(query)
+        if sum(len(w) for w in words) < self.min_chars:
+            return []
+        self.ensure_fresh()
+
+        with self._lock:
+            fuzzy = False
+            matched = []
+            for word in words:
+                prefixes, word_fuzzy = self._word_prefixes(word)
+                ranges = [r for r in map(self._range, prefixes) if r[1] > r[0]]
+                if not ranges:
+                    matched = []
+                    break
+                fuzzy = fuzzy or word_fuzzy
+                matched.append((self._estimate(ranges), prefixes, ranges))
+
+            products = self.products
+            candidates = set()
+            if len(matched) == 1:
+                candidates = self._top_ids(matched[0][2], limit)
+            elif matched:
+                narrowest = min(matched, key=lambda m: m[0])
+                others = [tuple(m[1]) for m in matched if m is not narrowest]
+                for product_id in self._range_ids(narrowest[2]):
+                    tokens = products[product_id][3]
+                    if all(self._matches(tokens, prefixes) for prefixes in others):
+                        candidates.add(product_id)
+
+            phrase = ' '.join(words)
+            lead = tuple(matched[0][1]) if matched else ()
+
+            def rank(product_id):
+                name, normalized, _, tokens = products[product_id]
+                return (not normalized.startswith(phrase), not tokens[0].startswith(lead),
+                        len(name), normalized)
+
+            best = heapq.nsmallest(limit, candidates, key=rank)
+            suggestions = [
+                {'type': 'category', 'name': category}
+                for category in sorted(self.categories)
+                if all(self._matches(tokenize(category), w) for w in words)
+            ][:categories_limit]
+            suggestions.extend(
+                {'type': 'product', 'id': product_id, 'name': products[product_id][0],
+                 'category': products[product_id][2]}
+                for product_id in best
+            )
+
+        metrics.registry.inc('shop_autocomplete_queries_total', fuzzy='1' if fuzzy else '0')
+        return suggestions
+
+
+autocomplete = AutocompleteIndex()
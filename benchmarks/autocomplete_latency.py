@@ -0,0 +1,71 @@
+"""Бенчмарк подсказок поиска: время ответа индекса autocomplete.
+
+Засеивает базу (или берет готовую), строит индекс и прогоняет запросы
+разной длины, в другом регистре, с ё и с опечатками, печатая медиану и
+95-й перцентиль времени одного запроса и первую подсказку.
+
+Примеры:
+    python benchmarks/autocomplete_latency.py --products 100000
+    python benchmarks/autocomplete_latency.py --database sqlite:////tmp/shop_bench.db --skip-seed
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import DEFAULT_DATABASE, seed
+
+QUERIES = [
+    ('короткий префикс', 'см'),
+    ('слово целиком', 'наушники'),
+    ('другой регистр', 'НОУТБ'),
+    ('два слова', 'смартфон 12'),
+    ('категория', 'быт'),
+    ('опечатка: замена', 'смартвон'),
+    ('опечатка: пропуск', 'ноутбк'),
+    ('опечатка: перестановка', 'холодлиьник'),
+    ('ничего не найдено', 'зюзюка'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк подсказок поиска')
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже засеянную базу')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seed(products=args.products, orders=0, carts=0)
+        print(f'Засеяно {args.products:,} товаров за {time.perf_counter() - started:.1f} с')
+
+    from app import app
+    from autocomplete import autocomplete
+
+    with app.app_context():
+        elapsed = autocomplete.load()
+        print(f'Индекс: {len(autocomplete.products):,} товаров, {len(autocomplete.keys):,} слов, '
+              f'сборка {elapsed:.2f} с\n')
+
+        for name, query in QUERIES:
+            durations = []
+            suggestions = []
+            for _ in range(args.iterations):
+                started = time.perf_counter()
+                suggestions = autocomplete.suggest(query)
+                durations.append((time.perf_counter() - started) * 1000)
+            durations.sort()
+            p95 = durations[int(len(durations) * 0.95) - 1]
+            first = suggestions[0]['name'] if suggestions else '-'
+            print(f'{name:<24} {query!r:<16} медиана {statistics.median(durations):6.3f} мс   '
+                  f'p95 {p95:6.3f} мс   {len(suggestions)} шт., первая: {first}')
+
+
+if __name__ == '__main__':
+    main()
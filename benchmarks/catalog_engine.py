@@ -0,0 +1,104 @@
+"""Бенчмарк движков каталога: SQL против колоночной модели в памяти.
+
+Засеивает базу (или берет готовую), строит снимок catalog_model и
+гоняет одинаковые комбинации фильтров и сортировок через оба пути,
+сравнивая время и совпадение выдачи. Время загрузки снимка и его
+размер тоже печатаются.
+
+Примеры:
+    python benchmarks/catalog_engine.py --products 100000
+    python benchmarks/catalog_engine.py --database sqlite:////tmp/shop_bench.db --skip-seed
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import DEFAULT_DATABASE, seed
+
+SCENARIOS = [
+    ('все, новые', {}),
+    ('категория, новые', {'category': 'Электроника'}),
+    ('категория, цена ↑', {'category': 'Книги', 'sort': 'price_asc'}),
+    ('диапазон цен, цена ↓', {'min_price': 1000.0, 'max_price': 50000.0, 'sort': 'price_desc'}),
+    ('все, по названию', {'sort': 'name'}),
+    ('категория, 10-я страница', {'category': 'Спорт', 'page': 10}),
+]
+
+
+def timed(func, iterations):
+    durations = []
+    result = None
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк движков каталога')
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже засеянную базу')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+    os.environ['CATALOG_ENGINE'] = 'memory'
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seed(products=args.products, orders=0, carts=0)
+        print(f'Засеяно {args.products:,} товаров за {time.perf_counter() - started:.1f} с')
+
+    from app import app, db, Product, catalog_page_sql, catalog_category_counts, get_catalog_version
+    from catalog_model import catalog_model
+
+    per_page = app.config.get('CATALOG_PAGE_SIZE', 24)
+
+    with app.app_context():
+        conn = db.session.connection()
+        started = time.perf_counter()
+        snapshot = catalog_model.load(conn, get_catalog_version()[0])
+        if snapshot is None:
+            print(f'❌ Модель не построена: {catalog_model.disabled_reason}')
+            return
+        print(f'Снимок: {len(snapshot.ids):,} товаров, {snapshot.nbytes / 1024 / 1024:.1f} МБ, '
+              f'загрузка {time.perf_counter() - started:.2f} с\n')
+
+        sql_counts, _ = timed(catalog_category_counts, args.iterations)
+        memory_counts, _ = timed(snapshot.counts, args.iterations)
+        print(f'{"счетчики категорий":<28} SQL {sql_counts:8.2f} мс   память {memory_counts:8.2f} мс')
+
+        for name, params in SCENARIOS:
+            page = params.get('page', 1)
+            sort = params.get('sort', 'newest')
+
+            def run_sql():
+                products, found = catalog_page_sql(params.get('category'), None, params.get('min_price'),
+                                                   params.get('max_price'), sort, page, per_page)
+                return [p.id for p in products], found
+
+            def run_memory():
+                ids, found = snapshot.query(params.get('category'), params.get('min_price'),
+                                            params.get('max_price'), sort,
+                                            offset=(page - 1) * per_page, limit=per_page)
+                by_id = {p.id: p for p in Product.query.filter(Product.id.in_(ids)).all()} if ids else {}
+                return [i for i in ids if i in by_id], found
+
+            sql_ms, (sql_ids, sql_found) = timed(run_sql, args.iterations)
+            memory_ms, (memory_ids, memory_found) = timed(run_memory, args.iterations)
+            db.session.expunge_all()
+
+            # При равных ключах порядок у SQL не определен, поэтому сравниваем число найденных
+            match = '✅' if sql_found == memory_found else '❌'
+            same_page = '' if sql_ids == memory_ids else ' (страница отличается порядком равных)'
+            print(f'{name:<28} SQL {sql_ms:8.2f} мс   память {memory_ms:8.2f} мс   '
+                  f'x{sql_ms / memory_ms if memory_ms else 0:5.1f}   найдено {memory_found:,} {match}{same_page}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Бенчмарк сборки индекса совместных покупок на синтетических строках заказов.
+
+Строки генерируются потоком (без базы): популярность товаров по Ципфу, часть
+товаров в заказе берется из "тематической" группы, чтобы были устойчивые пары.
+
+Примеры:
+    python benchmarks/copurchase_build.py --lines 5000000
+    python benchmarks/copurchase_build.py --lines 300000 --check   # сравнить с точным подсчетом
+"""
+import os
+import sys
+import time
+import random
+import bisect
+import argparse
+import resource
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from copurchase import CoPurchaseCounter
+
+
+def generate_lines(lines, products, random_seed=42, group_size=5):
+    """Генерирует (order_id, product_id) в порядке заказов"""
+    rnd = random.Random(random_seed)
+    weights = [1.0 / (i + 1) for i in range(products)]
+    cumulative = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cumulative.append(total)
+
+    def popular():
+        return bisect.bisect_left(cumulative, rnd.random() * total) + 1
+
+    emitted = 0
+    order_id = 0
+    while emitted < lines:
+        order_id += 1
+        anchor = popular()
+        group_start = (anchor - 1) // group_size * group_size + 1
+        size = min(rnd.randint(1, 6), lines - emitted)
+        basket = {anchor}
+        while len(basket) < size:
+            if rnd.random() < 0.6:
+                basket.add(group_start + rnd.randrange(group_size))
+            else:
+                basket.add(popular())
+        for product_id in basket:
+            yield order_id, product_id
+        emitted += len(basket)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк индекса совместных покупок')
+    parser.add_argument('--lines', type=int, default=2000000, help='строк заказов')
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--capacity', type=int, default=200, help='соседей на товар в памяти')
+    parser.add_argument('--top-k', type=int, default=20)
+    parser.add_argument('--min-count', type=int, default=2)
+    parser.add_argument('--check', action='store_true', help='сравнить top-K с точным подсчетом')
+    args = parser.parse_args()
+
+    counter = CoPurchaseCounter(capacity=args.capacity)
+    started = time.perf_counter()
+    counter.consume(generate_lines(args.lines, args.products))
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    top = counter.top(args.top_k, args.min_count)
+    top_time = time.perf_counter() - started
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Строк: {counter.lines}, заказов: {counter.orders}, товаров с парами: {len(counter.counts)}')
+    print(f'Сборка: {build_time:.1f} с ({counter.lines / build_time:,.0f} строк/с, генерация включена)')
+    print(f'Top-{args.top_k}: {top_time:.1f} с, списков: {len(top)}')
+    print(f'Пар в памяти: {counter.pairs}, отброшено при вытеснении: {counter.pruned}, пик RSS: {max_rss_mb:.0f} МБ')
+
+    if args.check:
+        exact = CoPurchaseCounter(capacity=float('inf'))
+        exact.consume(generate_lines(args.lines, args.products))
+        exact_top = exact.top(args.top_k, args.min_count)
+
+        hits = total = 0
+        for product_id, pairs in exact_top.items():
+            expected = {other_id for other_id, _ in pairs}
+            got = {other_id for other_id, _ in top.get(product_id, ())}
+            hits += len(expected & got)
+            total += len(expected)
+        recall = hits / total if total else 1.0
+        print(f'Полнота top-{args.top_k} относительно точного подсчета: {recall:.3f} '
+              f'(точных пар: {exact.pairs})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Симуляция распродажи: много покупателей одновременно берут несколько дефицитных товаров.
+
+Каждый покупатель кладет в корзину 1-2 единицы горячего товара через
+/api/cart, "заполняет форму" (случайная пауза) и оформляет заказ. Прогон
+делается с резервированием и без него; в конце проверяются инварианты:
+продано не больше, чем было на складе, остаток не ушел в минус,
+product.reserved совпадает с суммой активных удержаний.
+
+Примеры:
+    python benchmarks/flash_sale.py
+    python benchmarks/flash_sale.py --buyers 500 --concurrency 16 --stock 30
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import seed, DEFAULT_DATABASE
+from storefront import TestClientSession, login
+
+
+def run(app, db, buyers, concurrency, hot_ids, think_ms, random_seed):
+    """Гоняет покупателей и возвращает счетчики исходов"""
+    sessions = []
+    for i in range(buyers):
+        session = TestClientSession(app)
+        login(session, f'bench{i + 2}')
+        sessions.append(session)
+
+    def buyer(index):
+        rnd = random.Random(random_seed + index)
+        session = sessions[index]
+        product_id = rnd.choice(hot_ids)
+        wanted = rnd.randint(1, 2)
+
+        response = session.client.post('/api/cart', json={'items': [{'product_id': product_id, 'quantity': wanted}]})
+        if response.status_code >= 500:
+            return 'error'
+        cart = response.get_json()['cart']
+        got = sum(item['quantity'] for item in cart['items'] if item['product_id'] == product_id)
+        if got == 0:
+            return 'rejected_at_cart'
+
+        time.sleep(rnd.uniform(0, think_ms) / 1000)
+
+        response = session.client.post('/checkout', data={'shipping_address': 'г. Москва, ул. Распродажная, 1',
+                                                          'payment_method': 'card'})
+        if response.status_code >= 500:
+            return 'error'
+        location = response.headers.get('Location', '')
+        if '/order/confirmation/' in location:
+            return 'ordered'
+        return 'failed_at_checkout'
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(buyer, range(buyers)))
+    wall = time.perf_counter() - started
+
+    counts = {name: outcomes.count(name) for name in
+              ('ordered', 'rejected_at_cart', 'failed_at_checkout', 'error')}
+    counts['seconds'] = round(wall, 2)
+    return counts
+
+
+def check_invariants(db, Product, StockHold, OrderItem, hot_ids, initial_stock):
+    problems = []
+    for product_id in hot_ids:
+        product = db.session.get(Product, product_id)
+        sold = db.session.query(db.func.coalesce(db.func.sum(OrderItem.quantity), 0)) \
+            .filter(OrderItem.product_id == product_id).scalar()
+        held = db.session.query(db.func.coalesce(db.func.sum(StockHold.quantity), 0)) \
+            .filter(StockHold.product_id == product_id).scalar()
+        if sold > initial_stock:
+            problems.append(f'товар #{product_id}: продано {sold} при остатке {initial_stock}')
+        if product.stock < 0:
+            problems.append(f'товар #{product_id}: остаток {product.stock}')
+        if product.stock + sold != initial_stock:
+            problems.append(f'товар #{product_id}: остаток {product.stock} + продано {sold} != {initial_stock}')
+        if product.reserved != held:
+            problems.append(f'товар #{product_id}: reserved {product.reserved}, удержано {held}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Симуляция распродажи с резервированием')
+    parser.add_argument('--buyers', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--hot-products', type=int, default=3)
+    parser.add_argument('--stock', type=int, default=20, help='остаток каждого горячего товара')
+    parser.add_argument('--think-ms', type=float, default=30, help='пауза между корзиной и оформлением')
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+    os.environ['RESPONSE_CACHE_TYPE'] = 'none'
+
+    failed = False
+    for enabled in (False, True):
+        seed(products=200, users=args.buyers + 2, orders=0, carts=0)
+
+        from app import app, db, Product, StockHold, OrderItem
+        from reservations import reservations
+
+        reservations.enabled = enabled
+        with app.app_context():
+            hot_ids = [p.id for p in Product.query.order_by(Product.id).limit(args.hot_products)]
+            Product.query.filter(Product.id.in_(hot_ids)).update({'stock': args.stock, 'reserved': 0})
+            db.session.commit()
+
+        counts = run(app, db, args.buyers, args.concurrency, hot_ids, args.think_ms, random_seed=7)
+
+        with app.app_context():
+            problems = check_invariants(db, Product, StockHold, OrderItem, hot_ids, args.stock)
+
+        title = 'С резервированием' if enabled else 'Без резервирования'
+        print(f'\n{title}: {args.buyers} покупателей, {args.hot_products} товара по {args.stock} шт.')
+        print(f'   оформили заказ:        {counts["ordered"]}')
+        print(f'   отказ при добавлении:  {counts["rejected_at_cart"]}')
+        print(f'   отказ при оформлении:  {counts["failed_at_checkout"]}')
+        print(f'   ошибки 5xx:            {counts["error"]}')
+        print(f'   время:                 {counts["seconds"]} с')
+        if problems:
+            failed = True
+            print('   ❌ Нарушены инварианты:')
+            for line in problems:
+                print(f'      {line}')
+        else:
+            print('   ✅ Перепродаж нет, резервы сходятся')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Проверка маршрутизации чтения на реплику на двух локальных базах SQLite.
+
+Основная база заполняется seed и копируется в реплику, после чего в
+реплике к названиям товаров дописывается метка. По метке на странице
+видно, откуда читал запрос: витрина - с реплики, страницы вне
+REPLICA_ENDPOINTS - из основной базы, после записи (вход, корзина)
+посетитель REPLICA_STICKY_SECONDS читает из основной базы, потом снова
+с реплики.
+
+Примеры:
+    python benchmarks/replica_routing.py
+    python benchmarks/replica_routing.py --sticky 2
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PRIMARY_FILE = '/tmp/shop_primary.db'
+REPLICA_FILE = '/tmp/shop_replica.db'
+REPLICA_MARK = '[реплика]'
+
+
+def prepare(products, sticky):
+    for path in (PRIMARY_FILE, REPLICA_FILE):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    os.environ['DATABASE_URL'] = f'sqlite:///{PRIMARY_FILE}'
+    os.environ['DATABASE_REPLICA_URLS'] = f'sqlite:///{REPLICA_FILE}'
+    os.environ['REPLICA_STICKY_SECONDS'] = str(sticky)
+    os.environ['RESPONSE_CACHE_TYPE'] = 'none'
+
+    from seed import seed
+    seed(products=products, users=5, orders=0, carts=0)
+
+    # Реплика - копия основной базы, отличимая по названиям товаров
+    source = sqlite3.connect(PRIMARY_FILE)
+    replica = sqlite3.connect(REPLICA_FILE)
+    source.backup(replica)
+    replica.execute('UPDATE product SET name = name || ?', (' ' + REPLICA_MARK,))
+    replica.commit()
+    replica.close()
+    source.close()
+
+
+def reads_replica(session, path):
+    response = session.client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'{path}: HTTP {response.status_code}')
+    return REPLICA_MARK in response.get_data(as_text=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка чтения с реплики и чтения своих записей')
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--sticky', type=float, default=1.0, help='REPLICA_STICKY_SECONDS для проверки')
+    args = parser.parse_args()
+
+    prepare(args.products, args.sticky)
+
+    from app import app
+    from storefront import TestClientSession, login
+
+    checks = []
+
+    guest = TestClientSession(app)
+    checks.append(('гость: товар читается с реплики', reads_replica(guest, '/product/1')))
+    checks.append(('гость: каталог читается с реплики', reads_replica(guest, '/catalog')))
+
+    buyer = TestClientSession(app)
+    login(buyer, 'bench2')
+    checks.append(('после входа: чтение из основной базы', not reads_replica(buyer, '/product/1')))
+    time.sleep(args.sticky + 0.2)
+    checks.append(('после окна: снова реплика', reads_replica(buyer, '/product/1')))
+
+    buyer.client.post('/add_to_cart/1', data={'quantity': 1})
+    checks.append(('после добавления в корзину: основная база', not reads_replica(buyer, '/product/1')))
+    checks.append(('корзина всегда из основной базы', not reads_replica(buyer, '/cart')))
+    time.sleep(args.sticky + 0.2)
+    checks.append(('корзина и после окна из основной базы', not reads_replica(buyer, '/cart')))
+    checks.append(('товар после окна: снова реплика', reads_replica(buyer, '/product/1')))
+
+    for title, ok in checks:
+        print(f'{"✅" if ok else "❌"} {title}')
+
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
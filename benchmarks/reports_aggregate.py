@@ -0,0 +1,103 @@
+"""Бенчмарк агрегации отчетов о продажах на синтетических строках заказов.
+
+Сравнивает векторную агрегацию reports.aggregate() с наивным циклом
+по строкам в Python; опционально меряет и чтение строк из засеянной базы.
+
+Примеры:
+    python benchmarks/reports_aggregate.py --lines 10000000
+    python benchmarks/reports_aggregate.py --lines 1000000 --python-lines 1000000
+    python benchmarks/reports_aggregate.py --database sqlite:////tmp/shop_bench.db
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import date, timedelta
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reports import OrderLines, aggregate
+
+CATEGORIES = ['Электроника', 'Одежда', 'Книги', 'Бытовая техника', 'Спорт', 'Игрушки', 'Красота', 'Дом и сад']
+PAYMENT_METHODS = ['card', 'cash', 'online']
+
+
+def synthetic_lines(lines, products, days, random_seed=42):
+    rng = np.random.default_rng(random_seed)
+    start = np.datetime64(date.today() - timedelta(days=days - 1), 'D')
+    quantities = rng.integers(1, 4, size=lines)
+    order_ids = np.sort(rng.integers(1, max(lines // 3, 1) + 1, size=lines))
+    return OrderLines(
+        order_ids=order_ids,
+        days=start + rng.integers(0, days, size=lines).astype('timedelta64[D]'),
+        product_ids=rng.zipf(1.3, size=lines) % products + 1,
+        amounts=rng.uniform(100, 200000, size=lines) * quantities,
+        quantities=quantities,
+        category_codes=rng.integers(0, len(CATEGORIES), size=lines).astype(np.int32),
+        categories=CATEGORIES,
+        payment_codes=rng.integers(0, len(PAYMENT_METHODS), size=lines).astype(np.int32),
+        payment_methods=PAYMENT_METHODS,
+    ), start
+
+
+def python_aggregate(lines, start, limit):
+    """То же самое циклом по строкам - так выглядел бы отчет поверх ORM-объектов"""
+    by_day, by_category, by_payment, by_product, orders = {}, {}, {}, {}, set()
+    rows = zip(lines.order_ids[:limit].tolist(), lines.days[:limit].tolist(), lines.product_ids[:limit].tolist(),
+               lines.amounts[:limit].tolist(), lines.category_codes[:limit].tolist(),
+               lines.payment_codes[:limit].tolist())
+    for order_id, day, product_id, amount, category, payment in rows:
+        orders.add(order_id)
+        by_day[day] = by_day.get(day, 0.0) + amount
+        by_category[category] = by_category.get(category, 0.0) + amount
+        by_payment[payment] = by_payment.get(payment, 0.0) + amount
+        by_product[product_id] = by_product.get(product_id, 0.0) + amount
+    return sorted(by_product.items(), key=lambda item: -item[1])[:10]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк отчетов о продажах')
+    parser.add_argument('--lines', type=int, default=10000000)
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--python-lines', type=int, default=1000000,
+                        help='сколько строк прогнать через наивный цикл (0 - пропустить)')
+    parser.add_argument('--database', help='засеянная база (benchmarks/seed.py) для замера чтения строк')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    lines, start = synthetic_lines(args.lines, args.products, args.days)
+    print(f'Генерация {args.lines:,} строк: {time.perf_counter() - started:.1f} с')
+
+    started = time.perf_counter()
+    report = aggregate(lines, start, args.days)
+    vector_time = time.perf_counter() - started
+    print(f'NumPy: {vector_time:.2f} с ({args.lines / vector_time:,.0f} строк/с), '
+          f'заказов {report["orders_count"]:,}, выручка {report["total_revenue"]:,.0f}')
+
+    if args.python_lines:
+        limit = min(args.python_lines, args.lines)
+        started = time.perf_counter()
+        python_aggregate(lines, start, limit)
+        python_time = time.perf_counter() - started
+        rate = limit / python_time
+        print(f'Python-цикл: {python_time:.2f} с на {limit:,} строк ({rate:,.0f} строк/с), '
+              f'ускорение NumPy x{(args.lines / vector_time) / rate:.0f}')
+
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+        from app import app, db
+        from reports import sales_reports
+        with app.app_context():
+            conn = db.session.connection()
+            started = time.perf_counter()
+            db_lines = sales_reports.load_lines(conn, date(2000, 1, 1), date(2100, 1, 1))
+            load_time = time.perf_counter() - started
+            print(f'Чтение из БД: {len(db_lines):,} строк за {load_time:.2f} с '
+                  f'({len(db_lines) / load_time if load_time else 0:,.0f} строк/с)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""Заполнение базы синтетическими данными для бенчмарков.
+
+Пример:
+    python benchmarks/seed.py --products 100000 --database sqlite:////tmp/bench.db
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CATEGORIES = ['Электроника', 'Одежда', 'Книги', 'Бытовая техника', 'Спорт', 'Игрушки', 'Красота', 'Дом и сад']
+WORDS = ['Смартфон', 'Ноутбук', 'Футболка', 'Книга', 'Холодильник', 'Мяч', 'Конструктор', 'Крем',
+         'Лампа', 'Наушники', 'Куртка', 'Роман', 'Пылесос', 'Гантели', 'Кукла', 'Шампунь']
+STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+PAYMENT_METHODS = ['card', 'cash', 'online']
+
+BENCH_PASSWORD = 'bench123'
+BATCH_SIZE = 10000
+DEFAULT_DATABASE = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'shop_bench.db')
+
+
+def _insert_batches(db, table, rows_iter):
+    """Вставляет строки пачками по BATCH_SIZE одним executemany на пачку"""
+    batch = []
+    total = 0
+    for row in rows_iter:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        total += len(batch)
+    db.session.commit()
+    return total
+
+
+def seed(products=1000, users=None, orders=None, carts=None, random_seed=42):
+    """Пересоздает схему и заполняет ее синтетическим каталогом"""
+    from app import app, db, User, Product, CartItem, Order, OrderItem
+    from werkzeug.security import generate_password_hash
+
+    users = users if users is not None else max(50, products // 10)
+    orders = orders if orders is not None else max(100, products // 2)
+    carts = carts if carts is not None else max(20, users // 4)
+
+    rnd = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    # Один быстрый хеш на всех: scrypt на миллион пользователей считался бы часами
+    password_hash = generate_password_hash(BENCH_PASSWORD, method='pbkdf2:sha256:1000')
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        counts = {}
+
+        counts['users'] = _insert_batches(db, User.__table__, (
+            {
+                'id': i,
+                'username': 'admin' if i == 1 else f'bench{i}',
+                'email': f'bench{i}@example.com',
+                'password_hash': password_hash,
+                'address': f'г. Москва, ул. Тестовая, д. {i}',
+                'is_admin': i == 1,
+                'created_at': now - timedelta(minutes=i)
+            }
+            for i in range(1, users + 1)
+        ))
+
+        counts['products'] = _insert_batches(db, Product.__table__, (
+            {
+                'id': i,
+                'name': f'{rnd.choice(WORDS)} {i}',
+                'description': f'Описание товара {i}',
+                'price': round(rnd.uniform(100, 200000), 2),
+                'category': rnd.choice(CATEGORIES),
+                'stock': rnd.randint(0, 500),
+                'created_at': now - timedelta(seconds=i)
+            }
+            for i in range(1, products + 1)
+        ))
+
+        # Пары (пользователь, товар) уникальны - на cart_item уникальный индекс
+        cart_pairs = set()
+        while len(cart_pairs) < min(carts, users * products):
+            cart_pairs.add((rnd.randint(1, users), rnd.randint(1, products)))
+        counts['cart_items'] = _insert_batches(db, CartItem.__table__, (
+            {
+                'user_id': user_id,
+                'product_id': product_id,
+                'quantity': rnd.randint(1, 3),
+                'added_at': now - timedelta(hours=rnd.randint(0, 24 * 60))
+            }
+            for user_id, product_id in sorted(cart_pairs)
+        ))
+
+        counts['orders'] = _insert_batches(db, Order.__table__, (
+            {
+                'id': i,
+                'user_id': rnd.randint(1, users),
+                'order_number': f'BENCH-{i:08d}',
+                'status': rnd.choice(STATUSES),
+                'total_amount': 0,
+                'shipping_address': 'г. Москва',
+                'billing_address': 'г. Москва',
+                'payment_method': rnd.choice(PAYMENT_METHODS),
+                'payment_status': 'paid',
+                'created_at': now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+                'updated_at': now
+            }
+            for i in range(1, orders + 1)
+        ))
+
+        def order_items():
+            for order_id in range(1, orders + 1):
+                for _ in range(rnd.randint(1, 4)):
+                    product_id = rnd.randint(1, products)
+                    yield {
+                        'order_id': order_id,
+                        'product_id': product_id,
+                        'product_name': f'Товар {product_id}',
+                        'product_price': round(rnd.uniform(100, 200000), 2),
+                        'quantity': rnd.randint(1, 3)
+                    }
+
+        counts['order_items'] = _insert_batches(db, OrderItem.__table__, order_items())
+
+        # Начальные остатки в журнал движения, чтобы сверка сходилась
+        db.session.execute(db.text(
+            "INSERT INTO inventory_movement (product_id, delta, reason, created_at) "
+            "SELECT id, stock, 'initial', created_at FROM product WHERE stock <> 0"
+        ))
+
+        # Суммы заказов одним UPDATE вместо пересчета в Python
+        db.session.execute(db.text(
+            'UPDATE "order" SET total_amount = '
+            '(SELECT COALESCE(SUM(product_price * quantity), 0) FROM order_item WHERE order_item.order_id = "order".id)'
+        ))
+        db.session.commit()
+
+        # Совместные покупки и похожие товары считаются по уже заполненной истории заказов
+        from copurchase import copurchase_index
+        from related_products import related_engine
+        with db.engine.begin() as conn:
+            copurchase_index.rebuild(conn)
+            related_engine.rebuild_all(conn)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заполнение базы синтетическими данными')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--orders', type=int)
+    parser.add_argument('--carts', type=int)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', default=DEFAULT_DATABASE,
+                        help='URI базы (будет пересоздана!), по умолчанию временный SQLite')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+
+    started = datetime.now()
+    counts = seed(args.products, args.users, args.orders, args.carts, args.seed)
+    elapsed = (datetime.now() - started).total_seconds()
+
+    for table, count in counts.items():
+        print(f'   {table}: {count}')
+    print(f'✅ Данные созданы за {elapsed:.1f} с')
+
+
+if __name__ == '__main__':
+    main()
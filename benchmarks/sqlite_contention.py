@@ -0,0 +1,185 @@
+"""Конкуренция за SQLite: несколько процессов-воркеров одновременно пишут в один файл базы.
+
+Каждый процесс - отдельное приложение со своим пулом соединений (как
+воркер gunicorn). Покупатели в процессах вперемешку смотрят товары,
+меняют корзину через /api/cart и оформляют заказы. Прогон делается без
+профиля SQLite (SQLITE_PROFILE=0: журнал по умолчанию, неявный BEGIN)
+и с профилем (WAL, busy_timeout, BEGIN IMMEDIATE у пишущих маршрутов).
+Печатаются пропускная способность, задержки, ошибки 5xx, неудачные
+оформления и число "database is locked" в логах приложения.
+
+Примеры:
+    python benchmarks/sqlite_contention.py
+    python benchmarks/sqlite_contention.py --processes 8 --threads 2 --duration 15
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_DATABASE_FILE = '/tmp/shop_contention.db'
+
+
+class LockCounter(logging.Handler):
+    """Считает сообщения лога о блокировке базы вместо их печати"""
+
+    def __init__(self):
+        super().__init__()
+        self.locked = 0
+        self.other = 0
+
+    def emit(self, record):
+        if 'locked' in record.getMessage() or 'busy' in record.getMessage():
+            self.locked += 1
+        else:
+            self.other += 1
+
+
+def _environment(database, profile):
+    os.environ['DATABASE_URL'] = database
+    os.environ['SQLITE_PROFILE'] = '1' if profile else '0'
+    os.environ['RESPONSE_CACHE_TYPE'] = 'none'
+
+
+def seed_database(database, profile, products, users):
+    _environment(database, profile)
+    from seed import seed
+    seed(products=products, users=users, orders=0, carts=0)
+    from app import app, db, Product
+    with app.app_context():
+        # Товара с запасом: меряем блокировки, а не нехватку
+        Product.query.update({'stock': 1000000, 'reserved': 0})
+        db.session.commit()
+
+
+def run_worker(task):
+    database, profile, usernames, products, duration, start_at, worker_seed = task
+    _environment(database, profile)
+    from app import app
+    from storefront import TestClientSession, login
+
+    counter = LockCounter()
+    app.logger.handlers[:] = [counter]
+    app.logger.propagate = False
+
+    sessions = []
+    for username in usernames:
+        session = TestClientSession(app)
+        login(session, username)
+        sessions.append(session)
+
+    def shopper(index):
+        rnd = random.Random(worker_seed * 1000 + index)
+        session = sessions[index]
+        stats = {'ops': 0, 'ordered': 0, 'checkout_failed': 0, 'errors': 0, 'latencies': []}
+        while time.time() < start_at:
+            time.sleep(0.001)
+        deadline = start_at + duration
+        last_checkout = 0.0
+        while time.time() < deadline:
+            roll = rnd.random()
+            # Номер заказа уникален в пределах секунды для покупателя - чаще не оформляем
+            if roll >= 0.8 and time.time() - last_checkout < 1.1:
+                roll = rnd.random() * 0.8
+            started = time.perf_counter()
+            if roll < 0.4:
+                response = session.client.get(f'/product/{rnd.randint(1, products)}')
+            elif roll < 0.8:
+                items = [{'product_id': rnd.randint(1, products), 'quantity': rnd.randint(1, 2)}]
+                response = session.client.post('/api/cart', json={'items': items})
+            else:
+                session.client.post('/api/cart', json={'items': [{'product_id': rnd.randint(1, products), 'quantity': 1}]})
+                response = session.client.post('/checkout', data={'shipping_address': 'г. Москва, ул. Параллельная, 1',
+                                                                  'payment_method': 'card'})
+                last_checkout = time.time()
+                if '/order/confirmation/' in response.headers.get('Location', ''):
+                    stats['ordered'] += 1
+                else:
+                    stats['checkout_failed'] += 1
+            stats['latencies'].append(time.perf_counter() - started)
+            stats['ops'] += 1
+            if response.status_code >= 500:
+                stats['errors'] += 1
+        return stats
+
+    with ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+        results = list(pool.map(shopper, range(len(sessions))))
+
+    total = {'ops': 0, 'ordered': 0, 'checkout_failed': 0, 'errors': 0, 'latencies': []}
+    for stats in results:
+        for key in ('ops', 'ordered', 'checkout_failed', 'errors'):
+            total[key] += stats[key]
+        total['latencies'].extend(stats['latencies'])
+    total['locked_logs'] = counter.locked
+    return total
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run(args, profile):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(args.database_file + suffix):
+            os.remove(args.database_file + suffix)
+    database = f'sqlite:///{args.database_file}'
+    shoppers = args.processes * args.threads
+
+    # spawn: каждый процесс импортирует приложение заново, как отдельный воркер
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        pool.apply(seed_database, (database, profile, args.products, shoppers + 2))
+
+    start_at = time.time() + 3 + args.processes * 0.5
+    tasks = [
+        (database, profile, [f'bench{2 + p * args.threads + t}' for t in range(args.threads)],
+         args.products, args.duration, start_at, p)
+        for p in range(args.processes)
+    ]
+    with ctx.Pool(args.processes) as pool:
+        results = pool.map(run_worker, tasks)
+
+    latencies = [value for result in results for value in result['latencies']]
+    summary = {key: sum(result[key] for result in results)
+               for key in ('ops', 'ordered', 'checkout_failed', 'errors', 'locked_logs')}
+    summary['throughput'] = summary['ops'] / args.duration
+    summary['p50'] = percentile(latencies, 50) * 1000
+    summary['p99'] = percentile(latencies, 99) * 1000
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конкуренция процессов за SQLite с профилем и без')
+    parser.add_argument('--processes', type=int, default=4, help='процессы-воркеры')
+    parser.add_argument('--threads', type=int, default=2, help='покупателей в каждом процессе')
+    parser.add_argument('--duration', type=float, default=10, help='секунд на прогон')
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--database-file', default=DEFAULT_DATABASE_FILE)
+    args = parser.parse_args()
+
+    print(f'🏁 {args.processes} процессов x {args.threads} покупателя, {args.duration:g} с на прогон')
+    for profile in (False, True):
+        s = run(args, profile)
+        title = 'С профилем SQLite' if profile else 'Без профиля'
+        print(f'\n{title}:')
+        print(f'   операций:               {s["ops"]} ({s["throughput"]:.1f} в секунду)')
+        print(f'   задержка p50 / p99:     {s["p50"]:.1f} / {s["p99"]:.1f} мс')
+        print(f'   заказов оформлено:      {s["ordered"]}')
+        print(f'   оформлений не удалось:  {s["checkout_failed"]}')
+        print(f'   ошибки 5xx:             {s["errors"]}')
+        print(f'   "database is locked":   {s["locked_logs"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Бенчмарк запуска: время импорта приложения и до первого ответа.
+
+Каждый замер - отдельный свежий процесс Python: импорт app, create_app()
+(папки, проверка схемы БД) и первый запрос к главной странице через
+тестовый клиент. Печатаются медианы и модули, которые не должны
+загружаться при импорте (Pillow, numpy, диалект PostgreSQL на SQLite).
+С --gunicorn дополнительно меряется время от запуска gunicorn с
+gunicorn_config.py до первого ответа с preload_app и без.
+
+Примеры:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 11 --gunicorn --workers 4
+    python benchmarks/startup.py --save-baseline
+
+Код возврата 1 означает регрессию относительно baseline: медиана выросла
+больше чем на --tolerance и на --min-delta-ms, или при импорте снова
+загружается тяжелый модуль.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import seed, DEFAULT_DATABASE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+BASELINE_KEY = 'startup'
+HEAVY_MODULES = ['PIL.Image', 'numpy', 'sqlalchemy.dialects.postgresql']
+METRICS = ['import_ms', 'create_app_ms', 'first_request_ms', 'total_ms']
+
+CHILD = f'''
+import sys, time, json
+started = time.perf_counter()
+import app as shop
+imported = time.perf_counter()
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+modules = len(sys.modules)
+shop.create_app()
+created = time.perf_counter()
+response = shop.app.test_client().get('/')
+response.close()
+finished = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (finished - created) * 1000,
+    'total_ms': (finished - started) * 1000,
+    'status': response.status_code,
+    'modules': modules,
+    'heavy': heavy,
+}}))
+'''
+
+
+def measure_process(env):
+    result = subprocess.run([sys.executable, '-W', 'ignore', '-c', CHILD], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_gunicorn(env, workers, preload):
+    """Миллисекунды от запуска gunicorn до первого ответа 200"""
+    port = free_port()
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_PRELOAD='1' if preload else '0')
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py', '-b', f'127.0.0.1:{port}', 'wsgi:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = started + 60
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=5) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.02)
+        raise RuntimeError('gunicorn не ответил за 60 секунд')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare_with_baseline(results, tolerance, min_delta_ms):
+    """Возвращает список регрессий относительно baseline"""
+    if not os.path.exists(BASELINE_PATH):
+        print(f'⚠️  Baseline не найден ({BASELINE_PATH}), сравнение пропущено')
+        return []
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f).get(BASELINE_KEY)
+    if not baseline:
+        print(f'⚠️  В baseline нет записи для "{BASELINE_KEY}", сравнение пропущено')
+        return []
+
+    regressions = []
+    for name in METRICS:
+        base = baseline.get(name)
+        if base is None:
+            continue
+        # Запуск процесса шумит сильнее запросов: нужен рост и в процентах, и в миллисекундах
+        if results[name] > base * (1 + tolerance) and results[name] - base > min_delta_ms:
+            regressions.append(f'{name}: {results[name]} мс (baseline {base} мс)')
+    for name in results['heavy']:
+        if name not in baseline.get('heavy', []):
+            regressions.append(f'при импорте app загружается {name}')
+    return regressions
+
+
+def save_baseline(results):
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    baseline[BASELINE_KEY] = results
+    with open(BASELINE_PATH, 'w') as f:
+        json.dump(baseline, f, indent=2, ensure_ascii=False, sort_keys=True)
+        f.write('\n')
+    print(f'💾 Baseline "{BASELINE_KEY}" сохранен в {BASELINE_PATH}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк запуска приложения')
+    parser.add_argument('--runs', type=int, default=7, help='запусков процесса (берется медиана)')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--database', default=DEFAULT_DATABASE, help='URI базы (будет пересоздана!)')
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже заполненную базу')
+    parser.add_argument('--gunicorn', action='store_true', help='замерить запуск gunicorn с preload_app и без')
+    parser.add_argument('--workers', type=int, default=4, help='воркеры gunicorn')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='допустимый рост медианы (0.3 = +30%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=50.0, help='минимальный абсолютный рост медианы')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=args.database)
+    if not args.skip_seed:
+        print(f'🌱 Заполняем базу: {args.products} товаров...')
+        seed(products=args.products, orders=0, carts=0)
+
+    # Первый запуск прогревает файловый кеш ОС и .pyc, в медиану не идет
+    measure_process(env)
+    runs = [measure_process(env) for _ in range(args.runs)]
+    if any(run['status'] != 200 for run in runs):
+        print(f'❌ Первый запрос вернул {[run["status"] for run in runs]}')
+        return 1
+
+    results = {name: round(statistics.median(run[name] for run in runs), 1) for name in METRICS}
+    results['modules'] = runs[-1]['modules']
+    results['heavy'] = sorted({name for run in runs for name in run['heavy']})
+    for name in METRICS:
+        values = sorted(run[name] for run in runs)
+        print(f'{name:18s} медиана {results[name]:8.1f} мс   мин {values[0]:8.1f}   макс {values[-1]:8.1f}')
+    print(f'{"модулей после импорта":18s} {results["modules"]}')
+    print(f'{"тяжелые при импорте":18s} {", ".join(results["heavy"]) or "нет"}')
+
+    if args.gunicorn:
+        for preload in (False, True):
+            elapsed = statistics.median(measure_gunicorn(env, args.workers, preload) for _ in range(3))
+            print(f'gunicorn -w {args.workers} preload_app={preload!s:5s} до первого ответа {elapsed:8.1f} мс')
+
+    if args.save_baseline:
+        save_baseline(results)
+        return 0
+
+    regressions = compare_with_baseline(results, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print('\n❌ Регрессии времени запуска:')
+        for line in regressions:
+            print(f'   {line}')
+        return 1
+    print('\n✅ Регрессий не обнаружено')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+"""Бенчмарк горячих путей витрины и оформления заказа.
+
+Гоняет index, catalog (поиск, фильтры, сортировки), product_detail, add_to_cart
+(гостем и пользователем), пакетное API корзины и checkout через тестовый клиент Flask или через настоящий процесс gunicorn,
+печатает пропускную способность, перцентили задержки и типичное (самое
+частое) число SQL-запросов (из заголовка Server-Timing) и сравнивает
+результат с сохраненным baseline.
+
+Публичные страницы по умолчанию запрашиваются с уникальным параметром
+_nocache, чтобы каждый запрос проходил мимо кеша страниц и число SQL-запросов
+отражало настоящий путь рендеринга. Попадания в кеш меряются отдельными
+сценариями *_cached.
+
+Baseline хранится в двух файлах: baseline.json (в git) - только
+детерминированное число SQL-запросов по сценариям; baseline.local.json (в
+.gitignore) - p95 этой машины, с ним сравниваются задержки.
+
+Примеры:
+    python benchmarks/storefront.py --products 1000
+    python benchmarks/storefront.py --products 100000 --mode gunicorn --workers 4 --concurrency 8
+    python benchmarks/storefront.py --products 1000 --save-baseline
+
+Код возврата 1 означает регрессию относительно baseline.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import itertools
+import subprocess
+import urllib.parse
+import urllib.request
+import urllib.error
+import http.cookiejar
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import seed, BENCH_PASSWORD, DEFAULT_DATABASE, CATEGORIES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+LOCAL_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.local.json')
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class _Response:
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    @property
+    def queries(self):
+        match = QUERIES_RE.search(self.headers.get('Server-Timing', ''))
+        return int(match.group(1)) if match else None
+
+
+class TestClientSession:
+    """Сессия пользователя поверх app.test_client()"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None, json_body=None):
+        response = self.client.open(path, method=method, data=data, json=json_body, headers=headers or {})
+        return _Response(response.status_code, response.headers)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    """Сессия пользователя поверх HTTP (для запущенного gunicorn)"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect()
+        )
+
+    def request(self, method, path, data=None, headers=None, json_body=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                response.read()
+                return _Response(response.status, response.headers)
+        except urllib.error.HTTPError as e:
+            return _Response(e.code, e.headers)
+
+
+def build_scenarios(products):
+    """Сценарии: имя -> функция (session, rnd) -> список ответов"""
+    xhr = {'X-Requested-With': 'XMLHttpRequest'}
+    bust = itertools.count()
+
+    def get(path, cached=False):
+        def request(session, rnd):
+            url = path(rnd) if callable(path) else path
+            if not cached:
+                # Уникальный параметр - промах кеша страниц, рендеринг и запросы к БД каждый раз
+                url += ('&' if '?' in url else '?') + f'_nocache={next(bust)}'
+            return [session.request('GET', url)]
+        return request
+
+    def add_to_cart(session, rnd):
+        return [session.request('POST', f'/add_to_cart/{rnd.randint(1, products)}', headers=xhr)]
+
+    def cart_batch(session, rnd):
+        items = [{'product_id': rnd.randint(1, products), 'quantity': rnd.randint(0, 3)} for _ in range(5)]
+        return [session.request('POST', '/api/cart', json_body={'items': items})]
+
+    def checkout(session, rnd):
+        session.request('POST', f'/add_to_cart/{rnd.randint(1, products)}', headers=xhr)
+        return [session.request('POST', '/checkout', data={
+            'shipping_address': 'г. Москва, ул. Бенчмарковая, 1',
+            'payment_method': 'card'
+        })]
+
+    return {
+        'index': get('/'),
+        'catalog': get('/catalog'),
+        'catalog_search': get('/catalog?search=' + urllib.parse.quote('Смартфон')),
+        'catalog_filter': get(lambda rnd: '/catalog?' + urllib.parse.urlencode({
+            'category': rnd.choice(CATEGORIES), 'min_price': 1000, 'max_price': 50000, 'sort': 'price_asc'
+        })),
+        'catalog_sort_name': get('/catalog?sort=name'),
+        'product_detail': get(lambda rnd: f'/product/{rnd.randint(1, products)}'),
+        'index_cached': get('/', cached=True),
+        'catalog_cached': get('/catalog', cached=True),
+        'catalog_search_cached': get('/catalog?search=' + urllib.parse.quote('Смартфон'), cached=True),
+        'guest_add_to_cart': add_to_cart,
+        'add_to_cart': add_to_cart,
+        'cart_batch': cart_batch,
+        'checkout': checkout,
+    }
+
+
+AUTH_SCENARIOS = {'add_to_cart', 'cart_batch', 'checkout'}
+
+
+def run_scenario(name, fn, sessions, iterations, concurrency, rnd_seed):
+    """Выполняет сценарий и собирает задержки и число запросов к БД"""
+    latencies = []
+    queries = []
+    errors = 0
+
+    def worker(worker_id):
+        rnd = random.Random(rnd_seed + worker_id)
+        local = []
+        for i in range(worker_id, iterations, concurrency):
+            # У checkout каждый заказ оформляет свой пользователь: номер заказа
+            # уникален только в пределах пользователя и секунды
+            session = sessions[i % len(sessions)]
+            started = time.perf_counter()
+            responses = fn(session, rnd)
+            local.append((time.perf_counter() - started, responses[-1]))
+        return local
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [r for chunk in pool.map(worker, range(concurrency)) for r in chunk]
+    wall = time.perf_counter() - started
+
+    for elapsed, response in results:
+        latencies.append(elapsed * 1000)
+        if response.status >= 500:
+            errors += 1
+        if response.queries is not None:
+            queries.append(response.queries)
+
+    return {
+        'requests': len(results),
+        'rps': round(len(results) / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        # Самое частое значение, а не максимум: одиночный выброс - не путь рендеринга
+        'queries': Counter(queries).most_common(1)[0][0] if queries else None,
+        'errors': errors
+    }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(database, workers):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=database)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'wsgi:app', '-b', f'127.0.0.1:{port}', '-w', str(workers),
+         '--log-level', 'warning'],
+        cwd=ROOT, env=env
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/about', timeout=1).read()
+            return process, base_url
+        except Exception:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn не запустился за 30 секунд')
+
+
+def login(session, username):
+    response = session.request('POST', '/login', data={'username': username, 'password': BENCH_PASSWORD})
+    if response.status != 302:
+        raise RuntimeError(f'Не удалось войти под {username}: HTTP {response.status}')
+
+
+def _load(path, key):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(key)
+
+
+def compare_with_baseline(key, results, tolerance, min_delta_ms):
+    """Возвращает список регрессий относительно baseline"""
+    baseline = _load(BASELINE_PATH, key)
+    if not baseline:
+        print(f'⚠️  В {BASELINE_PATH} нет записи для "{key}", сравнение SQL-запросов пропущено')
+        baseline = {}
+    timings = _load(LOCAL_BASELINE_PATH, key)
+    if not timings:
+        print(f'⚠️  Локальных задержек для "{key}" нет ({LOCAL_BASELINE_PATH}), сравнение p95 пропущено')
+        timings = {}
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        # Фоновые чтения по таймеру в main() отключены, типичное число запросов
+        # детерминировано: любой рост - это N+1
+        if base.get('queries') is not None and result['queries'] is not None and result['queries'] > base['queries']:
+            regressions.append(f'{name}: SQL-запросов {result["queries"]} (baseline {base["queries"]})')
+        # Для быстрых маршрутов шум измерений сравним с самим p95, поэтому
+        # требуем превышения и в относительных, и в абсолютных единицах
+        base_p95 = timings.get(name, {}).get('p95_ms')
+        if (base_p95 is not None and result['p95_ms'] > base_p95 * (1 + tolerance)
+                and result['p95_ms'] - base_p95 > min_delta_ms):
+            regressions.append(f'{name}: p95 {result["p95_ms"]} мс (baseline {base_p95} мс)')
+        if result['errors']:
+            regressions.append(f'{name}: {result["errors"]} ответов 5xx')
+    return regressions
+
+
+def _save(path, key, results):
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    baseline[key] = results
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, ensure_ascii=False, sort_keys=True)
+        f.write('\n')
+
+
+def save_baseline(key, results):
+    # Задержки зависят от машины и в git не попадают
+    _save(BASELINE_PATH, key, {name: {'queries': r['queries']} for name, r in results.items()})
+    _save(LOCAL_BASELINE_PATH, key, {name: {'p95_ms': r['p95_ms']} for name, r in results.items()})
+    print(f'💾 Baseline "{key}" сохранен: SQL-запросы в {BASELINE_PATH}, p95 в {LOCAL_BASELINE_PATH}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк витрины и оформления заказа')
+    parser.add_argument('--products', type=int, default=1000, help='размер каталога (1000, 100000, 1000000)')
+    parser.add_argument('--database', default=DEFAULT_DATABASE, help='URI базы (будет пересоздана!)')
+    parser.add_argument('--mode', choices=['client', 'gunicorn'], default='client')
+    parser.add_argument('--workers', type=int, default=2, help='воркеры gunicorn')
+    parser.add_argument('--concurrency', type=int, default=1, help='параллельные клиенты (для gunicorn)')
+    parser.add_argument('--iterations', type=int, default=50, help='запросов на сценарий')
+    parser.add_argument('--scenarios', help='список сценариев через запятую')
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже заполненную базу')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='допустимый рост p95 (0.5 = +50%%)')
+    parser.add_argument('--min-delta-ms', type=float, default=10.0, help='минимальный абсолютный рост p95')
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+    # Число SQL-запросов берется из Server-Timing, по умолчанию его видят только администраторы
+    os.environ['SERVER_TIMING_PUBLIC'] = '1'
+    # Чтения по таймеру (проверка версии каталога, сброс популярности, опрос
+    # очереди задач, снятие резервов) попадали в случайные запросы и давали
+    # ложные регрессии SQL; за время прогона они не срабатывают
+    for name in ('CATALOG_VERSION_TTL', 'POPULARITY_FLUSH_INTERVAL', 'JOBS_INLINE_POLL_INTERVAL',
+                 'RESERVATION_SWEEP_INTERVAL'):
+        os.environ[name] = '86400'
+    concurrency = args.concurrency if args.mode == 'gunicorn' else 1
+
+    if not args.skip_seed:
+        print(f'🌱 Заполняем базу: {args.products} товаров...')
+        # Каждому сценарию с авторизацией - свои пользователи, чтобы корзины не накапливались между сценариями
+        auth_users = args.iterations + 1 + (len(AUTH_SCENARIOS) - 1) * (concurrency + 1)
+        seed(products=args.products, users=max(50, args.products // 10, auth_users + 2))
+
+    from app import app
+
+    process = None
+    if args.mode == 'gunicorn':
+        process, base_url = start_gunicorn(args.database, args.workers)
+        make_session = lambda: HttpSession(base_url)
+    else:
+        make_session = lambda: TestClientSession(app)
+
+    try:
+        scenarios = build_scenarios(args.products)
+        if args.scenarios:
+            selected = args.scenarios.split(',')
+            scenarios = {name: fn for name, fn in scenarios.items() if name in selected}
+
+        anonymous = [make_session() for _ in range(concurrency)]
+        results = {}
+        next_user = 2
+
+        for name, fn in scenarios.items():
+            if name in AUTH_SCENARIOS:
+                count = args.iterations if name == 'checkout' else concurrency
+                sessions = [make_session() for _ in range(count + 1)]
+                for i, session in enumerate(sessions):
+                    login(session, f'bench{next_user + i}')
+                next_user += len(sessions)
+                warmup_session = sessions.pop()
+            else:
+                sessions = anonymous
+                warmup_session = sessions[0]
+
+            # Прогрев: первый запрос инициализирует БД и кеши шаблонов
+            fn(warmup_session, random.Random(0))
+
+            results[name] = run_scenario(name, fn, sessions, args.iterations, concurrency, rnd_seed=1)
+            r = results[name]
+            print(f'{name:22s} {r["rps"]:9.1f} req/s  p50 {r["p50_ms"]:8.2f} мс  p95 {r["p95_ms"]:8.2f} мс  '
+                  f'p99 {r["p99_ms"]:8.2f} мс  SQL {r["queries"]}  5xx {r["errors"]}')
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    key = f'{args.mode}-{args.products}-{args.iterations}'
+    if args.save_baseline:
+        save_baseline(key, results)
+        return 0
+
+    regressions = compare_with_baseline(key, results, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print('\n❌ Регрессии производительности:')
+        for line in regressions:
+            print(f'   {line}')
+        return 1
+
+    print('\n✅ Регрессий не обнаружено')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""Пакетные операции над заказами и пользователями.
+
+Все функции работают множествами: несколько DELETE/UPDATE на любую пачку
+id вместо загрузки ORM-объектов и удаления по одному. Возврат товара на
+склад - один UPDATE product ... FROM (SELECT product_id, SUM(quantity) ...).
+
+Смена статуса заказов проверяется по явному графу переходов
+ORDER_TRANSITIONS и делается условным UPDATE ... WHERE status IN (...):
+заказ, который успели перевести в другой статус параллельно, просто не
+попадет под условие.
+
+Дочерние строки удаляются явно, до родительских: внешние ключи объявлены
+с ON DELETE CASCADE, но SQLite проверяет их только с PRAGMA foreign_keys,
+а в старых базах ключи созданы без каскада.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, func, literal
+
+import metrics
+
+CHUNK_SIZE = 500
+
+# Откуда в какой статус можно перевести заказ. Из отмененного и доставленного
+# выхода нет: повторная продажа отмененного заказа снова списала бы склад.
+ORDER_TRANSITIONS = {
+    'pending': ('processing', 'shipped', 'cancelled'),
+    'processing': ('pending', 'shipped', 'cancelled'),
+    'shipped': ('delivered',),
+    'delivered': (),
+    'cancelled': (),
+}
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def restore_stock(conn, metadata, order_ids, reason='return'):
+    """Возвращает на склад товары заказов одним UPDATE на пачку; возвращает число товаров.
+
+    Движения пишутся в журнал одним INSERT ... SELECT по строкам заказов.
+    """
+    products = metadata.tables['product']
+    items = metadata.tables['order_item']
+    moves = metadata.tables['inventory_movement']
+    now = datetime.utcnow()
+    touched = 0
+    for chunk in _chunks(order_ids):
+        conn.execute(moves.insert().from_select(
+            ['product_id', 'delta', 'reason', 'ref_id', 'created_at'],
+            select(items.c.product_id, func.sum(items.c.quantity), literal(reason), items.c.order_id, literal(now))
+            .where(items.c.order_id.in_(chunk))
+            .group_by(items.c.order_id, items.c.product_id)
+        ))
+        totals = (
+            select(items.c.product_id, func.sum(items.c.quantity).label('quantity'))
+            .where(items.c.order_id.in_(chunk))
+            .group_by(items.c.product_id)
+            .subquery()
+        )
+        touched += conn.execute(
+            products.update()
+            .where(products.c.id == totals.c.product_id)
+            .values(stock=products.c.stock + totals.c.quantity)
+        ).rowcount
+    return touched
+
+
+def delete_orders(conn, metadata, order_ids, restore=True):
+    """Удаляет заказы со строками. Товары неотмененных заказов возвращаются на склад.
+
+    Возвращает (удалено заказов, товаров с возвращенным остатком).
+    """
+    orders = metadata.tables['order']
+    items = metadata.tables['order_item']
+    deleted = 0
+    restored = 0
+    for chunk in _chunks(order_ids):
+        if restore:
+            active = [row[0] for row in conn.execute(
+                select(orders.c.id).where(orders.c.id.in_(chunk), orders.c.status != 'cancelled')
+            )]
+            if active:
+                restored += restore_stock(conn, metadata, active, reason='order_deleted')
+        conn.execute(items.delete().where(items.c.order_id.in_(chunk)))
+        deleted += conn.execute(orders.delete().where(orders.c.id.in_(chunk))).rowcount
+    return deleted, restored
+
+
+def delete_users(conn, metadata, user_ids):
+    """Удаляет пользователей вместе с корзинами, удержаниями и заказами (и архивными тоже).
+
+    Заказы удаляются без возврата товара на склад, как и раньше при удалении
+    пользователя. Удержания нужно снять до вызова (reservations.release),
+    чтобы вернуть product.reserved. Возвращает (пользователей, заказов).
+    """
+    users = metadata.tables['user']
+    orders = metadata.tables['order']
+    items = metadata.tables['order_item']
+    cart = metadata.tables['cart_item']
+    holds = metadata.tables['stock_hold']
+    archive = metadata.tables['order_archive']
+    item_archive = metadata.tables['order_item_archive']
+    deleted_users = 0
+    deleted_orders = 0
+    for chunk in _chunks(user_ids):
+        user_orders = select(orders.c.id).where(orders.c.user_id.in_(chunk))
+        conn.execute(items.delete().where(items.c.order_id.in_(user_orders)))
+        deleted_orders += conn.execute(orders.delete().where(orders.c.user_id.in_(chunk))).rowcount
+        archived_orders = select(archive.c.id).where(archive.c.user_id.in_(chunk))
+        conn.execute(item_archive.delete().where(item_archive.c.order_id.in_(archived_orders)))
+        deleted_orders += conn.execute(archive.delete().where(archive.c.user_id.in_(chunk))).rowcount
+        conn.execute(cart.delete().where(cart.c.user_id.in_(chunk)))
+        conn.execute(holds.delete().where(holds.c.user_id.in_(chunk)))
+        deleted_users += conn.execute(users.delete().where(users.c.id.in_(chunk))).rowcount
+    return deleted_users, deleted_orders
+
+
+def allowed_sources(new_status):
+    """Статусы, из которых разрешен переход в new_status"""
+    if new_status not in ORDER_TRANSITIONS:
+        raise ValueError(f'Недопустимый статус: {new_status}')
+    return [status for status, targets in ORDER_TRANSITIONS.items() if new_status in targets]
+
+
+def transition_orders(conn, metadata, order_ids, new_status):
+    """Переводит заказы в new_status там, где это разрешено графом переходов.
+
+    Один условный UPDATE на пачку id с обновлением updated_at; для отмены
+    товары переведенных заказов возвращаются на склад одним UPDATE.
+    Возвращает (список переведенных id, {id: текущий статус} для пропущенных;
+    несуществующие заказы в пропущенных со статусом None).
+    """
+    orders = metadata.tables['order']
+    sources = allowed_sources(new_status)
+    now = datetime.utcnow()
+    changed = []
+    skipped = {}
+
+    for chunk in _chunks(order_ids):
+        guarded = orders.update() \
+            .where(orders.c.id.in_(chunk), orders.c.status.in_(sources)) \
+            .values(status=new_status, updated_at=now)
+        if conn.dialect.update_returning:
+            ids = list(conn.execute(guarded.returning(orders.c.id)).scalars())
+        else:
+            ids = list(conn.execute(
+                select(orders.c.id).where(orders.c.id.in_(chunk), orders.c.status.in_(sources)).with_for_update()
+            ).scalars())
+            if ids:
+                conn.execute(guarded.where(orders.c.id.in_(ids)))
+
+        if new_status == 'cancelled' and ids:
+            restore_stock(conn, metadata, ids, reason='cancel')
+        changed.extend(ids)
+
+        if len(ids) < len(chunk):
+            done = set(ids)
+            rest = [order_id for order_id in chunk if order_id not in done]
+            current = dict(conn.execute(select(orders.c.id, orders.c.status).where(orders.c.id.in_(rest))).all())
+            for order_id in rest:
+                skipped[order_id] = current.get(order_id)
+
+    if changed:
+        metrics.registry.inc('shop_order_status_changes_total', len(changed), status=new_status)
+    return changed, skipped
@@ -0,0 +1,198 @@
+"""Колоночная модель каталога в памяти воркера.
+
+Товары загружаются в компактные массивы NumPy (id, цена, остаток, код
+категории, время создания, ранг по названию). Фильтры каталога
+(категория, диапазон цен) считаются векторными масками, сортировка -
+по нужному столбцу, при равенстве - по id; из БД затем загружается
+только видимая страница. Модель пересобирается, когда меняется версия каталога,
+но не чаще раза в CATALOG_READ_MODEL_MAX_STALENESS секунд; пока снимок
+не совпадает с версией, каталог обслуживается через SQL - устаревшая
+страница иначе попала бы в кеш страниц под ключом новой версии.
+
+Сортировка по названию - по кодовым точкам, как BINARY в SQLite и
+COLLATE "C" в PostgreSQL у SQL-пути, чтобы оба движка давали один порядок.
+"""
+import time
+import threading
+
+# numpy импортируется в методах: при CATALOG_ENGINE=sql он воркеру не нужен вовсе
+from sqlalchemy import select, func
+
+# Примерный размер строки модели в байтах: id 8 + цена 8 + остаток 4 + категория 2 + дата 8 + ранг 4
+BYTES_PER_ROW = 34
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога; запросы работают с ним без блокировок"""
+
+    def __init__(self, version, ids, prices, stock, category_codes, categories, created, name_rank):
+        import numpy as np
+        self.version = version
+        self.ids = ids
+        self.prices = prices
+        self.stock = stock
+        self.category_codes = category_codes
+        self.categories = categories
+        self.category_index = {label: code for code, label in enumerate(categories)}
+        self.created = created
+        self.name_rank = name_rank
+        self.built_at = time.monotonic()
+        self.category_counts = np.bincount(category_codes, minlength=len(categories)) if len(categories) else np.zeros(0)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.ids, self.prices, self.stock, self.category_codes,
+                                       self.created, self.name_rank))
+
+    def query(self, category=None, min_price=None, max_price=None, sort='newest', offset=0, limit=24):
+        """Возвращает (id товаров страницы, сколько всего найдено)"""
+        import numpy as np
+        mask = np.ones(len(self.ids), dtype=bool)
+
+        if category:
+            code = self.category_index.get(category)
+            if code is None:
+                return [], 0
+            mask &= self.category_codes == code
+        if min_price is not None:
+            mask &= self.prices >= min_price
+        if max_price is not None:
+            mask &= self.prices <= max_price
+
+        selected = np.flatnonzero(mask)
+        found = len(selected)
+        if not found or offset >= found:
+            return [], found
+
+        if sort == 'price_asc':
+            key = self.prices[selected]
+        elif sort == 'price_desc':
+            key = -self.prices[selected]
+        elif sort == 'name':
+            key = self.name_rank[selected]
+        else:
+            key = -self.created[selected]
+
+        # При равном ключе - по id, как ORDER BY ..., id у SQL-пути: иначе
+        # соседние страницы пересекаются и часть товаров не попадает ни на одну
+        tie = self.ids[selected]
+        # Для первых страниц частичная сортировка дешевле полной
+        end = min(offset + limit, found)
+        if end < found // 2:
+            # Граница берется по значению ключа, чтобы все равные ей товары попали в отбор
+            bound = np.partition(key, end - 1)[end - 1]
+            head = np.flatnonzero(key <= bound)
+            order = head[np.lexsort((tie[head], key[head]))]
+        else:
+            order = np.lexsort((tie, key))
+        page = selected[order[offset:end]]
+        return self.ids[page].tolist(), found
+
+    def counts(self):
+        """Количество товаров по категориям и всего"""
+        return ({label: int(self.category_counts[code]) for code, label in enumerate(self.categories) if label},
+                len(self.ids))
+
+
+class CatalogReadModel:
+
+    def __init__(self):
+        self.metadata = None
+        self.engine = None
+        self.version_getter = None
+        self.snapshot = None
+        self.memory_budget = 256 * 1024 * 1024
+        self.max_staleness = 10.0
+        self.batch_size = 50000
+        self.disabled_reason = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, version_getter):
+        self.metadata = db.metadata
+        self.version_getter = version_getter
+        self.memory_budget = app.config.get('CATALOG_READ_MODEL_MEMORY_MB', 256) * 1024 * 1024
+        self.max_staleness = app.config.get('CATALOG_READ_MODEL_MAX_STALENESS', 10)
+        self.engine = app.config.get('CATALOG_ENGINE', 'sql')
+
+    @property
+    def enabled(self):
+        return self.engine == 'memory' and self.disabled_reason is None
+
+    def load(self, conn, version):
+        """Строит новый снимок из таблицы product; None, если не укладываемся в бюджет памяти"""
+        import numpy as np
+        p = self.metadata.tables['product']
+        total = conn.execute(select(func.count()).select_from(p)).scalar()
+        # Названия держим только на время сборки, поэтому бюджет проверяем по столбцам
+        if total * BYTES_PER_ROW > self.memory_budget:
+            self.disabled_reason = (f'{total} товаров требуют ~{total * BYTES_PER_ROW // (1024 * 1024)} МБ, '
+                                    f'бюджет {self.memory_budget // (1024 * 1024)} МБ')
+            return None
+
+        ids = np.empty(total, dtype=np.int64)
+        prices = np.empty(total, dtype=np.float64)
+        stock = np.empty(total, dtype=np.int32)
+        category_codes = np.empty(total, dtype=np.int16)
+        created = np.empty(total, dtype=np.int64)
+        names = []
+        categories = {}
+
+        position = 0
+        result = conn.execution_options(stream_results=True, yield_per=self.batch_size).execute(
+            select(p.c.id, p.c.price, p.c.stock, p.c.category, p.c.created_at, p.c.name).order_by(p.c.id)
+        )
+        for rows in result.partitions(self.batch_size):
+            # Товары могли добавиться между count и чтением - лишнее отбрасываем
+            rows = rows[:total - position]
+            if not rows:
+                break
+            batch_ids, batch_prices, batch_stock, batch_categories, batch_created, batch_names = zip(*rows)
+            end = position + len(rows)
+            ids[position:end] = batch_ids
+            prices[position:end] = batch_prices
+            stock[position:end] = [s or 0 for s in batch_stock]
+            category_codes[position:end] = [categories.setdefault(c, len(categories)) for c in batch_categories]
+            created[position:end] = np.array(batch_created, dtype='datetime64[us]').astype(np.int64)
+            names.extend(batch_names)
+            position = end
+
+        # Товары могли удалиться между count и чтением
+        ids, prices, stock, category_codes, created = (
+            a[:position] for a in (ids, prices, stock, category_codes, created)
+        )
+        name_rank = np.empty(position, dtype=np.int32)
+        name_rank[np.argsort(np.array(names, dtype=object), kind='stable')] = np.arange(position, dtype=np.int32)
+
+        labels = [None] * len(categories)
+        for label, code in categories.items():
+            labels[code] = label
+
+        return CatalogSnapshot(version, ids, prices, stock, category_codes, labels, created, name_rank)
+
+    def current(self, conn):
+        """Актуальный снимок или None (тогда каталог обслуживается через SQL)"""
+        if not self.enabled:
+            return None
+
+        snapshot = self.snapshot
+        version = self.version_getter()[0]
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        # Снимок устарел: отдавать его нельзя, но и пересобирать на каждое изменение
+        # товара дорого - до истечения max_staleness каталог идет через SQL
+        if snapshot is not None and time.monotonic() - snapshot.built_at < self.max_staleness:
+            return None
+
+        # Пересобирает один поток; остальные пока идут через SQL
+        if not self._lock.acquire(blocking=snapshot is None):
+            return None
+        try:
+            if self.snapshot is snapshot:
+                self.snapshot = self.load(conn, version)
+            current = self.snapshot
+            return current if current is not None and current.version == version else None
+        finally:
+            self._lock.release()
+
+
+catalog_model = CatalogReadModel()
@@ -1,8 +1,12 @@
 import os
-from dotenv import load_dotenv
 import urllib.parse
 
-load_dotenv()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# .env рядом с приложением; без файла python-dotenv не импортируется и каталоги не обходятся
+if os.path.exists(os.path.join(BASE_DIR, '.env')):
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(BASE_DIR, '.env'))
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
@@ -15,6 +19,15 @@ class Config:
     SQLALCHEMY_DATABASE_URI = DATABASE_URL or 'sqlite:///shop.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Реплики для чтения (адреса через запятую): GET-запросы витрины читают с них,
+    # после записи посетитель REPLICA_STICKY_SECONDS читает из основной базы
+    DATABASE_REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://', 1)
+                             for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    SQLALCHEMY_BINDS = {f'replica{i}': url for i, url in enumerate(DATABASE_REPLICA_URLS)}
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+    REPLICA_ENDPOINTS = [e.strip() for e in os.environ.get(
+        'REPLICA_ENDPOINTS', 'index,catalog,product_detail,about,api_products,api_product').split(',') if e.strip()]
+
     # Настройки для загрузки файлов
     # На Render используем временную папку, локально - постоянную
     if os.environ.get('RENDER'):
@@ -22,21 +35,154 @@ class Config:
         UPLOAD_FOLDER = os.path.join('/tmp', 'uploads')
     else:
         # Локально - постоянная папка
-        UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+        UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
     
     PRODUCT_IMAGE_FOLDER = os.path.join(UPLOAD_FOLDER, 'products')
     
-    # Создаем папки если их нет
-    os.makedirs(PRODUCT_IMAGE_FOLDER, exist_ok=True)
-    
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    # Ширины уменьшенных копий изображений товаров для srcset
+    PRODUCT_IMAGE_WIDTHS = [int(w) for w in os.environ.get('PRODUCT_IMAGE_WIDTHS', '160,320,480').split(',')]
 
     # Настройки для продакшн
     SESSION_COOKIE_SECURE = os.environ.get('FLASK_ENV') == 'production'
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
 
+    # Метрики и журнал медленных запросов
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    # Без токена /metrics открыт только администраторам
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Server-Timing получают администраторы и debug; 1 - всем клиентам (для бенчмарков)
+    SERVER_TIMING_PUBLIC = os.environ.get('SERVER_TIMING_PUBLIC') == '1'
+    # Общий каталог метрик воркеров: /metrics складывает счетчики всех процессов
+    # gunicorn (gunicorn_config.py задает его сам). Без него - метрики одного воркера
+    METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+    SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 1000))
+
+    # Кеш публичных страниц для анонимных посетителей: lru, filesystem, redis или none
+    RESPONSE_CACHE_TYPE = os.environ.get('RESPONSE_CACHE_TYPE', 'lru')
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+    RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR') or os.path.join('/tmp', 'shop_page_cache')
+    RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', 'redis://localhost:6379/0')
+    RESPONSE_CACHE_CONTROL = os.environ.get('RESPONSE_CACHE_CONTROL',
+                                            'public, max-age=60, s-maxage=300, stale-while-revalidate=30')
+    # Как часто воркер перечитывает версию каталога из БД (секунды)
+    CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', 1))
+
+    # Похожие товары: сколько показывать, сколько соседей по цене рассматривать
+    # и вес одной совместной покупки относительно близости цены
+    RELATED_PRODUCTS_COUNT = int(os.environ.get('RELATED_PRODUCTS_COUNT', 4))
+    RELATED_PRODUCTS_PRICE_WINDOW = int(os.environ.get('RELATED_PRODUCTS_PRICE_WINDOW', 8))
+    RELATED_PRODUCTS_COPURCHASE_WEIGHT = float(os.environ.get('RELATED_PRODUCTS_COPURCHASE_WEIGHT', 1.0))
+
+    # Индекс совместных покупок: сколько пар хранить на товар, минимальная
+    # частота пары при полной сборке, лимит соседей в памяти и размер корзины
+    COPURCHASE_TOP_K = int(os.environ.get('COPURCHASE_TOP_K', 20))
+    COPURCHASE_MIN_COUNT = int(os.environ.get('COPURCHASE_MIN_COUNT', 2))
+    COPURCHASE_CAPACITY = int(os.environ.get('COPURCHASE_CAPACITY', 200))
+    COPURCHASE_MAX_BASKET = int(os.environ.get('COPURCHASE_MAX_BASKET', 50))
+
+    # Отчеты о продажах: размер пачки при чтении строк заказов и кеш готовых отчетов
+    REPORTS_BATCH_SIZE = int(os.environ.get('REPORTS_BATCH_SIZE', 50000))
+    REPORTS_CACHE_TTL = int(os.environ.get('REPORTS_CACHE_TTL', 300))
+    REPORTS_CACHE_MAX_ENTRIES = int(os.environ.get('REPORTS_CACHE_MAX_ENTRIES', 64))
+
+    # Каталог: размер страницы и движок фильтрации (sql - запросы к БД, memory - колоночная модель в памяти)
+    CATALOG_PAGE_SIZE = int(os.environ.get('CATALOG_PAGE_SIZE', 24))
+    CATALOG_ENGINE = os.environ.get('CATALOG_ENGINE', 'sql')
+    CATALOG_READ_MODEL_MEMORY_MB = int(os.environ.get('CATALOG_READ_MODEL_MEMORY_MB', 256))
+    # Не чаще раза в столько секунд пересобирать модель; пока она отстает от версии, каталог идет через SQL
+    CATALOG_READ_MODEL_MAX_STALENESS = float(os.environ.get('CATALOG_READ_MODEL_MAX_STALENESS', 10))
+
+    # Популярность: счетчики копятся в памяти воркера и сбрасываются в БД пачкой
+    POPULARITY_FLUSH_INTERVAL = float(os.environ.get('POPULARITY_FLUSH_INTERVAL', 30))
+    POPULARITY_FLUSH_MAX_KEYS = int(os.environ.get('POPULARITY_FLUSH_MAX_KEYS', 1000))
+    POPULARITY_HALF_LIFE_HOURS = float(os.environ.get('POPULARITY_HALF_LIFE_HOURS', 168))
+    POPULARITY_VIEW_WEIGHT = float(os.environ.get('POPULARITY_VIEW_WEIGHT', 1.0))
+    POPULARITY_CART_WEIGHT = float(os.environ.get('POPULARITY_CART_WEIGHT', 5.0))
+
+    # Пакетное API корзины: максимум позиций в одном запросе
+    CART_BATCH_MAX_ITEMS = int(os.environ.get('CART_BATCH_MAX_ITEMS', 100))
+
+    # Корзина гостя в подписанной cookie
+    GUEST_CART_COOKIE = os.environ.get('GUEST_CART_COOKIE', 'guest_cart')
+    GUEST_CART_MAX_AGE = int(os.environ.get('GUEST_CART_MAX_AGE', 30 * 24 * 3600))
+    GUEST_CART_MAX_ITEMS = int(os.environ.get('GUEST_CART_MAX_ITEMS', 50))
+
+    # Резервирование товара в корзинах: срок удержания, период и размер пачки очистки
+    RESERVATIONS_ENABLED = os.environ.get('RESERVATIONS_ENABLED', '1') == '1'
+    RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 900))
+    RESERVATION_SWEEP_INTERVAL = float(os.environ.get('RESERVATION_SWEEP_INTERVAL', 60))
+    RESERVATION_SWEEP_BATCH = int(os.environ.get('RESERVATION_SWEEP_BATCH', 500))
+
+    # Очистка брошенных корзин (flask cleanup-carts): возраст, размер пачки, пауза между пачками
+    CART_MAX_AGE_DAYS = int(os.environ.get('CART_MAX_AGE_DAYS', 30))
+    CART_CLEANUP_BATCH = int(os.environ.get('CART_CLEANUP_BATCH', 1000))
+    CART_CLEANUP_PAUSE = float(os.environ.get('CART_CLEANUP_PAUSE', 0.05))
+
+    # Массовые операции над заказами в админке: максимум заказов за один запрос
+    ORDER_BULK_MAX_ITEMS = int(os.environ.get('ORDER_BULK_MAX_ITEMS', 1000))
+
+    # Архив заказов (flask archive-orders): возраст завершенных заказов, размер пачки, пауза между пачками
+    ORDER_ARCHIVE_MONTHS = int(os.environ.get('ORDER_ARCHIVE_MONTHS', 12))
+    ORDER_ARCHIVE_BATCH = int(os.environ.get('ORDER_ARCHIVE_BATCH', 500))
+    ORDER_ARCHIVE_PAUSE = float(os.environ.get('ORDER_ARCHIVE_PAUSE', 0.05))
+
+    # Сверка остатков с журналом движения: строк в одной порции потокового чтения
+    INVENTORY_RECONCILE_CHUNK = int(os.environ.get('INVENTORY_RECONCILE_CHUNK', 10000))
+
+    # Профиль SQLite: WAL, ожидание блокировки, кеш страниц; пишущие маршруты начинают с BEGIN IMMEDIATE
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', '1') == '1'
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))
+
+    # Фоновые задачи: без отдельного воркера (JOBS_INLINE=1) их выполняет веб-процесс после ответа
+    JOBS_INLINE = os.environ.get('JOBS_INLINE', '1') == '1'
+    JOBS_INLINE_BATCH = int(os.environ.get('JOBS_INLINE_BATCH', 10))
+    JOBS_INLINE_POLL_INTERVAL = float(os.environ.get('JOBS_INLINE_POLL_INTERVAL', 30))
+    JOBS_CONCURRENCY = int(os.environ.get('JOBS_CONCURRENCY', 4))
+    JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 1.0))
+    JOBS_LEASE_SECONDS = int(os.environ.get('JOBS_LEASE_SECONDS', 300))
+    JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+    JOBS_BACKOFF_BASE = float(os.environ.get('JOBS_BACKOFF_BASE', 5))
+    JOBS_BACKOFF_MAX = float(os.environ.get('JOBS_BACKOFF_MAX', 3600))
+    JOBS_RETENTION_HOURS = float(os.environ.get('JOBS_RETENTION_HOURS', 24))
+    # Как часто веб-процесс в режиме JOBS_INLINE удаляет выполненные задачи (секунды)
+    JOBS_PURGE_INTERVAL = float(os.environ.get('JOBS_PURGE_INTERVAL', 600))
+
+    # Статика из flask build-assets: адреса с хешем и срок кеширования в браузере
+    ASSETS_ENABLED = os.environ.get('ASSETS_ENABLED', '1') == '1'
+    ASSETS_MAX_AGE = int(os.environ.get('ASSETS_MAX_AGE', 365 * 24 * 3600))
+
+    # Подсказки поиска: как часто сверяться с БД, запас по updated_at на часы
+    # разных серверов, сколько id брать на префикс, минимальная длина запроса
+    AUTOCOMPLETE_SYNC_INTERVAL = float(os.environ.get('AUTOCOMPLETE_SYNC_INTERVAL', 5))
+    AUTOCOMPLETE_SYNC_OVERLAP = int(os.environ.get('AUTOCOMPLETE_SYNC_OVERLAP', 60))
+    AUTOCOMPLETE_CANDIDATES = int(os.environ.get('AUTOCOMPLETE_CANDIDATES', 500))
+    AUTOCOMPLETE_MIN_CHARS = int(os.environ.get('AUTOCOMPLETE_MIN_CHARS', 2))
+    AUTOCOMPLETE_MAX_AGE = int(os.environ.get('AUTOCOMPLETE_MAX_AGE', 60))
+
+    # Профилирование запросов (/admin/profiler): ?_profile=1 или X-Profile: 1 от администратора,
+    # плюс доля всех запросов (0 - только по запросу) с лимитом в минуту на воркер
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '1') == '1'
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    PROFILER_MAX_PER_MINUTE = int(os.environ.get('PROFILER_MAX_PER_MINUTE', 30))
+    # Сколько профилей хранить, сколько функций в топе, с какой доли времени показывать
+    # ветку дерева вызовов и насколько глубоко его разворачивать
+    PROFILER_KEEP = int(os.environ.get('PROFILER_KEEP', 500))
+    PROFILER_TOP = int(os.environ.get('PROFILER_TOP', 40))
+    PROFILER_MIN_SHARE = float(os.environ.get('PROFILER_MIN_SHARE', 0.005))
+    PROFILER_TREE_DEPTH = int(os.environ.get('PROFILER_TREE_DEPTH', 20))
+    # Глубина стека, которую tracemalloc запоминает для каждого выделения памяти
+    PROFILER_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILER_TRACEMALLOC_FRAMES', 1))
+
     @staticmethod
     def init_app(app):
-        pass
+        # Папки создаются при запуске приложения (create_app), а не при импорте конфига
+        os.makedirs(app.config['PRODUCT_IMAGE_FOLDER'], exist_ok=True)
@@ -0,0 +1,204 @@
+"""Индекс совместных покупок ("с этим товаром покупают").
+
+Полная сборка потоково читает order_item вместе с архивом заказов
+(order_item_archive), отсортированные по order_id,
+собирает корзину каждого заказа и считает пары товаров в разреженном
+словаре. Память ограничена: у каждого товара хранится не больше capacity
+соседей, при переполнении редкие пары отбрасываются (как в Space-Saving).
+В таблицу copurchase пишется top-K на товар строкой "id:count,id:count",
+поэтому чтение - один запрос по первичному ключу. Новые заказы
+добавляются инкрементально через apply_orders().
+"""
+import heapq
+from datetime import datetime
+
+from sqlalchemy import select, union_all
+
+
+def encode_counts(pairs):
+    return ','.join(f'{product_id}:{count}' for product_id, count in pairs)
+
+
+def decode_counts(value):
+    pairs = []
+    if value:
+        for chunk in value.split(','):
+            product_id, count = chunk.split(':')
+            pairs.append((int(product_id), int(count)))
+    return pairs
+
+
+class CoPurchaseCounter:
+    """Потоковый подсчет пар товаров с ограниченной памятью"""
+
+    def __init__(self, capacity=200, max_basket=50):
+        self.capacity = capacity
+        self.max_basket = max_basket
+        self.counts = {}
+        self.orders = 0
+        self.lines = 0
+        self.pruned = 0
+
+    def add_basket(self, product_ids):
+        """Учитывает один заказ (набор id товаров)"""
+        basket = sorted(set(product_ids))
+        self.orders += 1
+        self.lines += len(basket)
+        if len(basket) < 2:
+            return
+        # Оптовые заказы дают квадратичное число пар и почти ничего не говорят о связях
+        if len(basket) > self.max_basket:
+            basket = basket[:self.max_basket]
+
+        for a in basket:
+            neighbors = self.counts.get(a)
+            if neighbors is None:
+                neighbors = self.counts[a] = {}
+            for b in basket:
+                if a != b:
+                    neighbors[b] = neighbors.get(b, 0) + 1
+            if len(neighbors) > self.capacity:
+                self._prune(a, neighbors)
+
+    def _prune(self, product_id, neighbors):
+        keep = heapq.nlargest(self.capacity // 2, neighbors.items(), key=lambda item: item[1])
+        self.pruned += len(neighbors) - len(keep)
+        self.counts[product_id] = dict(keep)
+
+    def consume(self, rows):
+        """rows - пары (order_id, product_id), отсортированные по order_id"""
+        current_order = None
+        basket = []
+        for order_id, product_id in rows:
+            if order_id != current_order:
+                if basket:
+                    self.add_basket(basket)
+                current_order = order_id
+                basket = []
+            basket.append(product_id)
+        if basket:
+            self.add_basket(basket)
+
+    def top(self, k, min_count=1):
+        """Итоговые top-K списки: {product_id: [(id, count), ...]}"""
+        result = {}
+        for product_id, neighbors in self.counts.items():
+            best = heapq.nlargest(k, ((b, c) for b, c in neighbors.items() if c >= min_count),
+                                  key=lambda item: (item[1], -item[0]))
+            if best:
+                result[product_id] = best
+        return result
+
+    @property
+    def pairs(self):
+        return sum(len(neighbors) for neighbors in self.counts.values())
+
+
+class CoPurchaseIndex:
+
+    def __init__(self):
+        self.metadata = None
+        self.top_k = 20
+        self.min_count = 2
+        self.capacity = 200
+        self.max_basket = 50
+
+    def init_app(self, app, db):
+        self.metadata = db.metadata
+        self.top_k = app.config.get('COPURCHASE_TOP_K', 20)
+        self.min_count = app.config.get('COPURCHASE_MIN_COUNT', 2)
+        self.capacity = app.config.get('COPURCHASE_CAPACITY', 200)
+        self.max_basket = app.config.get('COPURCHASE_MAX_BASKET', 50)
+
+    @property
+    def table(self):
+        return self.metadata.tables['copurchase']
+
+    @property
+    def order_items(self):
+        return self.metadata.tables['order_item']
+
+    @property
+    def archived_order_items(self):
+        return self.metadata.tables['order_item_archive']
+
+    def lookup_many(self, conn, product_ids):
+        """Сохраненные списки: {product_id: [(id, count), ...]}"""
+        t = self.table
+        if not product_ids:
+            return {}
+        return {
+            row.product_id: decode_counts(row.pairs)
+            for row in conn.execute(select(t.c.product_id, t.c.pairs).where(t.c.product_id.in_(list(product_ids))))
+        }
+
+    def lookup(self, conn, product_id):
+        return self.lookup_many(conn, [product_id]).get(product_id, [])
+
+    def recommend(self, conn, product_ids, limit=4):
+        """Товары, которые покупают вместе с набором (например, с корзиной)"""
+        exclude = set(product_ids)
+        scores = {}
+        for pairs in self.lookup_many(conn, exclude).values():
+            for other_id, count in pairs:
+                if other_id not in exclude:
+                    scores[other_id] = scores.get(other_id, 0) + count
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [product_id for product_id, _ in best]
+
+    def _write(self, conn, top):
+        t = self.table
+        if not top:
+            return
+        now = datetime.utcnow()
+        conn.execute(t.delete().where(t.c.product_id.in_(list(top))))
+        conn.execute(t.insert(), [
+            {'product_id': product_id, 'pairs': encode_counts(pairs), 'updated_at': now}
+            for product_id, pairs in top.items() if pairs
+        ])
+
+    def apply_orders(self, conn, baskets):
+        """Инкрементально добавляет новые заказы: baskets - список наборов id товаров"""
+        counter = CoPurchaseCounter(capacity=self.capacity, max_basket=self.max_basket)
+        for basket in baskets:
+            counter.add_basket(basket)
+        if not counter.counts:
+            return
+
+        stored = self.lookup_many(conn, counter.counts)
+        merged = {}
+        for product_id, deltas in counter.counts.items():
+            counts = dict(stored.get(product_id, ()))
+            for other_id, delta in deltas.items():
+                counts[other_id] = counts.get(other_id, 0) + delta
+            merged[product_id] = heapq.nlargest(self.top_k, counts.items(), key=lambda item: (item[1], -item[0]))
+        self._write(conn, merged)
+
+    def stream_order_lines(self, conn, batch_size=10000):
+        """Потоково читает (order_id, product_id) рабочих и архивных заказов в порядке заказов"""
+        oi = self.order_items
+        archived = self.archived_order_items
+        lines = union_all(
+            select(oi.c.order_id, oi.c.product_id),
+            select(archived.c.order_id, archived.c.product_id),
+        ).subquery()
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+            select(lines.c.order_id, lines.c.product_id).order_by(lines.c.order_id)
+        )
+        for partition in result.partitions(batch_size):
+            yield from partition
+
+    def rebuild(self, conn):
+        """Полная сборка индекса по всей истории заказов"""
+        counter = CoPurchaseCounter(capacity=self.capacity, max_basket=self.max_basket)
+        counter.consume(self.stream_order_lines(conn))
+        top = counter.top(self.top_k, self.min_count)
+
+        conn.execute(self.table.delete())
+        items = list(top.items())
+        for start in range(0, len(items), 1000):
+            self._write(conn, dict(items[start:start + 1000]))
+        return counter
+
+
+copurchase_index = CoPurchaseIndex()
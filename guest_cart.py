@@ -0,0 +1,97 @@
+"""Корзина гостя в подписанной cookie.
+
+Пока посетитель не вошел, корзина живет только в cookie вида
+"id:qty|id:qty.<подпись>" - никаких записей в БД. Подпись (itsdangerous,
+секретный ключ приложения) не дает подменить содержимое. При входе или
+регистрации корзина переносится в CartItem одним upsert и cookie удаляется.
+
+Значение cookie намеренно читаемо: script.js по нему рисует счетчик
+корзины гостя, поэтому закешированные страницы остаются общими для всех.
+"""
+from flask import g, request
+from itsdangerous import Signer, BadSignature
+
+
+def encode_cart(cart):
+    return '|'.join(f'{product_id}:{quantity}' for product_id, quantity in cart.items() if quantity > 0)
+
+
+def decode_cart(value):
+    cart = {}
+    if value:
+        for chunk in value.split('|'):
+            product_id, quantity = chunk.split(':')
+            cart[int(product_id)] = int(quantity)
+    return cart
+
+
+class GuestCartItem:
+    """Позиция гостевой корзины с тем же интерфейсом, что у CartItem в шаблонах.
+
+    id совпадает с id товара: у гостевых позиций нет строк в БД.
+    """
+
+    def __init__(self, product, quantity):
+        self.id = product.id
+        self.product_id = product.id
+        self.product = product
+        self.quantity = quantity
+
+
+class GuestCart:
+
+    def __init__(self):
+        self.signer = None
+        self.cookie_name = 'guest_cart'
+        self.max_age = 30 * 24 * 3600
+        self.max_items = 50
+
+    def init_app(self, app):
+        self.signer = Signer(app.secret_key, salt='guest-cart')
+        self.cookie_name = app.config.get('GUEST_CART_COOKIE', 'guest_cart')
+        self.max_age = app.config.get('GUEST_CART_MAX_AGE', 30 * 24 * 3600)
+        self.max_items = app.config.get('GUEST_CART_MAX_ITEMS', 50)
+
+        @app.after_request
+        def save_guest_cart(response):
+            if g.get('guest_cart_dirty'):
+                cart = g.guest_cart
+                if cart:
+                    response.set_cookie(self.cookie_name, self.signer.sign(encode_cart(cart)).decode('ascii'),
+                                        max_age=self.max_age, samesite='Lax',
+                                        secure=app.config.get('SESSION_COOKIE_SECURE', False))
+                else:
+                    response.delete_cookie(self.cookie_name)
+            return response
+
+    def get(self):
+        """Корзина текущего запроса: {product_id: quantity}"""
+        if 'guest_cart' not in g:
+            cart = {}
+            raw = request.cookies.get(self.cookie_name)
+            if raw:
+                try:
+                    cart = decode_cart(self.signer.unsign(raw).decode('ascii'))
+                except (BadSignature, ValueError):
+                    # Битая или поддельная cookie - просто пустая корзина (и удаляем cookie)
+                    g.guest_cart_dirty = True
+            g.guest_cart = cart
+        return g.guest_cart
+
+    def save(self, cart):
+        """Запоминает новую корзину; cookie выставится в after_request"""
+        if len(cart) > self.max_items:
+            raise ValueError(f'В корзине гостя может быть не больше {self.max_items} позиций')
+        g.guest_cart = {product_id: quantity for product_id, quantity in cart.items() if quantity > 0}
+        g.guest_cart_dirty = True
+
+    def clear(self):
+        g.guest_cart = {}
+        g.guest_cart_dirty = True
+
+    @property
+    def count(self):
+        return sum(self.get().values())
+
+
+guest_cart = GuestCart()
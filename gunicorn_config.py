@@ -1,8 +1,66 @@
-import multiprocessing
+import gc
+import os
+import shutil
+import tempfile
+import importlib
 
-bind = "0.0.0.0:10000"
-workers = multiprocessing.cpu_count() * 2 + 1
-threads = 2
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+# Число воркеров задается явно, а не от cpu_count(): каждый воркер держит свои
+# индексы подсказок, каталога (numpy) и похожих товаров, и на тарифе с 512 МБ
+# формула cpu_count()*2+1 быстро упирается в память. Без DATABASE_URL все
+# воркеры пишут в один файл SQLite, и лишние процессы только ждут блокировку.
+# Прибавляйте воркеры, когда есть запас памяти и база - PostgreSQL.
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
 worker_class = 'sync'
 timeout = 120
-keepalive = 5
\ No newline at end of file
+keepalive = 5
+
+# Общий каталог метрик: каждый воркер пишет туда свои счетчики, /metrics их
+# складывает (metrics.py). Иначе опрос попадал бы в случайный воркер, и счетчики
+# на графиках прыгали бы. Каталог очищается при старте мастера (on_starting)
+METRICS_MULTIPROC_DIR = os.environ.setdefault(
+    'METRICS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), f"shopmaster-metrics-{os.environ.get('PORT', 10000)}")
+)
+
+# Приложение загружается один раз в мастере, воркеры получают его через fork:
+# быстрее старт и перезапуск воркеров, общая (copy-on-write) память под код и модели.
+# GUNICORN_PRELOAD=0 - загрузка в каждом воркере (нужно, чтобы HUP перечитывал код)
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Тяжелые модули, которые приложение импортирует лениво; при preload_app мастер
+# загружает их заранее, чтобы воркеры не импортировали их каждый у себя
+PRELOAD_MODULES = [m.strip() for m in os.environ.get('GUNICORN_PRELOAD_MODULES', 'PIL.Image,numpy').split(',')
+                   if m.strip()]
+
+
+def on_starting(server):
+    # Файлы прошлого запуска сложились бы с новыми счетчиками
+    shutil.rmtree(METRICS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            server.log.warning(f'Preload of {name} skipped: {e}')
+    # Объекты мастера - в постоянное поколение: сборщик мусора воркеров не
+    # обходит их и не пишет в их заголовки, страницы остаются общими
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    # Соединения пула, открытые мастером (проверка схемы в create_app), принадлежат
+    # ему: воркер забывает их, не закрывая, и открывает свои
+    from app import app, db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
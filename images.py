@@ -0,0 +1,153 @@
+"""Адаптивные изображения товаров.
+
+Файлы называются по хешу содержимого (content_filename), так что одно
+фото для нескольких товаров хранится один раз. При загрузке из исходника
+(не больше 800px) нарезаются уменьшенные копии <имя>_<ширина>.<расширение>
+для ширин из PRODUCT_IMAGE_WIDTHS и считается
+крошечная размытая заглушка - data URI JPEG шириной 16px. Размеры, список
+нарезанных ширин и заглушка хранятся в товаре, так что шаблону не нужно
+лезть в файловую систему.
+
+product_image() в шаблонах рисует <img> с srcset/sizes, явными width и
+height (место под картинку резервируется до загрузки), нативной ленивой
+загрузкой и заглушкой в фоне, которую перекрывает настоящая картинка.
+
+Pillow импортируется при первой обработке картинки, а не при импорте
+модуля: витрине он не нужен, а воркерам gunicorn он не стоит времени
+запуска (с preload_app его загружает мастер до fork).
+"""
+import io
+import os
+import re
+import base64
+import hashlib
+
+from flask import url_for
+from markupsafe import Markup, escape
+
+PLACEHOLDER_WIDTH = 16
+IMAGE_FIELDS = ('image_width', 'image_height', 'image_renditions', 'image_placeholder')
+RENDITION_RE = re.compile(r'^(.+)_\d+(\.\w+)$')
+SAVE_OPTIONS = {
+    'jpeg': {'format': 'JPEG', 'quality': 80, 'optimize': True, 'progressive': True},
+    'png': {'format': 'PNG', 'optimize': True},
+}
+
+
+def content_filename(data, ext):
+    """Имя файла по содержимому: одинаковые загрузки дают одно имя"""
+    return f'{hashlib.sha256(data).hexdigest()[:32]}.{ext}'
+
+
+def source_filename(name):
+    """Исходник, к которому относится файл: для копии <имя>_<ширина>.ext - <имя>.ext"""
+    match = RENDITION_RE.match(name)
+    return match.group(1) + match.group(2) if match else name
+
+
+def rendition_name(filename, width):
+    stem, ext = filename.rsplit('.', 1)
+    return f'{stem}_{width}.{ext}'
+
+
+def open_image(source):
+    """Image.open с отложенным импортом Pillow; source - путь или файловый объект"""
+    from PIL import Image
+    return Image.open(source)
+
+
+def image_format(ext):
+    ext = ext.lower()
+    return 'jpeg' if ext in ('jpg', 'jpeg') else ext
+
+
+def make_renditions(image, folder, filename, widths):
+    """Сохраняет уменьшенные копии для ширин меньше исходной; возвращает их ширины"""
+    from PIL import Image
+    options = SAVE_OPTIONS.get(image_format(filename.rsplit('.', 1)[1]))
+    if options is None:
+        # GIF может быть анимированным - не пережимаем
+        return []
+    made = []
+    for width in sorted(set(widths)):
+        if width >= image.width:
+            continue
+        height = max(1, round(image.height * width / image.width))
+        copy = image.resize((width, height), Image.LANCZOS)
+        if options['format'] == 'JPEG' and copy.mode not in ('RGB', 'L'):
+            copy = copy.convert('RGB')
+        copy.save(os.path.join(folder, rendition_name(filename, width)), **options)
+        made.append(width)
+    return made
+
+
+def placeholder_data_uri(image):
+    """Размытая заглушка для фона <img>; None для картинок с прозрачностью"""
+    from PIL import Image
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        return None
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    tiny = image.convert('RGB').resize((PLACEHOLDER_WIDTH, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'JPEG', quality=40, optimize=True)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def process_image(image, folder, filename, widths):
+    """Нарезка и метаданные для сохраненного исходника: поля товара image_*"""
+    return {
+        'image_width': image.width,
+        'image_height': image.height,
+        'image_renditions': ','.join(str(w) for w in make_renditions(image, folder, filename, widths)),
+        'image_placeholder': placeholder_data_uri(image),
+    }
+
+
+def delete_renditions(folder, filename, widths):
+    for width in widths:
+        path = os.path.join(folder, rendition_name(filename, width))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def image_url(filename):
+    return url_for('static', filename='uploads/products/' + filename)
+
+
+def product_image(product, sizes='100vw', lazy=True, **attrs):
+    """<img> товара с srcset по нарезанным копиям.
+
+    lazy=False - для главной картинки страницы (LCP): без ленивой загрузки
+    и с fetchpriority=high. Остальные атрибуты передаются как есть,
+    class_ превращается в class.
+    """
+    filename = product.image_filename
+    tag = {'src': image_url(filename), 'alt': attrs.pop('alt', product.name)}
+
+    widths = [int(w) for w in (product.image_renditions or '').split(',') if w]
+    if product.image_width and product.image_height:
+        tag['width'] = product.image_width
+        tag['height'] = product.image_height
+        if widths:
+            candidates = [f'{image_url(rendition_name(filename, w))} {w}w' for w in widths]
+            candidates.append(f'{tag["src"]} {product.image_width}w')
+            tag['srcset'] = ', '.join(candidates)
+            tag['sizes'] = sizes
+
+    if lazy:
+        tag['loading'] = 'lazy'
+    else:
+        tag['fetchpriority'] = 'high'
+    tag['decoding'] = 'async'
+
+    style = attrs.pop('style', '').strip().rstrip(';')
+    if product.image_placeholder:
+        background = f"background: url('{product.image_placeholder}') center / cover no-repeat"
+        style = f'{style}; {background}' if style else background
+    if style:
+        tag['style'] = style
+
+    for name, value in attrs.items():
+        tag[name.rstrip('_')] = value
+
+    return Markup('<img ' + ' '.join(f'{name}="{escape(value)}"' for name, value in tag.items()) + '>')
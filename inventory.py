@@ -0,0 +1,145 @@
+"""Журнал движения товара: каждое изменение остатка - строка в inventory_movement.
+
+Журнал только дополняется. Материализованный баланс товара - это сам
+product.stock: он меняется в той же транзакции, что и запись в журнал,
+поэтому сумма delta по товару должна совпадать с остатком. Сверка
+(flask inventory-reconcile) проверяет это одним потоковым проходом.
+
+Движения из ORM (добавление товара, правка остатка в админке) ловятся в
+after_flush по истории атрибута stock, явные (продажа при оформлении)
+добавляются через record(). Все они копятся в session.info и пишутся
+одним executemany перед commit. Возвраты на склад по заказам пишутся в
+bulk_ops одним INSERT ... SELECT из order_item.
+
+У товаров, созданных до появления журнала, движений нет; при создании
+таблицы журнала prepare_database переносит их остатки движениями 'initial'
+(seed_from_stock), иначе первая сверка сочла бы расхождением каждый товар.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, func, literal
+
+import metrics
+
+PENDING_KEY = 'inventory_movements'
+
+
+def _merge_sorted(products, balances):
+    """Слияние двух потоков, упорядоченных по product_id: (id, stock, баланс по журналу)"""
+    balance = next(balances, None)
+    for product_id, stock in products:
+        while balance is not None and balance[0] < product_id:
+            # Движения удаленного товара - не расхождение
+            balance = next(balances, None)
+        if balance is not None and balance[0] == product_id:
+            yield product_id, stock or 0, balance[1]
+            balance = next(balances, None)
+        else:
+            yield product_id, stock or 0, 0
+
+
+class InventoryLedger:
+
+    def __init__(self):
+        self.metadata = None
+        self.product_class = None
+        self.chunk_size = 10000
+
+    def init_app(self, app, db, product_class):
+        self.metadata = db.metadata
+        self.product_class = product_class
+        self.chunk_size = app.config.get('INVENTORY_RECONCILE_CHUNK', 10000)
+
+        event.listen(db.session, 'after_flush', self._collect_orm_changes)
+        event.listen(db.session, 'before_commit', self._write_pending)
+        event.listen(db.session, 'after_soft_rollback', self._drop_pending)
+
+    @property
+    def movements(self):
+        return self.metadata.tables['inventory_movement']
+
+    def record(self, session, quantities, reason, ref_id=None):
+        """Запоминает движения {product_id: delta}; запишутся при commit сессии"""
+        now = datetime.utcnow()
+        pending = session.info.setdefault(PENDING_KEY, [])
+        for product_id, delta in quantities.items():
+            if delta:
+                pending.append({'product_id': product_id, 'delta': delta, 'reason': reason,
+                                'ref_id': ref_id, 'created_at': now})
+
+    def _collect_orm_changes(self, session, flush_context):
+        changes = {}
+        for obj in session.new:
+            if isinstance(obj, self.product_class) and obj.stock:
+                self.record(session, {obj.id: obj.stock}, 'initial')
+        for obj in session.dirty:
+            if not isinstance(obj, self.product_class):
+                continue
+            history = inspect(obj).attrs.stock.history
+            if history.added and history.deleted:
+                delta = (history.added[0] or 0) - (history.deleted[0] or 0)
+                if delta:
+                    changes[obj.id] = delta
+        if changes:
+            self.record(session, changes, 'adjust')
+
+    def _write_pending(self, session):
+        # Сначала flush: after_flush может добавить движения из ORM
+        session.flush()
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending:
+            session.connection().execute(self.movements.insert(), pending)
+            metrics.registry.inc('shop_inventory_movements_total', len(pending))
+
+    @staticmethod
+    def _drop_pending(session, previous_transaction):
+        session.info.pop(PENDING_KEY, None)
+
+    def seed_from_stock(self, conn):
+        """Одно движение 'initial' на каждый товар с ненулевым остатком; возвращает их число"""
+        products = self.metadata.tables['product']
+        result = conn.execute(self.movements.insert().from_select(
+            ['product_id', 'delta', 'reason', 'ref_id', 'created_at'],
+            select(products.c.id, products.c.stock, literal('initial'), literal(None), literal(datetime.utcnow()))
+            .where(products.c.stock != 0)
+        ))
+        metrics.registry.inc('shop_inventory_movements_total', result.rowcount)
+        return result.rowcount
+
+    def reconcile(self, conn, fix=False):
+        """Сверяет product.stock с суммой движений по журналу.
+
+        Оба потока читаются упорядоченными по product_id порциями по
+        INVENTORY_RECONCILE_CHUNK строк, так что память не зависит от
+        размера журнала. Возвращает список (product_id, остаток, по журналу).
+        При fix=True расхождения закрываются движениями 'reconcile' -
+        история не переписывается, а остаток считается верным.
+        """
+        products = self.metadata.tables['product']
+        moves = self.movements
+        stream = conn.execution_options(yield_per=self.chunk_size)
+
+        product_rows = stream.execute(select(products.c.id, products.c.stock).order_by(products.c.id))
+        balance_rows = stream.execute(
+            select(moves.c.product_id, func.sum(moves.c.delta))
+            .group_by(moves.c.product_id)
+            .order_by(moves.c.product_id)
+        )
+        discrepancies = [(product_id, stock, balance)
+                         for product_id, stock, balance in _merge_sorted(iter(product_rows), iter(balance_rows))
+                         if stock != balance]
+
+        if fix and discrepancies:
+            now = datetime.utcnow()
+            for start in range(0, len(discrepancies), self.chunk_size):
+                conn.execute(moves.insert(), [
+                    {'product_id': product_id, 'delta': stock - balance, 'reason': 'reconcile',
+                     'ref_id': None, 'created_at': now}
+                    for product_id, stock, balance in discrepancies[start:start + self.chunk_size]
+                ])
+
+        metrics.registry.set_gauge('shop_inventory_discrepancies', 0 if fix else len(discrepancies))
+        return discrepancies
+
+
+inventory = InventoryLedger()
@@ -0,0 +1,364 @@
+"""Фоновые задачи в таблице job той же базы.
+
+Задача ставится enqueue() в транзакции запроса: появляется только после
+commit и пропадает вместе с откатом. Забирает ее воркер (python
+worker.py) одним UPDATE ... WHERE id IN (SELECT ... LIMIT n FOR UPDATE
+SKIP LOCKED) RETURNING: на PostgreSQL параллельные воркеры пропускают
+чужие строки, на SQLite FOR UPDATE не выводится, а сам UPDATE атомарен.
+Забранная задача получает аренду на JOBS_LEASE_SECONDS; если воркер
+упал, по истечении аренды задачу заберет другой.
+
+Обработчик получает соединение в транзакции, в которой задача и
+отмечается выполненной, поэтому изменения в БД применяются ровно один раз.
+attempts увеличивается при каждом захвате и служит меткой владельца:
+если аренду перехватили, отметка не проходит и транзакция откатывается.
+Ошибка - повтор с экспоненциальной задержкой, после max_attempts -
+статус failed (flask jobs-retry возвращает такие задачи в очередь).
+
+Без отдельного воркера (JOBS_INLINE=1) задачи выполняет веб-процесс
+после отправки ответа (response.call_on_close).
+"""
+import os
+import json
+import time
+import random
+import signal
+import socket
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context, request
+from sqlalchemy import select, func, and_, or_
+
+import metrics
+
+
+class LeaseLost(Exception):
+    """Аренду задачи перехватил другой воркер"""
+
+
+class Task:
+
+    def __init__(self, name, func, max_attempts, concurrency, immediate):
+        self.name = name
+        self.func = func
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.immediate = immediate
+
+
+class JobQueue:
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.metadata = None
+        self.engine_getter = None
+        self.tasks = {}
+        self.inline = True
+        self.inline_batch = 10
+        self.inline_poll_interval = 30.0
+        self.concurrency = 4
+        self.poll_interval = 1.0
+        self.lease = 300
+        self.max_attempts = 5
+        self.backoff_base = 5.0
+        self.backoff_max = 3600.0
+        self.retention = timedelta(hours=24)
+        self.purge_interval = 600.0
+        self._inline_lock = threading.Lock()
+        self._last_inline_poll = 0.0
+        self._last_purge = 0.0
+        self._stopping = threading.Event()
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.metadata = db.metadata
+        self.engine_getter = lambda: db.engine
+        self.inline = app.config.get('JOBS_INLINE', True)
+        self.inline_batch = app.config.get('JOBS_INLINE_BATCH', 10)
+        self.inline_poll_interval = app.config.get('JOBS_INLINE_POLL_INTERVAL', 30)
+        self.concurrency = app.config.get('JOBS_CONCURRENCY', 4)
+        self.poll_interval = app.config.get('JOBS_POLL_INTERVAL', 1.0)
+        self.lease = app.config.get('JOBS_LEASE_SECONDS', 300)
+        self.max_attempts = app.config.get('JOBS_MAX_ATTEMPTS', 5)
+        self.backoff_base = app.config.get('JOBS_BACKOFF_BASE', 5.0)
+        self.backoff_max = app.config.get('JOBS_BACKOFF_MAX', 3600.0)
+        self.retention = timedelta(hours=app.config.get('JOBS_RETENTION_HOURS', 24))
+        self.purge_interval = app.config.get('JOBS_PURGE_INTERVAL', 600)
+
+        @app.before_request
+        def update_queue_gauges():
+            # Глубину очереди видно в /metrics любого веб-процесса
+            if request.endpoint == 'metrics':
+                self.update_gauges()
+
+        @app.after_request
+        def run_inline_jobs(response):
+            if not self.inline:
+                return response
+            due = time.time() - self._last_inline_poll > self.inline_poll_interval
+            if g.pop('jobs_enqueued', False) or due:
+                response.call_on_close(self.run_inline)
+            return response
+
+    @property
+    def table(self):
+        return self.metadata.tables['job']
+
+    def _write_engine(self):
+        # Запись в очередь начинается с чтения (подзапрос, проверка attempts) - на SQLite сразу берем блокировку
+        return self.engine_getter().execution_options(sqlite_immediate=True)
+
+    @property
+    def worker_id(self):
+        # pid берется при каждом вызове: воркеры gunicorn получают его после fork
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def task(self, name, max_attempts=None, concurrency=None, immediate=False):
+        """Регистрирует обработчик func(conn, payload).
+
+        concurrency - сколько таких задач одновременно выполняет один
+        процесс-воркер (по умолчанию без отдельного ограничения).
+        immediate - на SQLite начинать транзакцию с BEGIN IMMEDIATE: для
+        задач, которые сначала читают, а потом пишут (иначе параллельный
+        писатель дает "database is locked" без ожидания).
+        """
+        def decorator(func):
+            self.tasks[name] = Task(name, func, max_attempts, concurrency, immediate)
+            return func
+        return decorator
+
+    def enqueue(self, name, payload=None, delay=0, conn=None):
+        """Ставит задачу в транзакции conn (по умолчанию - сессии запроса).
+
+        Задача станет видна воркерам после commit этой транзакции.
+        """
+        if name not in self.tasks:
+            raise ValueError(f'Неизвестная задача: {name}')
+        if conn is None:
+            conn = self.db.session.connection()
+        now = datetime.utcnow()
+        conn.execute(self.table.insert().values(
+            name=name,
+            payload=json.dumps(payload or {}, ensure_ascii=False),
+            status='queued',
+            attempts=0,
+            max_attempts=self.tasks[name].max_attempts or self.max_attempts,
+            run_at=now + timedelta(seconds=delay),
+            created_at=now,
+        ))
+        metrics.registry.inc('shop_jobs_enqueued_total', task=name)
+        if has_request_context():
+            g.jobs_enqueued = True
+
+    def claim(self, limit, exclude=()):
+        """Забирает до limit готовых задач; возвращает строки (id, name, payload, attempts, max_attempts, run_at)"""
+        j = self.table
+        now = datetime.utcnow()
+        due = or_(and_(j.c.status == 'queued', j.c.run_at <= now),
+                  and_(j.c.status == 'running', j.c.locked_until < now))
+        candidates = select(j.c.id).where(due)
+        if exclude:
+            candidates = candidates.where(j.c.name.notin_(list(exclude)))
+        candidates = candidates.order_by(j.c.run_at).limit(limit).with_for_update(skip_locked=True)
+        values = dict(status='running', locked_by=self.worker_id, attempts=j.c.attempts + 1,
+                      locked_until=now + timedelta(seconds=self.lease), started_at=now)
+        columns = (j.c.id, j.c.name, j.c.payload, j.c.attempts, j.c.max_attempts, j.c.run_at)
+
+        with self._write_engine().begin() as conn:
+            if conn.dialect.update_returning:
+                return conn.execute(j.update().where(j.c.id.in_(candidates)).values(**values)
+                                    .returning(*columns)).all()
+            ids = conn.execute(candidates).scalars().all()
+            if not ids:
+                return []
+            conn.execute(j.update().where(j.c.id.in_(ids), due).values(**values))
+            return conn.execute(select(*columns).where(j.c.id.in_(ids), j.c.locked_by == self.worker_id,
+                                                       j.c.started_at == now)).all()
+
+    def release(self, jobs):
+        """Возвращает забранные задачи в очередь, не засчитывая попытку"""
+        j = self.table
+        with self._write_engine().begin() as conn:
+            for job in jobs:
+                conn.execute(j.update().where(j.c.id == job.id, j.c.attempts == job.attempts)
+                             .values(status='queued', attempts=j.c.attempts - 1, locked_by=None, locked_until=None))
+
+    def execute(self, job):
+        """Выполняет забранную задачу; вызывать в контексте приложения"""
+        j = self.table
+        task = self.tasks.get(job.name)
+        started = time.perf_counter()
+        metrics.registry.inc('shop_job_wait_seconds_total',
+                             max(0.0, (datetime.utcnow() - job.run_at).total_seconds()), task=job.name)
+        try:
+            if task is None:
+                raise LookupError(f'Неизвестная задача: {job.name}')
+            engine = self.engine_getter()
+            if task.immediate:
+                engine = engine.execution_options(sqlite_immediate=True)
+            with engine.begin() as conn:
+                task.func(conn, json.loads(job.payload or '{}'))
+                # Отметка в той же транзакции, attempts - метка владельца аренды
+                result = conn.execute(j.update().where(j.c.id == job.id, j.c.attempts == job.attempts)
+                                      .values(status='done', finished_at=datetime.utcnow(), last_error=None,
+                                              locked_by=None, locked_until=None))
+                if result.rowcount == 0:
+                    raise LeaseLost(job.id)
+            outcome = 'done'
+        except LeaseLost:
+            self.app.logger.warning(f'Задачу #{job.id} ({job.name}) перехватил другой воркер')
+            outcome = 'lease_lost'
+        except Exception as e:
+            outcome = self._fail(job, e)
+        duration = time.perf_counter() - started
+        metrics.registry.inc('shop_jobs_total', task=job.name, outcome=outcome)
+        metrics.registry.inc('shop_job_run_seconds_total', duration, task=job.name)
+        return outcome
+
+    def _fail(self, job, error):
+        j = self.table
+        now = datetime.utcnow()
+        values = dict(last_error=f'{type(error).__name__}: {error}'[:2000], locked_by=None, locked_until=None)
+        if job.attempts >= job.max_attempts:
+            values.update(status='failed', finished_at=now)
+            outcome = 'failed'
+            self.app.logger.error(f'Задача #{job.id} ({job.name}) не выполнена после {job.attempts} попыток: {error}')
+        else:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (job.attempts - 1))
+            values.update(status='queued', run_at=now + timedelta(seconds=delay * random.uniform(0.8, 1.2)))
+            outcome = 'retry'
+            self.app.logger.warning(f'Задача #{job.id} ({job.name}), попытка {job.attempts}: {error}')
+        with self._write_engine().begin() as conn:
+            conn.execute(j.update().where(j.c.id == job.id, j.c.attempts == job.attempts).values(**values))
+        return outcome
+
+    def run_inline(self):
+        """Пачка задач в веб-процессе после отправки ответа"""
+        if not self._inline_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_inline_poll = time.time()
+            with self.app.app_context():
+                for job in self.claim(self.inline_batch):
+                    self.execute(job)
+                # Без отдельного воркера (JOBS_INLINE) старые задачи чистит веб-процесс
+                if time.time() - self._last_purge > self.purge_interval:
+                    self._last_purge = time.time()
+                    self.purge()
+        except Exception as e:
+            self.app.logger.error(f'Ошибка фоновых задач: {e}')
+        finally:
+            self._inline_lock.release()
+
+    def _run_in_context(self, job):
+        with self.app.app_context():
+            return self.execute(job)
+
+    def run_worker(self, concurrency=None, once=False):
+        """Цикл воркера: держит до concurrency задач в потоках, пока не придет SIGTERM/SIGINT"""
+        concurrency = concurrency or self.concurrency
+        running = {}
+        per_task = Counter()
+        last_maintenance = 0.0
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: self._stopping.set())
+
+        print(f'🛠️  Воркер {self.worker_id}: {concurrency} потоков, задачи: {", ".join(sorted(self.tasks))}')
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while not self._stopping.is_set():
+                if time.time() - last_maintenance > 60:
+                    last_maintenance = time.time()
+                    with self.app.app_context():
+                        self.update_gauges()
+                        self.purge()
+
+                claimed = []
+                free = concurrency - len(running)
+                if free > 0:
+                    full = [name for name, task in self.tasks.items()
+                            if task.concurrency and per_task[name] >= task.concurrency]
+                    try:
+                        with self.app.app_context():
+                            claimed = self.claim(free, exclude=full)
+                    except Exception as e:
+                        self.app.logger.error(f'Не удалось забрать задачи: {e}')
+
+                extra = []
+                for job in claimed:
+                    task = self.tasks.get(job.name)
+                    if task and task.concurrency and per_task[job.name] >= task.concurrency:
+                        extra.append(job)
+                        continue
+                    per_task[job.name] += 1
+                    running[pool.submit(self._run_in_context, job)] = job.name
+                if extra:
+                    with self.app.app_context():
+                        self.release(extra)
+
+                if once and not running:
+                    break
+                if running:
+                    done, _ = wait(running, timeout=self.poll_interval if not claimed else 0,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        per_task[running.pop(future)] -= 1
+                elif not claimed:
+                    self._stopping.wait(self.poll_interval)
+
+            for future in list(running):
+                future.result()
+        print(f'👋 Воркер {self.worker_id} остановлен')
+
+    def stats(self, conn):
+        """{(задача, статус): количество}"""
+        j = self.table
+        rows = conn.execute(select(j.c.name, j.c.status, func.count()).group_by(j.c.name, j.c.status))
+        return {(name, status): count for name, status, count in rows}
+
+    def update_gauges(self):
+        j = self.table
+        try:
+            with self.engine_getter().connect() as conn:
+                depth = Counter()
+                for (name, status), count in self.stats(conn).items():
+                    depth[status] += count
+                oldest = conn.execute(select(func.min(j.c.run_at))
+                                      .where(j.c.status == 'queued', j.c.run_at <= datetime.utcnow())).scalar()
+        except Exception as e:
+            self.app.logger.error(f'Не удалось прочитать очередь задач: {e}')
+            return
+        for status in ('queued', 'running', 'failed'):
+            metrics.registry.set_gauge('shop_job_queue_depth', depth[status], status=status)
+        age = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+        metrics.registry.set_gauge('shop_job_oldest_due_seconds', max(0.0, age))
+
+    def purge(self, batch_size=1000):
+        """Удаляет выполненные задачи старше JOBS_RETENTION_HOURS пачками; failed остаются"""
+        j = self.table
+        cutoff = datetime.utcnow() - self.retention
+        removed = 0
+        while True:
+            with self._write_engine().begin() as conn:
+                ids = select(j.c.id).where(j.c.status == 'done', j.c.finished_at < cutoff).limit(batch_size)
+                count = conn.execute(j.delete().where(j.c.id.in_(ids))).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+
+    def retry_failed(self, conn, name=None):
+        """Возвращает задачи failed в очередь с новым запасом попыток"""
+        j = self.table
+        query = j.update().where(j.c.status == 'failed')
+        if name:
+            query = query.where(j.c.name == name)
+        return conn.execute(query.values(status='queued', attempts=0, run_at=datetime.utcnow(),
+                                         finished_at=None)).rowcount
+
+
+job_queue = JobQueue()
@@ -0,0 +1,126 @@
+"""Обслуживание: очистка брошенных корзин, уплотнение таблиц, сборка мусора в загрузках.
+
+Задачи рассчитаны на запуск из cron через CLI (flask cleanup-carts).
+Удаление идет пачками по индексу added_at, каждая пачка - отдельная
+короткая транзакция, поэтому таблица не блокируется надолго и
+оформление заказов параллельно не страдает.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+
+import metrics
+from images import source_filename
+
+
+def cleanup_stale_carts(engine, cart_table, max_age_days=30, batch_size=1000, pause=0.0):
+    """Удаляет корзины, в которые ничего не добавляли дольше max_age_days.
+
+    Корзина считается брошенной целиком: строки пользователя, у которого есть
+    свежие добавления, не трогаются. Возвращает число удаленных строк.
+    """
+    t = cart_table
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    active_users = select(t.c.user_id).where(t.c.added_at >= cutoff)
+    removed = 0
+
+    while True:
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(
+                select(t.c.id)
+                .where(t.c.added_at < cutoff, t.c.user_id.notin_(active_users))
+                .order_by(t.c.added_at)
+                .limit(batch_size)
+            )]
+            if not ids:
+                break
+            conn.execute(t.delete().where(t.c.id.in_(ids)))
+        removed += len(ids)
+        if len(ids) < batch_size:
+            break
+        # Пауза между пачками оставляет окно для конкурирующих записей
+        if pause:
+            time.sleep(pause)
+
+    if removed:
+        metrics.registry.inc('shop_stale_cart_rows_removed_total', removed)
+    return removed
+
+
+def compact_table(engine, table_name, vacuum=False):
+    """Обновляет статистику планировщика, а при vacuum=True еще и возвращает место на диске.
+
+    В SQLite VACUUM переписывает весь файл базы и блокирует ее на время работы,
+    поэтому по умолчанию выполняется только ANALYZE.
+    """
+    dialect = engine.dialect.name
+    quoted = engine.dialect.identifier_preparer.quote(table_name)
+
+    if dialect == 'postgresql':
+        # VACUUM не работает внутри транзакции
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text(f'VACUUM ANALYZE {quoted}' if vacuum else f'ANALYZE {quoted}'))
+    elif dialect == 'mysql':
+        with engine.begin() as conn:
+            conn.execute(text(f'OPTIMIZE TABLE {quoted}' if vacuum else f'ANALYZE TABLE {quoted}'))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text(f'ANALYZE {quoted}'))
+        if vacuum:
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM'))
+
+
+def collect_orphan_images(engine, product_table, folder, batch_size=1000, min_age=3600, dry_run=False):
+    """Удаляет файлы изображений, на которые не ссылается ни один товар.
+
+    Папка читается потоково (os.scandir) пачками по batch_size имен; на
+    пачку - один запрос product.image_filename IN (...). Уменьшенная копия
+    живет, пока жив ее исходник. Файлы моложе min_age секунд не трогаются:
+    их могли только что загрузить для товара, который еще не сохранен.
+    Возвращает (удалено файлов, освобождено байт).
+    """
+    t = product_table
+    now = time.time()
+    removed = 0
+    reclaimed = 0
+
+    def sweep(batch):
+        nonlocal removed, reclaimed
+        sources = {source_filename(entry.name) for entry in batch}
+        with engine.connect() as conn:
+            referenced = {row[0] for row in conn.execute(
+                select(t.c.image_filename).where(t.c.image_filename.in_(list(sources)))
+            )}
+        for entry in batch:
+            if source_filename(entry.name) in referenced:
+                continue
+            try:
+                stat = entry.stat()
+                if now - stat.st_mtime < min_age:
+                    continue
+                if not dry_run:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+
+    batch = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                sweep(batch)
+                batch = []
+    if batch:
+        sweep(batch)
+
+    if removed and not dry_run:
+        metrics.registry.inc('shop_orphan_images_removed_total', removed)
+        metrics.registry.inc('shop_orphan_image_bytes_reclaimed_total', reclaimed)
+    return removed, reclaimed
@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import defaultdict, deque
+
+from flask import g, request, has_request_context, template_rendered, before_render_template, Response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Границы гистограммы времени ответа (в секундах)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _Histogram:
+    """Простая кумулятивная гистограмма в формате Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """Хранилище метрик текущего процесса.
+
+    У каждого воркера gunicorn свой экземпляр. Если задан multiproc_dir
+    (METRICS_MULTIPROC_DIR), фоновый поток воркера раз в flush_interval
+    секунд пишет изменившееся состояние в <pid>.json этого каталога, а /metrics складывает файлы всех
+    воркеров: счетчики и гистограммы суммируются (в том числе завершившихся
+    воркеров, чтобы счетчики не убывали), gauge - с меткой worker только по
+    живым процессам. Без каталога /metrics отдает метрики одного воркера.
+    """
+
+    def __init__(self, slow_log_size=100):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.request_latency = defaultdict(_Histogram)
+        self.sql_queries = defaultdict(int)
+        self.sql_time = defaultdict(float)
+        self.template_time = defaultdict(float)
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.multiproc_dir = None
+        self.flush_interval = 1.0
+        self._changes = 0
+        self._writer_pid = None
+
+    def record_request(self, endpoint, method, status, duration, sql_count, sql_time, template_time):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.request_latency[endpoint].observe(duration)
+            self.sql_queries[endpoint] += sql_count
+            self.sql_time[endpoint] += sql_time
+            self.template_time[endpoint] += template_time
+            self._changes += 1
+
+    def record_slow_query(self, endpoint, statement, duration):
+        with self._lock:
+            self.slow_queries.append({
+                'endpoint': endpoint,
+                'statement': statement,
+                'duration_ms': round(duration * 1000, 2),
+                'at': time.time()
+            })
+            self._changes += 1
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает произвольный счетчик (для других подсистем)"""
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+            self._changes += 1
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+            self._changes += 1
+
+    # ---- общий каталог воркеров ----
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.request_latency.clear()
+            self.sql_queries.clear()
+            self.sql_time.clear()
+            self.template_time.clear()
+            self.slow_queries.clear()
+            self.counters.clear()
+            self.gauges.clear()
+            self._changes += 1
+
+    def state(self):
+        """Состояние процесса в виде, пригодном для JSON"""
+        with self._lock:
+            return {
+                'requests': [[*key, value] for key, value in self.requests.items()],
+                'latency': [[endpoint, hist.counts, hist.total, hist.count]
+                            for endpoint, hist in self.request_latency.items()],
+                'sql_queries': dict(self.sql_queries),
+                'sql_time': dict(self.sql_time),
+                'template_time': dict(self.template_time),
+                'slow_queries': len(self.slow_queries),
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+            }
+
+    def write_state(self):
+        """Пишет состояние процесса в <pid>.json каталога multiproc_dir"""
+        if not self.multiproc_dir:
+            return
+        path = os.path.join(self.multiproc_dir, f'{os.getpid()}.json')
+        # Запись через временный файл: читатель не увидит половину JSON
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(tmp, path)
+
+    def start_writer(self):
+        """Запускает в текущем процессе поток, сохраняющий изменения раз в flush_interval"""
+        if not self.multiproc_dir or self._writer_pid == os.getpid():
+            return
+        self._writer_pid = os.getpid()
+        threading.Thread(target=self._write_loop, name='metrics-writer', daemon=True).start()
+
+    def _write_loop(self):
+        written = None
+        while True:
+            time.sleep(self.flush_interval)
+            if self._changes == written:
+                continue
+            written = self._changes
+            try:
+                self.write_state()
+            except OSError:
+                pass
+
+    def _collect(self):
+        """Состояния всех воркеров: [(pid, state, жив ли процесс)]"""
+        if not self.multiproc_dir:
+            return [(os.getpid(), self.state(), True)]
+        self.write_state()
+        states = []
+        for name in os.listdir(self.multiproc_dir):
+            if not name.endswith('.json'):
+                continue
+            pid = int(name[:-5])
+            try:
+                with open(os.path.join(self.multiproc_dir, name)) as f:
+                    states.append((pid, json.load(f), _pid_alive(pid)))
+            except (OSError, ValueError):
+                continue
+        return states
+
+    def render(self):
+        """Формирует текст в формате Prometheus exposition"""
+        requests = defaultdict(int)
+        latency = {}
+        sql_queries = defaultdict(int)
+        sql_time = defaultdict(float)
+        template_time = defaultdict(float)
+        slow_queries = 0
+        counters = defaultdict(float)
+        gauges = {}
+        multiprocess = bool(self.multiproc_dir)
+
+        for pid, state, alive in self._collect():
+            for endpoint, method, status, value in state['requests']:
+                requests[(endpoint, method, status)] += value
+            for endpoint, counts, total, count in state['latency']:
+                hist = latency.setdefault(endpoint, _Histogram())
+                hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                hist.total += total
+                hist.count += count
+            for target, source in ((sql_queries, 'sql_queries'), (sql_time, 'sql_time'),
+                                   (template_time, 'template_time')):
+                for endpoint, value in state[source].items():
+                    target[endpoint] += value
+            slow_queries += state['slow_queries']
+            for name, labels, value in state['counters']:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            # Gauge - мгновенное значение процесса: у завершившихся воркеров его нет
+            if alive:
+                for name, labels, value in state['gauges']:
+                    labels = tuple(map(tuple, labels))
+                    if multiprocess:
+                        labels += (('worker', pid),)
+                    gauges[(name, labels)] = value
+
+        lines = ['# TYPE shop_http_requests_total counter']
+        for (endpoint, method, status), value in sorted(requests.items()):
+            lines.append(f'shop_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {value}')
+
+        lines.append('# TYPE shop_http_request_duration_seconds histogram')
+        for endpoint, hist in sorted(latency.items()):
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'shop_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'shop_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {hist.count}')
+            lines.append(f'shop_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {hist.total:.6f}')
+            lines.append(f'shop_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {hist.count}')
+
+        lines.append('# TYPE shop_sql_queries_total counter')
+        for endpoint, value in sorted(sql_queries.items()):
+            lines.append(f'shop_sql_queries_total{{endpoint="{endpoint}"}} {value}')
+
+        lines.append('# TYPE shop_sql_duration_seconds_total counter')
+        for endpoint, value in sorted(sql_time.items()):
+            lines.append(f'shop_sql_duration_seconds_total{{endpoint="{endpoint}"}} {value:.6f}')
+
+        lines.append('# TYPE shop_template_render_seconds_total counter')
+        for endpoint, value in sorted(template_time.items()):
+            lines.append(f'shop_template_render_seconds_total{{endpoint="{endpoint}"}} {value:.6f}')
+
+        lines.append('# TYPE shop_sql_slow_queries_logged gauge')
+        lines.append(f'shop_sql_slow_queries_logged {slow_queries}')
+
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), value in sorted(gauges.items()):
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+registry = MetricsRegistry()
+
+
+def _current_endpoint():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+
+def init_app(app):
+    """Подключает инструментирование запросов, SQL и шаблонов к приложению"""
+    slow_threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS', 200) / 1000.0
+    slow_request_threshold = app.config.get('SLOW_REQUEST_THRESHOLD_MS', 1000) / 1000.0
+
+    registry.multiproc_dir = app.config.get('METRICS_MULTIPROC_DIR')
+    registry.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 1.0)
+    if registry.multiproc_dir:
+        os.makedirs(registry.multiproc_dir, exist_ok=True)
+        # Последние значения завершающегося воркера остаются в сумме счетчиков
+        atexit.register(registry.write_state)
+        # С preload_app воркер получает копию метрик мастера: мастер сохраняет их в
+        # свой файл, а воркер начинает с нуля, иначе они сложились бы по разу на воркер
+        os.register_at_fork(before=registry.write_state, after_in_child=registry.reset)
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start_time'].pop()
+
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_sql_count += 1
+            g.metrics_sql_time += duration
+
+        if duration >= slow_threshold:
+            endpoint = _current_endpoint()
+            registry.record_slow_query(endpoint, statement, duration)
+            app.logger.warning(f'Медленный запрос ({duration * 1000:.1f} мс) в {endpoint}: {statement}')
+
+    # render_template внутри рендеринга (макрос, фильтр, вложенный вызов) не должен
+    # затирать начало внешнего: храним стек и считаем только время внешнего шаблона
+    def _on_before_render(sender, template, context, **extra):
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_template_stack.append(time.perf_counter())
+
+    def _on_rendered(sender, template, context, **extra):
+        if has_request_context() and g.get('metrics_template_stack'):
+            started = g.metrics_template_stack.pop()
+            if not g.metrics_template_stack:
+                g.metrics_template_time += time.perf_counter() - started
+
+    before_render_template.connect(_on_before_render, app, weak=False)
+    template_rendered.connect(_on_rendered, app, weak=False)
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_time = 0.0
+        g.metrics_template_time = 0.0
+        g.metrics_template_stack = []
+
+    @app.after_request
+    def _record_request(response):
+        if 'metrics_start' not in g:
+            return response
+        registry.start_writer()
+
+        duration = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unknown'
+
+        # Статику и сам /metrics не учитываем, чтобы не засорять дашборды
+        if endpoint not in ('static', 'metrics'):
+            registry.record_request(endpoint, request.method, response.status_code, duration,
+                                    g.metrics_sql_count, g.metrics_sql_time, g.metrics_template_time)
+
+            if duration >= slow_request_threshold:
+                app.logger.warning(
+                    f'Медленный запрос {request.method} {request.path} ({endpoint}): '
+                    f'{duration * 1000:.1f} мс, SQL: {g.metrics_sql_count} шт. / {g.metrics_sql_time * 1000:.1f} мс, '
+                    f'шаблоны: {g.metrics_template_time * 1000:.1f} мс'
+                )
+
+        if _server_timing_allowed():
+            response.headers['Server-Timing'] = (
+                f'app;dur={duration * 1000:.1f}, '
+                f'db;dur={g.metrics_sql_time * 1000:.1f};desc="{g.metrics_sql_count} queries", '
+                f'tpl;dur={g.metrics_template_time * 1000:.1f}'
+            )
+        return response
+
+    def _server_timing_allowed():
+        # Время БД и шаблонов помогает подбирать запросы под медленные места -
+        # показываем его только администраторам, в debug или явно (бенчмарки)
+        if app.debug or app.config.get('SERVER_TIMING_PUBLIC'):
+            return True
+        return current_user.is_authenticated and current_user.is_admin
+
+    def _metrics_allowed():
+        token = app.config.get('METRICS_TOKEN')
+        if token:
+            return request.headers.get('Authorization') == f'Bearer {token}'
+        # Без токена /metrics доступен только администратору
+        return current_user.is_authenticated and current_user.is_admin
+
+    if app.config.get('METRICS_ENABLED', True):
+        @app.route('/metrics')
+        def metrics():
+            """Экспорт метрик в формате Prometheus"""
+            if not _metrics_allowed():
+                return Response('Forbidden\n', status=403, mimetype='text/plain')
+            return Response(registry.render(), mimetype='text/plain; version=0.0.4')
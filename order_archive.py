@@ -0,0 +1,181 @@
+"""Архив завершенных заказов.
+
+Заказы в конечном статусе (delivered, cancelled) старше ORDER_ARCHIVE_MONTHS
+переносятся из order/order_item в order_archive/order_item_archive пачками:
+каждая пачка - отдельная транзакция INSERT ... SELECT + DELETE, так что
+рабочие таблицы, по которым строятся списки и поиск в админке, остаются
+маленькими, а перенос не держит блокировки подолгу.
+
+На PostgreSQL архивные таблицы секционированы по месяцам (PARTITION BY
+RANGE по created_at заказа); секции создаются перед вставкой пачки.
+Поэтому created_at заказа входит в первичные ключи архивных таблиц, а
+строки заказа хранят его копию order_created_at: запрос за период читает
+только свои секции. На других СУБД это обычные таблицы с индексами.
+
+Идентификаторы при переносе сохраняются; читать заказ по id из рабочей
+таблицы или архива - find_order в app.py. Поэтому id заказов не должны
+повторяться: на SQLite таблица order создается с AUTOINCREMENT (без него
+новые id выдаются от максимального оставшегося и после удаления последних
+заказов совпали бы с архивными), старые базы перестраивает
+ensure_monotonic_ids.
+"""
+import time
+from datetime import datetime
+
+from sqlalchemy import select, func, literal, DateTime, text, event
+from sqlalchemy.schema import CreateTable
+
+import metrics
+
+ARCHIVE_STATUSES = ('delivered', 'cancelled')
+
+
+def months_ago(months, now=None):
+    """Начало дня ровно months месяцев назад (день месяца обрезается до 28)"""
+    now = now or datetime.utcnow()
+    month_index = now.year * 12 + now.month - 1 - months
+    return datetime(month_index // 12, month_index % 12 + 1, min(now.day, 28))
+
+
+def month_bounds(moment):
+    start = datetime(moment.year, moment.month, 1)
+    end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def partition_by_range(table, column_name):
+    """PARTITION BY RANGE (column_name) в CREATE TABLE на PostgreSQL.
+
+    Задается при создании таблицы, а не через postgresql_partition_by в
+    __table_args__: такой аргумент заставляет SQLAlchemy импортировать
+    диалект PostgreSQL при импорте моделей на любой базе.
+    """
+    @event.listens_for(table, 'before_create')
+    def set_partitioning(target, connection, **kw):
+        if connection.dialect.name == 'postgresql':
+            target.dialect_options['postgresql']['partition_by'] = f'RANGE ({column_name})'
+
+
+def ensure_partitions(conn, table_names, moments):
+    """Создает месячные секции архивных таблиц под даты moments (только PostgreSQL)"""
+    if conn.dialect.name != 'postgresql':
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    for start, end in sorted({month_bounds(moment) for moment in moments}):
+        for table_name in table_names:
+            partition = f'{table_name}_{start:%Y_%m}'
+            conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS {quote(partition)} PARTITION OF {quote(table_name)} '
+                f"FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')"
+            ))
+
+
+def has_monotonic_ids(conn, table):
+    """False, если на SQLite таблица создана без AUTOINCREMENT и id могут выдаваться повторно"""
+    if conn.dialect.name != 'sqlite':
+        return True
+    sql = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+    ).scalar()
+    return sql is None or 'AUTOINCREMENT' in sql.upper()
+
+
+def ensure_monotonic_ids(engine, table, archive):
+    """Перестраивает на SQLite таблицу table с AUTOINCREMENT, если она создана без него.
+
+    SQLite не умеет добавить AUTOINCREMENT к существующей таблице: строки
+    переносятся в новую таблицу в одной транзакции. Счетчик id ставится
+    не ниже максимального id и в таблице, и в архиве. Возвращает True,
+    если таблица перестроена.
+    """
+    with engine.connect() as conn:
+        if has_monotonic_ids(conn, table):
+            return False
+
+    quote = engine.dialect.identifier_preparer.quote
+    old_name = f'{table.name}_old'
+    columns = ', '.join(quote(c.name) for c in table.columns)
+    with engine.begin() as conn:
+        # Старое поведение RENAME: ссылки внешних ключей других таблиц остаются на имени table
+        conn.exec_driver_sql('PRAGMA legacy_alter_table = ON')
+        conn.exec_driver_sql(f'ALTER TABLE {quote(table.name)} RENAME TO {quote(old_name)}')
+        conn.execute(CreateTable(table))
+        conn.exec_driver_sql(
+            f'INSERT INTO {quote(table.name)} ({columns}) SELECT {columns} FROM {quote(old_name)}'
+        )
+        conn.exec_driver_sql(f'DROP TABLE {quote(old_name)}')
+        for index in table.indexes:
+            index.create(conn)
+        last_id = max(conn.execute(select(func.max(table.c.id))).scalar() or 0,
+                      conn.execute(select(func.max(archive.c.id))).scalar() or 0)
+        conn.execute(text('DELETE FROM sqlite_sequence WHERE name = :name'), {'name': table.name})
+        conn.execute(text('INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)'),
+                     {'name': table.name, 'seq': last_id})
+        conn.exec_driver_sql('PRAGMA legacy_alter_table = OFF')
+    return True
+
+
+def archive_orders(engine, metadata, cutoff, statuses=ARCHIVE_STATUSES, batch_size=500, pause=0.0,
+                   max_batches=None):
+    """Переносит завершенные заказы, созданные раньше cutoff, в архив.
+
+    Возвращает (заказов, строк заказов). На SQLite без AUTOINCREMENT у
+    таблицы order отказывается работать (RuntimeError): id архивных заказов
+    были бы выданы заново.
+    """
+    orders = metadata.tables['order']
+    items = metadata.tables['order_item']
+    archive = metadata.tables['order_archive']
+    item_archive = metadata.tables['order_item_archive']
+    order_columns = [c.name for c in orders.columns if c.name in archive.c]
+    item_columns = [c.name for c in items.columns if c.name in item_archive.c]
+
+    with engine.connect() as conn:
+        if not has_monotonic_ids(conn, orders):
+            raise RuntimeError('Таблица order создана без AUTOINCREMENT: id архивных заказов могут '
+                               'повториться. Перезапустите приложение, чтобы выполнить миграцию.')
+
+    # На SQLite пачка начинается с чтения и продолжается записью - блокировку берем сразу
+    engine = engine.execution_options(sqlite_immediate=True)
+    moved_orders = moved_items = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(orders.c.id, orders.c.created_at)
+                .where(orders.c.created_at < cutoff, orders.c.status.in_(statuses))
+                .order_by(orders.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                break
+            ids = [row.id for row in rows]
+            ensure_partitions(conn, (archive.name, item_archive.name), [row.created_at for row in rows])
+
+            now = datetime.utcnow()
+            conn.execute(archive.insert().from_select(
+                order_columns + ['archived_at'],
+                select(*[orders.c[name] for name in order_columns], literal(now, DateTime))
+                .where(orders.c.id.in_(ids))
+            ))
+            moved_items += conn.execute(item_archive.insert().from_select(
+                item_columns + ['order_created_at'],
+                select(*[items.c[name] for name in item_columns], orders.c.created_at)
+                .select_from(items.join(orders, orders.c.id == items.c.order_id))
+                .where(items.c.order_id.in_(ids))
+            )).rowcount
+            conn.execute(items.delete().where(items.c.order_id.in_(ids)))
+            conn.execute(orders.delete().where(orders.c.id.in_(ids)))
+
+        moved_orders += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        # Пауза между пачками оставляет окно для оформления заказов
+        if pause:
+            time.sleep(pause)
+
+    if moved_orders:
+        metrics.registry.inc('shop_orders_archived_total', moved_orders)
+    return moved_orders, moved_items
@@ -0,0 +1,241 @@
+"""Счетчики просмотров и добавлений в корзину с отложенной записью.
+
+Каждый воркер копит приращения в памяти и раз в POPULARITY_FLUSH_INTERVAL
+секунд (или при POPULARITY_FLUSH_MAX_KEYS разных товаров) сбрасывает их
+в product_stats одной транзакцией: пакетный UPDATE существующих строк и
+пакетный INSERT новых.
+
+Популярность затухает экспоненциально с периодом полураспада
+POPULARITY_HALF_LIFE_HOURS. Чтобы не пересчитывать все строки, вес события
+хранится приведенным к эпохе: w * 2^((t - epoch) / half_life). Тогда порядок
+по score совпадает с порядком по затухшей популярности в любой момент, и
+сортировку обслуживает обычный индекс по score.
+
+Множитель растет вдвое за период полураспада и через ~1024 периода вышел бы
+за пределы float (при суточном периоде - меньше чем через три года). Поэтому
+эпоха не фиксирована: она хранится в cache_version (строка popularity_epoch,
+без нее - EPOCH), и когда от нее проходит REBASE_AFTER периодов, сброс
+счетчиков умножает все score на 2^(-прошедших периодов) и переносит эпоху на
+текущий момент. Сброс идет под блокировкой записи, так что все воркеры
+видят одну эпоху.
+"""
+import atexit
+import random
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select, bindparam
+
+import metrics
+
+EPOCH = datetime(2024, 1, 1)
+EPOCH_KEY = 'popularity_epoch'
+# Через столько периодов полураспада score приводятся к новой эпохе: множитель не больше 2^64
+REBASE_AFTER = 64
+
+
+class PopularityCounters:
+
+    def __init__(self):
+        self.metadata = None
+        self.engine_getter = None
+        self.logger = None
+        self.flush_interval = 30.0
+        self.flush_max_keys = 1000
+        self.half_life = 7 * 24 * 3600.0
+        self.view_weight = 1.0
+        self.cart_weight = 5.0
+        self.epoch = EPOCH
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def init_app(self, app, db):
+        self.metadata = db.metadata
+        self.engine_getter = lambda: db.engine
+        self.logger = app.logger
+        self.flush_interval = app.config.get('POPULARITY_FLUSH_INTERVAL', 30)
+        self.flush_max_keys = app.config.get('POPULARITY_FLUSH_MAX_KEYS', 1000)
+        self.half_life = app.config.get('POPULARITY_HALF_LIFE_HOURS', 168) * 3600.0
+        self.view_weight = app.config.get('POPULARITY_VIEW_WEIGHT', 1.0)
+        self.cart_weight = app.config.get('POPULARITY_CART_WEIGHT', 5.0)
+
+        @app.after_request
+        def flush_if_due(response):
+            self.maybe_flush()
+            return response
+
+        # Остаток буфера при остановке воркера (gunicorn вызывает atexit при штатном выходе)
+        atexit.register(self._flush_at_exit, app)
+
+    @property
+    def table(self):
+        return self.metadata.tables['product_stats']
+
+    def growth(self, at=None, epoch=None):
+        """Множитель веса события в момент at относительно эпохи"""
+        at = at or datetime.utcnow()
+        return 2.0 ** ((at - (epoch or self.epoch)).total_seconds() / self.half_life)
+
+    def decayed(self, score, at=None):
+        """Затухшая популярность на момент at из сохраненного score"""
+        return (score or 0.0) / self.growth(at)
+
+    def _add(self, product_id, views, cart_adds):
+        with self._lock:
+            counts = self.pending.get(product_id)
+            if counts is None:
+                counts = self.pending[product_id] = [0, 0]
+            counts[0] += views
+            counts[1] += cart_adds
+
+    def record_view(self, product_id):
+        self._add(product_id, 1, 0)
+
+    def record_cart_add(self, product_id, quantity=1):
+        self._add(product_id, 0, quantity)
+
+    def maybe_flush(self):
+        if not self.pending:
+            return
+        if (time.monotonic() - self.last_flush < self.flush_interval
+                and len(self.pending) < self.flush_max_keys):
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            self.logger.error(f'Ошибка записи счетчиков популярности: {e}')
+
+    def flush(self, connection=None):
+        """Сбрасывает накопленные приращения; возвращает число обновленных товаров"""
+        # Второй поток воркера не ждет, а оставляет сброс тому, кто уже пишет
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+                self.last_flush = time.monotonic()
+            if not pending:
+                return 0
+
+            try:
+                if connection is not None:
+                    return self._write(connection, pending)
+                # Эпоха читается и, возможно, переносится в той же транзакции - блокировку берем сразу
+                with self.engine_getter().execution_options(sqlite_immediate=True).begin() as conn:
+                    return self._write(conn, pending)
+            except Exception:
+                # Возвращаем приращения в буфер, чтобы не потерять их до следующей попытки
+                for product_id, (views, cart_adds) in pending.items():
+                    self._add(product_id, views, cart_adds)
+                raise
+        finally:
+            self._flush_lock.release()
+
+    def _write(self, conn, pending):
+        t = self.table
+        products = self.metadata.tables['product']
+        now = datetime.utcnow()
+        epoch = self._epoch(conn)
+        if (now - epoch).total_seconds() / self.half_life >= REBASE_AFTER:
+            self._rebase(conn, epoch, now)
+            epoch = now
+        self.epoch = epoch
+        growth = self.growth(now, epoch)
+
+        ids = list(pending)
+        existing = set()
+        known = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = conn.execute(
+                select(products.c.id, t.c.product_id)
+                .select_from(products.outerjoin(t, t.c.product_id == products.c.id))
+                .where(products.c.id.in_(chunk))
+            )
+            for product_id, stats_id in rows:
+                known.add(product_id)
+                if stats_id is not None:
+                    existing.add(product_id)
+
+        def params(product_id):
+            views, cart_adds = pending[product_id]
+            return {
+                'pid': product_id, 'views': views, 'cart_adds': cart_adds,
+                'score': (views * self.view_weight + cart_adds * self.cart_weight) * growth,
+                'now': now,
+            }
+
+        updates = [params(product_id) for product_id in ids if product_id in existing]
+        if updates:
+            conn.execute(
+                t.update()
+                .where(t.c.product_id == bindparam('pid'))
+                .values(views=t.c.views + bindparam('views'),
+                        cart_adds=t.c.cart_adds + bindparam('cart_adds'),
+                        score=t.c.score + bindparam('score'),
+                        updated_at=bindparam('now')),
+                updates
+            )
+
+        # Удаленные товары пропускаем
+        inserts = [params(product_id) for product_id in ids if product_id in known and product_id not in existing]
+        if inserts:
+            conn.execute(t.insert(), [
+                {'product_id': p['pid'], 'views': p['views'], 'cart_adds': p['cart_adds'],
+                 'score': p['score'], 'updated_at': p['now']}
+                for p in inserts
+            ])
+        metrics.registry.inc('shop_popularity_flushed_total', len(updates) + len(inserts))
+        return len(updates) + len(inserts)
+
+    def _epoch(self, conn):
+        versions = self.metadata.tables['cache_version']
+        row = conn.execute(
+            select(versions.c.updated_at).where(versions.c.name == EPOCH_KEY).with_for_update()
+        ).first()
+        return row.updated_at if row and row.updated_at else EPOCH
+
+    def _rebase(self, conn, epoch, now):
+        """Приводит все score к эпохе now: порядок и пропорции не меняются"""
+        t = self.table
+        versions = self.metadata.tables['cache_version']
+        # Для очень старой эпохи множитель уходит в 0 - это и есть полностью затухшая популярность
+        factor = 2.0 ** (-(now - epoch).total_seconds() / self.half_life)
+        conn.execute(t.update().values(score=t.c.score * factor))
+        result = conn.execute(
+            versions.update().where(versions.c.name == EPOCH_KEY)
+            .values(version=versions.c.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            conn.execute(versions.insert().values(name=EPOCH_KEY, version=1, updated_at=now))
+        metrics.registry.inc('shop_popularity_rebases_total')
+        self.logger.info(f'Популярность приведена к эпохе {now:%Y-%m-%d %H:%M} (множитель {factor:.3g})')
+
+    def weighted_sample(self, conn, count, pool=50):
+        """count товаров из pool самых популярных, с вероятностью пропорционально популярности"""
+        t = self.table
+        rows = conn.execute(
+            select(t.c.product_id, t.c.score).where(t.c.score > 0).order_by(t.c.score.desc()).limit(pool)
+        ).all()
+        if not rows:
+            return []
+        # Взвешенная выборка без возвращения (Efraimidis-Spirakis): ключ u^(1/w), веса относительно лидера
+        top_score = rows[0].score
+        keyed = ((random.random() ** (top_score / score), product_id) for product_id, score in rows)
+        return [product_id for _, product_id in heapq.nlargest(count, keyed)]
+
+    def _flush_at_exit(self, app):
+        if not self.pending:
+            return
+        try:
+            with app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f'❌ Не удалось сохранить счетчики популярности: {e}')
+
+
+popularity = PopularityCounters()
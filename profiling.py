@@ -0,0 +1,276 @@
+"""Профилирование запросов и снимки памяти по требованию.
+
+Запрос профилируется cProfile, если администратор добавил ?_profile=1 или
+заголовок X-Profile: 1, либо если он попал в выборку PROFILER_SAMPLE_RATE
+(доля всех запросов; 0 - выключено). Выборка ограничена
+PROFILER_MAX_PER_MINUTE на воркер, так что ее можно держать включенной под
+нагрузкой. Статистика разбирается после отправки ответа: дерево вызовов
+(cProfile хранит ребра вызывающий -> вызываемый, из них строится дерево от
+корней с отсечением веток меньше PROFILER_MIN_SHARE времени) и самые
+тяжелые функции по собственному времени. Результат пишется в таблицу
+request_profile, общую для всех воркеров; хранятся последние PROFILER_KEEP.
+
+Память: tracemalloc включается и сравнивает снимки в том воркере, который
+обслужил запрос (/admin/api/profiler/memory), - ответ содержит его id.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from datetime import datetime
+from collections import defaultdict
+
+from flask import g, request
+from flask_login import current_user
+from sqlalchemy import select, func
+
+import metrics
+
+SKIP_ENDPOINTS = ('static', 'metrics')
+MAX_TREE_NODES = 400
+
+
+def _label(func_key, root):
+    filename, lineno, name = func_key
+    if filename == '~':
+        # Встроенные функции: ('~', 0, "<built-in method time.sleep>")
+        return name
+    if filename.startswith(root):
+        filename = filename[len(root):].lstrip(os.sep)
+    elif 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    return f'{filename}:{lineno}({name})'
+
+
+def summarize(profile, root, top=40, min_share=0.005, max_depth=20):
+    """Дерево вызовов и топ функций из cProfile.Profile (время - в миллисекундах)"""
+    stats = pstats.Stats(profile).stats
+    total = sum(entry[2] for entry in stats.values()) or 1e-9
+    min_time = total * min_share
+
+    callees = defaultdict(list)
+    roots = []
+    for func_key, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            roots.append((func_key, nc, ct))
+        for caller, edge in callers.items():
+            # Ребро cProfile: (вызовов, примитивных вызовов, собственное время, полное время)
+            callees[caller].append((func_key, edge[0], edge[3]))
+
+    budget = [MAX_TREE_NODES]
+
+    def build(func_key, calls, cumtime, depth, path):
+        budget[0] -= 1
+        node = {'name': _label(func_key, root), 'calls': calls, 'ms': round(cumtime * 1000, 3),
+                'share': round(cumtime / total, 4), 'children': []}
+        if depth >= max_depth:
+            return node
+        for child, child_calls, child_time in sorted(callees[func_key], key=lambda c: -c[2]):
+            if child_time < min_time or budget[0] <= 0:
+                break
+            # Рекурсия: cProfile сливает все вызовы функции, дерево по кругу не разворачиваем
+            if child in path:
+                continue
+            node['children'].append(build(child, child_calls, child_time, depth + 1, path | {child}))
+        return node
+
+    tree = [
+        build(func_key, calls, cumtime, 0, {func_key})
+        for func_key, calls, cumtime in sorted(roots, key=lambda r: -r[2])
+        if cumtime >= min_time and budget[0] > 0
+    ]
+    functions = [
+        {'name': _label(func_key, root), 'calls': nc, 'primitive_calls': cc,
+         'tottime_ms': round(tt * 1000, 3), 'cumtime_ms': round(ct * 1000, 3)}
+        for func_key, (cc, nc, tt, ct, _) in sorted(stats.items(), key=lambda item: -item[1][2])[:top]
+    ]
+    return {'total_ms': round(total * 1000, 3), 'tree': tree, 'functions': functions}
+
+
+class RequestProfiler:
+
+    def __init__(self):
+        self.app = None
+        self.engine_getter = None
+        self.metadata = None
+        self.root = ''
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.max_per_minute = 30
+        self._window = (0, 0)
+        self._lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_at = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self.metadata = db.metadata
+        self.engine_getter = lambda: db.engine
+        self.root = app.root_path
+        self.enabled = app.config.get('PROFILER_ENABLED', True)
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0.0)
+        self.max_per_minute = app.config.get('PROFILER_MAX_PER_MINUTE', 30)
+        self.keep = app.config.get('PROFILER_KEEP', 500)
+        self.top = app.config.get('PROFILER_TOP', 40)
+        self.min_share = app.config.get('PROFILER_MIN_SHARE', 0.005)
+        self.max_depth = app.config.get('PROFILER_TREE_DEPTH', 20)
+        if not self.enabled:
+            return
+
+        @app.before_request
+        def start_profile():
+            reason = self._reason()
+            if reason is None:
+                return
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Профилировщик уже включен в этом потоке (или другим инструментом)
+                return
+            g.profile = profile
+            g.profile_reason = reason
+            g.profile_started = time.perf_counter()
+
+        @app.after_request
+        def finish_profile(response):
+            profile = g.pop('profile', None)
+            if profile is None:
+                return response
+            profile.disable()
+            token = uuid.uuid4().hex
+            record = {
+                'token': token,
+                'endpoint': request.endpoint or 'unknown',
+                'method': request.method,
+                'path': request.full_path.rstrip('?')[:500],
+                'status': response.status_code,
+                'duration_ms': round((time.perf_counter() - g.pop('profile_started')) * 1000, 3),
+                'reason': g.pop('profile_reason'),
+                'worker': self.worker_id,
+                'created_at': datetime.utcnow(),
+            }
+            # Разбор статистики и запись - после отправки ответа
+            response.call_on_close(lambda: self.save(profile, record))
+            response.headers['X-Profile-Token'] = token
+            return response
+
+        @app.teardown_request
+        def drop_profile(exc):
+            # Исключение в обработчике: after_request не вызывался, профилировщик еще включен
+            profile = g.pop('profile', None)
+            if profile is not None:
+                profile.disable()
+
+    @property
+    def worker_id(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @property
+    def table(self):
+        return self.metadata.tables['request_profile']
+
+    def _reason(self):
+        if request.endpoint in SKIP_ENDPOINTS:
+            return None
+        if request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1':
+            if current_user.is_authenticated and current_user.is_admin:
+                return 'admin'
+            return None
+        if self.sample_rate and random.random() < self.sample_rate and self._take_sample_slot():
+            return 'sample'
+        return None
+
+    def _take_sample_slot(self):
+        minute = int(time.time() // 60)
+        with self._lock:
+            window, used = self._window
+            if window != minute:
+                window, used = minute, 0
+            if used >= self.max_per_minute:
+                return False
+            self._window = (window, used + 1)
+            return True
+
+    def save(self, profile, record):
+        try:
+            summary = summarize(profile, self.root, self.top, self.min_share, self.max_depth)
+            t = self.table
+            # Вызывается после отправки ответа, контекст запроса уже снят
+            with self.app.app_context():
+                # На SQLite запись начинается с чтения max(id) - блокировку берем сразу
+                with self.engine_getter().execution_options(sqlite_immediate=True).begin() as conn:
+                    conn.execute(t.insert().values(stats=json.dumps(summary, ensure_ascii=False), **record))
+                    newest = conn.execute(select(func.max(t.c.id))).scalar()
+                    conn.execute(t.delete().where(t.c.id <= newest - self.keep))
+            metrics.registry.inc('shop_request_profiles_total', reason=record['reason'])
+        except Exception as e:
+            self.app.logger.error(f'Ошибка сохранения профиля {record["path"]}: {e}')
+
+    def summary_by_endpoint(self, conn):
+        t = self.table
+        return conn.execute(
+            select(t.c.endpoint, func.count().label('count'), func.avg(t.c.duration_ms).label('avg_ms'),
+                   func.max(t.c.duration_ms).label('max_ms'), func.max(t.c.created_at).label('last_at'))
+            .group_by(t.c.endpoint)
+            .order_by(func.max(t.c.duration_ms).desc())
+        ).all()
+
+    # ---- память (tracemalloc) текущего воркера ----
+
+    def memory(self, action=None, frames=1, key_type='lineno', limit=20):
+        """start / snapshot / stop; без action - состояние. Снимок сравнивается с предыдущим"""
+        with self._memory_lock:
+            diff = None
+            if action == 'start' and not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                self._snapshot = self._take_snapshot()
+                self._snapshot_at = datetime.utcnow()
+            elif action == 'snapshot' and tracemalloc.is_tracing():
+                snapshot = self._take_snapshot()
+                diff = {
+                    'since': self._snapshot_at.isoformat(),
+                    'top': [
+                        {
+                            'location': stat.traceback.format()[-1].strip() if key_type == 'traceback'
+                            else str(stat.traceback[0]),
+                            'traceback': stat.traceback.format() if key_type == 'traceback' else None,
+                            'size_kb': round(stat.size / 1024, 1),
+                            'size_diff_kb': round(stat.size_diff / 1024, 1),
+                            'count': stat.count,
+                            'count_diff': stat.count_diff,
+                        }
+                        for stat in snapshot.compare_to(self._snapshot, key_type)[:limit]
+                    ],
+                }
+                self._snapshot = snapshot
+                self._snapshot_at = datetime.utcnow()
+            elif action == 'stop' and tracemalloc.is_tracing():
+                tracemalloc.stop()
+                self._snapshot = self._snapshot_at = None
+
+            state = {'worker': self.worker_id, 'tracing': tracemalloc.is_tracing(), 'diff': diff}
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                state.update(frames=tracemalloc.get_traceback_limit(), traced_kb=round(current / 1024, 1),
+                             peak_kb=round(peak / 1024, 1), overhead_kb=round(tracemalloc.get_tracemalloc_memory() / 1024, 1))
+            return state
+
+    @staticmethod
+    def _take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+
+request_profiler = RequestProfiler()
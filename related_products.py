@@ -0,0 +1,187 @@
+"""Похожие товары для карточки товара.
+
+Для каждого товара заранее считается top-N: товары той же категории, близкие
+по цене, плюс товары, которые покупали вместе с ним (индекс copurchase). Результат
+хранится одной строкой на товар в таблице related_products, поэтому страница
+товара получает рекомендации одним запросом по первичному ключу.
+"""
+import heapq
+from datetime import datetime
+
+from sqlalchemy import select, and_
+
+from copurchase import copurchase_index
+
+
+def score(price, candidate_price, copurchase_count, copurchase_weight):
+    """Чем ближе цена и чаще совместные покупки, тем выше оценка"""
+    proximity = 0.0
+    if candidate_price is not None and price:
+        proximity = 1.0 / (1.0 + abs(candidate_price - price) / price)
+    return copurchase_count * copurchase_weight + proximity
+
+
+def encode_ids(ids):
+    return ','.join(str(i) for i in ids)
+
+
+def decode_ids(value):
+    return [int(i) for i in value.split(',') if i] if value else []
+
+
+class RelatedProductsEngine:
+
+    def __init__(self):
+        self.metadata = None
+        self.limit = 4
+        self.window = 8
+        self.copurchase_weight = 1.0
+
+    def init_app(self, app, db):
+        self.metadata = db.metadata
+        self.limit = app.config.get('RELATED_PRODUCTS_COUNT', 4)
+        self.window = app.config.get('RELATED_PRODUCTS_PRICE_WINDOW', 8)
+        self.copurchase_weight = app.config.get('RELATED_PRODUCTS_COPURCHASE_WEIGHT', 1.0)
+
+    @property
+    def products(self):
+        return self.metadata.tables['product']
+
+    @property
+    def related(self):
+        return self.metadata.tables['related_products']
+
+    def price_neighbors(self, conn, category, price, exclude_id=None):
+        """Ближайшие по цене товары категории: по window с каждой стороны (индекс category, price)"""
+        p = self.products
+        if category is None or price is None:
+            return []
+
+        base = [p.c.category == category]
+        if exclude_id is not None:
+            base.append(p.c.id != exclude_id)
+
+        above = conn.execute(
+            select(p.c.id, p.c.price).where(and_(*base, p.c.price >= price))
+            .order_by(p.c.price.asc()).limit(self.window)
+        ).all()
+        below = conn.execute(
+            select(p.c.id, p.c.price).where(and_(*base, p.c.price < price))
+            .order_by(p.c.price.desc()).limit(self.window)
+        ).all()
+        return above + below
+
+    def copurchased(self, conn, product_ids):
+        """Совместные покупки из индекса copurchase: {product_id: [(id, price, count), ...]}"""
+        p = self.products
+        pairs_by_product = copurchase_index.lookup_many(conn, product_ids)
+        other_ids = {other_id for pairs in pairs_by_product.values() for other_id, _ in pairs}
+        if not other_ids:
+            return {}
+
+        prices = dict(conn.execute(select(p.c.id, p.c.price).where(p.c.id.in_(other_ids))).all())
+        return {
+            product_id: [(other_id, prices[other_id], count) for other_id, count in pairs if other_id in prices]
+            for product_id, pairs in pairs_by_product.items()
+        }
+
+    def stored_candidates(self, conn, product_ids):
+        """Сохраненные списки вместе с ценами: {product_id: [(id, price), ...]}"""
+        r = self.related
+        p = self.products
+        stored = {
+            row.product_id: decode_ids(row.related_ids)
+            for row in conn.execute(
+                select(r.c.product_id, r.c.related_ids).where(r.c.product_id.in_(product_ids))
+            )
+        }
+        all_ids = {i for ids in stored.values() for i in ids}
+        prices = dict(conn.execute(select(p.c.id, p.c.price).where(p.c.id.in_(all_ids))).all()) if all_ids else {}
+        return {
+            product_id: [(i, prices[i]) for i in ids if i in prices]
+            for product_id, ids in stored.items()
+        }
+
+    def compute_many(self, conn, product_ids, copurchase_only=False):
+        """Считает top-N похожих товаров для набора; отсутствующие товары получают None.
+
+        copurchase_only=True - изменились только совместные покупки (новый заказ):
+        соседи по цене те же, поэтому новый top-N лежит внутри старого списка
+        и кандидатов по совместным покупкам, и запросы соседей не нужны.
+        """
+        p = self.products
+        product_ids = list(set(product_ids))
+        products = {
+            row.id: row for row in conn.execute(
+                select(p.c.id, p.c.category, p.c.price).where(p.c.id.in_(product_ids))
+            )
+        }
+        copurchases = self.copurchased(conn, list(products)) if products else {}
+        stored = self.stored_candidates(conn, list(products)) if copurchase_only and products else {}
+
+        result = {}
+        for product_id in product_ids:
+            product = products.get(product_id)
+            if product is None:
+                result[product_id] = None
+                continue
+
+            candidates = {}
+            if product_id in stored:
+                for candidate_id, price in stored[product_id]:
+                    candidates[candidate_id] = (price, 0)
+            else:
+                for row in self.price_neighbors(conn, product.category, product.price, exclude_id=product_id):
+                    candidates[row.id] = (row.price, 0)
+            for candidate_id, price, cnt in copurchases.get(product_id, ()):
+                candidates[candidate_id] = (price, cnt)
+
+            best = heapq.nlargest(
+                self.limit, candidates.items(),
+                key=lambda item: score(product.price, item[1][0], item[1][1], self.copurchase_weight)
+            )
+            result[product_id] = [candidate_id for candidate_id, _ in best]
+        return result
+
+    def compute(self, conn, product_id):
+        return self.compute_many(conn, [product_id])[product_id]
+
+    def refresh(self, conn, product_ids, copurchase_only=False):
+        """Пересчитывает списки для указанных товаров (удаленные товары вычищаются)"""
+        computed = self.compute_many(conn, product_ids, copurchase_only)
+        if not computed:
+            return
+        r = self.related
+        now = datetime.utcnow()
+        conn.execute(r.delete().where(r.c.product_id.in_(list(computed))))
+        rows = [
+            {'product_id': product_id, 'related_ids': encode_ids(ids), 'updated_at': now}
+            for product_id, ids in computed.items() if ids is not None
+        ]
+        if rows:
+            conn.execute(r.insert(), rows)
+
+    def lookup(self, conn, product_id):
+        """Возвращает сохраненный список id или None, если он еще не посчитан"""
+        r = self.related
+        row = conn.execute(select(r.c.related_ids).where(r.c.product_id == product_id)).first()
+        return decode_ids(row.related_ids) if row else None
+
+    def rebuild_all(self, conn, batch_size=1000):
+        """Полный пересчет: товары обходятся пачками по id, без загрузки каталога целиком"""
+        p = self.products
+        last_id = 0
+        total = 0
+        while True:
+            ids = conn.execute(
+                select(p.c.id).where(p.c.id > last_id).order_by(p.c.id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+            self.refresh(conn, ids)
+            total += len(ids)
+            last_id = ids[-1]
+        return total
+
+
+related_engine = RelatedProductsEngine()
@@ -0,0 +1,104 @@
+"""Чтение витрины с реплик БД.
+
+Реплики подключаются как binds Flask-SQLAlchemy с ключами replica0,
+replica1, ... (Config.DATABASE_REPLICA_URLS). Таблицы к ним не привязаны,
+поэтому create_all их не трогает, а модели по умолчанию работают с
+основной базой.
+
+RoutingSession отправляет на реплику только SELECT (без FOR UPDATE) и
+только в безопасных GET-запросах к маршрутам из REPLICA_ENDPOINTS;
+flush, DML и Core-запросы через db.engine всегда идут в основную базу.
+
+Чтение своих записей: запрос, который что-то записал через сессию или
+был POST/PUT/DELETE, закрепляет посетителя за основной базой на
+REPLICA_STICKY_SECONDS (метка в сессии Flask), чтобы после оформления
+заказа или изменения корзины он не увидел отстающую реплику.
+"""
+import time
+import random
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select
+
+import metrics
+
+REPLICA_BIND_PREFIX = 'replica'
+SAFE_METHODS = ('GET', 'HEAD')
+STICKY_SESSION_KEY = '_primary_until'
+DEFAULT_ENDPOINTS = ('index', 'catalog', 'product_detail', 'about', 'api_products', 'api_product')
+
+
+class RoutingSession(Session):
+    """Сессия, которая отдает чтение в запросах витрины реплике"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing
+                and isinstance(clause, Select) and clause._for_update_arg is None):
+            engine = replica_router.replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.db = None
+        self.keys = []
+        self.endpoints = set(DEFAULT_ENDPOINTS)
+        self.sticky_seconds = 10.0
+
+    def init_app(self, app, db):
+        self.db = db
+        self.keys = sorted(key for key in (app.config.get('SQLALCHEMY_BINDS') or {})
+                           if key and key.startswith(REPLICA_BIND_PREFIX))
+        self.endpoints = set(app.config.get('REPLICA_ENDPOINTS') or DEFAULT_ENDPOINTS)
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 10)
+        if not self.keys:
+            return
+
+        event.listen(RoutingSession, 'after_flush', self._on_flush)
+
+        @app.before_request
+        def choose_database():
+            g.read_replica = (request.method in SAFE_METHODS
+                              and request.endpoint in self.endpoints
+                              and not self.is_sticky())
+            metrics.registry.inc('shop_db_route_requests_total',
+                                 target='replica' if g.read_replica else 'primary')
+
+        @app.after_request
+        def stick_to_primary(response):
+            wrote = g.pop('wrote_primary', False)
+            if wrote or (request.method not in SAFE_METHODS and response.status_code < 400):
+                session[STICKY_SESSION_KEY] = time.time() + self.sticky_seconds
+            return response
+
+    @staticmethod
+    def _on_flush(db_session, flush_context):
+        if has_request_context():
+            g.wrote_primary = True
+
+    def is_sticky(self):
+        until = session.get(STICKY_SESSION_KEY)
+        if until is None:
+            return False
+        if until > time.time():
+            return True
+        session.pop(STICKY_SESSION_KEY)
+        return False
+
+    def replica_engine(self):
+        """Движок реплики для текущего запроса или None - читать из основной базы"""
+        if not self.keys or not has_request_context() or not g.get('read_replica'):
+            return None
+        # Одна реплика на весь запрос: страница не собирается из реплик с разным отставанием
+        key = g.get('replica_key')
+        if key is None:
+            key = g.replica_key = random.choice(self.keys)
+        return self.db.engines[key]
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,231 @@
+"""Отчеты о продажах для админ-панели.
+
+Строки заказов читаются из БД пачками кортежей столбцов и сразу
+складываются в массивы NumPy; все группировки (по дням, категориям,
+способам оплаты, товарам) считаются через np.bincount без циклов по ORM-объектам.
+Архивные заказы (order_archive) читаются тем же запросом через UNION ALL.
+Готовые отчеты кешируются по диапазону дат.
+"""
+from datetime import datetime, date, timedelta
+
+# numpy импортируется в функциях: отчеты строятся редко, а импорт удлиняет запуск каждого воркера
+from sqlalchemy import select, and_, union_all
+
+from response_cache import LRUStore
+
+UNKNOWN_CATEGORY = 'Без категории'
+
+
+class _Factorizer:
+    """Превращает строки в целочисленные коды, общие для всех пачек"""
+
+    def __init__(self):
+        self.codes = {}
+        self.labels = []
+
+    def encode(self, values):
+        import numpy as np
+        codes = self.codes
+        out = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(self.labels)
+                self.labels.append(value)
+            out[i] = code
+        return out
+
+
+class OrderLines:
+    """Столбцы строк заказов в виде массивов NumPy"""
+
+    def __init__(self, order_ids, days, product_ids, amounts, quantities,
+                 category_codes, categories, payment_codes, payment_methods):
+        self.order_ids = order_ids
+        self.days = days
+        self.product_ids = product_ids
+        self.amounts = amounts
+        self.quantities = quantities
+        self.category_codes = category_codes
+        self.categories = categories
+        self.payment_codes = payment_codes
+        self.payment_methods = payment_methods
+
+    def __len__(self):
+        return len(self.order_ids)
+
+
+def aggregate(lines, start_day, days_count, top_n=10):
+    """Считает сводку по столбцам. start_day/days - номера дней (datetime64[D])"""
+    import numpy as np
+    if len(lines) == 0:
+        return {
+            'total_revenue': 0.0, 'orders_count': 0, 'items_sold': 0, 'average_order_value': 0.0,
+            'revenue_by_day': [0.0] * days_count, 'revenue_by_category': {},
+            'revenue_by_payment_method': {}, 'top_products': []
+        }
+
+    amounts = lines.amounts
+    total_revenue = float(amounts.sum())
+
+    # Уникальные заказы: id - ограниченные целые, поэтому маска вместо сортировки
+    seen = np.zeros(int(lines.order_ids.max()) + 1, dtype=bool)
+    seen[lines.order_ids] = True
+    orders_count = int(np.count_nonzero(seen))
+
+    day_index = (lines.days - start_day).astype(np.int64)
+    by_day = np.bincount(day_index, weights=amounts, minlength=days_count)[:days_count]
+
+    by_category = np.bincount(lines.category_codes, weights=amounts, minlength=len(lines.categories))
+    by_payment = np.bincount(lines.payment_codes, weights=amounts, minlength=len(lines.payment_methods))
+
+    # Группировка по товару прямо по id (массив длиной max_id + 1)
+    product_revenue = np.bincount(lines.product_ids, weights=amounts)
+    product_quantity = np.bincount(lines.product_ids, weights=lines.quantities)
+    top_n = min(top_n, int(np.count_nonzero(product_revenue)))
+    top = np.argpartition(product_revenue, -top_n)[-top_n:] if top_n else np.empty(0, dtype=np.int64)
+    top = top[np.argsort(product_revenue[top])[::-1]]
+
+    return {
+        'total_revenue': round(total_revenue, 2),
+        'orders_count': orders_count,
+        'items_sold': int(lines.quantities.sum()),
+        'average_order_value': round(total_revenue / orders_count, 2) if orders_count else 0.0,
+        'revenue_by_day': [round(float(v), 2) for v in by_day],
+        'revenue_by_category': {
+            label: round(float(by_category[i]), 2)
+            for i, label in sorted(enumerate(lines.categories), key=lambda item: -by_category[item[0]])
+        },
+        'revenue_by_payment_method': {
+            label: round(float(by_payment[i]), 2) for i, label in enumerate(lines.payment_methods)
+        },
+        'top_products': [
+            {
+                'product_id': int(i),
+                'revenue': round(float(product_revenue[i]), 2),
+                'quantity': int(product_quantity[i])
+            }
+            for i in top
+        ]
+    }
+
+
+class SalesReports:
+
+    def __init__(self):
+        self.metadata = None
+        self.cache = None
+        self.batch_size = 50000
+
+    def init_app(self, app, db):
+        self.metadata = db.metadata
+        self.batch_size = app.config.get('REPORTS_BATCH_SIZE', 50000)
+        self.cache = LRUStore(max_entries=app.config.get('REPORTS_CACHE_MAX_ENTRIES', 64),
+                              ttl=app.config.get('REPORTS_CACHE_TTL', 300))
+
+    def load_lines(self, conn, start, end):
+        """Читает строки заказов [start, end) пачками и собирает столбцы"""
+        import numpy as np
+        orders = self.metadata.tables['order']
+        items = self.metadata.tables['order_item']
+        archive = self.metadata.tables['order_archive']
+        archive_items = self.metadata.tables['order_item_archive']
+        products = self.metadata.tables['product']
+
+        hot = (
+            select(orders.c.id, orders.c.created_at, orders.c.payment_method,
+                   items.c.product_id, items.c.product_price, items.c.quantity, products.c.category)
+            .select_from(orders.join(items, items.c.order_id == orders.c.id)
+                         .outerjoin(products, products.c.id == items.c.product_id))
+            .where(and_(orders.c.created_at >= start, orders.c.created_at < end,
+                        orders.c.status != 'cancelled'))
+        )
+        # Условие на order_created_at отсекает лишние секции строк архива на PostgreSQL
+        archived = (
+            select(archive.c.id, archive.c.created_at, archive.c.payment_method,
+                   archive_items.c.product_id, archive_items.c.product_price, archive_items.c.quantity,
+                   products.c.category)
+            .select_from(archive.join(archive_items, and_(archive_items.c.order_id == archive.c.id,
+                                                          archive_items.c.order_created_at == archive.c.created_at))
+                         .outerjoin(products, products.c.id == archive_items.c.product_id))
+            .where(and_(archive.c.created_at >= start, archive.c.created_at < end,
+                        archive_items.c.order_created_at >= start, archive_items.c.order_created_at < end,
+                        archive.c.status != 'cancelled'))
+        )
+        query = union_all(hot, archived)
+
+        categories = _Factorizer()
+        payment_methods = _Factorizer()
+        chunks = []
+
+        result = conn.execution_options(stream_results=True, yield_per=self.batch_size).execute(query)
+        for rows in result.partitions(self.batch_size):
+            order_ids, created, payment, product_ids, prices, quantities, category = zip(*rows)
+            quantities = np.array(quantities, dtype=np.int64)
+            chunks.append((
+                np.array(order_ids, dtype=np.int64),
+                np.array(created, dtype='datetime64[D]'),
+                np.array(product_ids, dtype=np.int64),
+                np.array(prices, dtype=np.float64) * quantities,
+                quantities,
+                categories.encode([c or UNKNOWN_CATEGORY for c in category]),
+                payment_methods.encode([p or 'unknown' for p in payment]),
+            ))
+
+        if not chunks:
+            empty = np.empty(0, dtype=np.int64)
+            return OrderLines(empty, np.empty(0, dtype='datetime64[D]'), empty, np.empty(0), empty,
+                              np.empty(0, dtype=np.int32), [], np.empty(0, dtype=np.int32), [])
+
+        columns = [np.concatenate(parts) for parts in zip(*chunks)]
+        return OrderLines(*columns[:5], columns[5], categories.labels, columns[6], payment_methods.labels)
+
+    def build(self, conn, start_date, end_date, top_n=10):
+        """Отчет за [start_date, end_date] включительно; закешированный, если есть"""
+        import numpy as np
+        key = f'{start_date.isoformat()}:{end_date.isoformat()}:{top_n}'
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        start = datetime.combine(start_date, datetime.min.time())
+        end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+        days_count = (end_date - start_date).days + 1
+
+        lines = self.load_lines(conn, start, end)
+        report = aggregate(lines, np.datetime64(start_date, 'D'), days_count, top_n)
+        report['start'] = start_date.isoformat()
+        report['end'] = end_date.isoformat()
+        report['days'] = [(start_date + timedelta(days=i)).isoformat() for i in range(days_count)]
+        report['lines_count'] = len(lines)
+        report['generated_at'] = datetime.utcnow().isoformat()
+
+        # Названия только для top-N, одним запросом
+        ids = [p['product_id'] for p in report['top_products']]
+        if ids:
+            products = self.metadata.tables['product']
+            names = dict(conn.execute(select(products.c.id, products.c.name).where(products.c.id.in_(ids))).all())
+            for p in report['top_products']:
+                p['name'] = names.get(p['product_id'], f'Товар #{p["product_id"]} (удален)')
+
+        self.cache.set(key, report)
+        return report
+
+
+def parse_range(start_arg, end_arg, default_days=30):
+    """Разбирает даты из параметров запроса (YYYY-MM-DD), по умолчанию - последние 30 дней"""
+    today = date.today()
+    try:
+        end_date = datetime.strptime(end_arg, '%Y-%m-%d').date() if end_arg else today
+    except ValueError:
+        end_date = today
+    try:
+        start_date = datetime.strptime(start_arg, '%Y-%m-%d').date() if start_arg else None
+    except ValueError:
+        start_date = None
+    if start_date is None or start_date > end_date:
+        start_date = end_date - timedelta(days=default_days - 1)
+    return start_date, end_date
+
+
+sales_reports = SalesReports()
@@ -0,0 +1,268 @@
+"""Резервирование товара на время, пока он лежит в корзине.
+
+Добавление в корзину ставит удержание (stock_hold) на RESERVATION_TTL
+секунд, и товар перестает быть доступен другим покупателям. Доступный
+остаток хранится готовым: product.reserved - сумма активных удержаний,
+поэтому "сколько можно продать" = stock - reserved читается из одной строки
+без обхода корзин. reserved меняется только условным UPDATE
+(... WHERE stock - reserved >= :delta), что исключает перепродажу при
+одновременных покупателях.
+
+Истекшие удержания снимаются пачками: запрос по индексу expires_at
+(DELETE ... RETURNING), затем один executemany по product.reserved.
+Чтобы не опрашивать БД постоянно, каждый воркер держит кучу сроков
+удержаний, которые он сам поставил, и запускает очистку, когда подходит
+ближайший срок; для чужих удержаний (другие воркеры, перезапуск)
+дополнительно есть периодическая очистка и CLI-команда flask expire-holds.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, case, bindparam, func
+
+import metrics
+
+
+class OutOfStock(Exception):
+    """Товара не хватает для оформления заказа"""
+
+    def __init__(self, product_id):
+        super().__init__(f'Недостаточно товара #{product_id}')
+        self.product_id = product_id
+
+
+class StockReservations:
+
+    def __init__(self):
+        self.metadata = None
+        self.engine_getter = None
+        self.logger = None
+        self.enabled = True
+        self.ttl = 900
+        self.sweep_interval = 60.0
+        self.batch_size = 500
+        self._heap = []
+        self._heap_lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self.last_sweep = 0.0
+
+    def init_app(self, app, db):
+        self.metadata = db.metadata
+        self.engine_getter = lambda: db.engine
+        self.logger = app.logger
+        self.enabled = app.config.get('RESERVATIONS_ENABLED', True)
+        self.ttl = app.config.get('RESERVATION_TTL', 900)
+        self.sweep_interval = app.config.get('RESERVATION_SWEEP_INTERVAL', 60)
+        self.batch_size = app.config.get('RESERVATION_SWEEP_BATCH', 500)
+
+        @app.after_request
+        def expire_due_holds(response):
+            self.maybe_sweep()
+            return response
+
+    @property
+    def holds(self):
+        return self.metadata.tables['stock_hold']
+
+    @property
+    def products(self):
+        return self.metadata.tables['product']
+
+    def _release_reserved(self, conn, released):
+        """Один executemany: reserved -= q по каждому товару (не ниже нуля)"""
+        if not released:
+            return
+        p = self.products
+        conn.execute(
+            p.update().where(p.c.id == bindparam('pid'))
+            .values(reserved=case((p.c.reserved > bindparam('qty'), p.c.reserved - bindparam('qty')), else_=0)),
+            [{'pid': product_id, 'qty': quantity} for product_id, quantity in released.items()]
+        )
+
+    def held_by(self, conn, user_id, product_ids=None):
+        """Удержания пользователя: {product_id: quantity}"""
+        h = self.holds
+        query = select(h.c.product_id, h.c.quantity).where(h.c.user_id == user_id)
+        if product_ids is not None:
+            query = query.where(h.c.product_id.in_(list(product_ids)))
+        return dict(conn.execute(query.with_for_update()).all())
+
+    def available(self, conn, product_ids, user_id=None):
+        """Доступно к продаже {product_id: количество}; свои удержания пользователя считаются доступными ему"""
+        p = self.products
+        rows = conn.execute(select(p.c.id, p.c.stock, p.c.reserved).where(p.c.id.in_(list(product_ids)))).all()
+        own = self.held_by(conn, user_id, product_ids) if user_id is not None and self.enabled else {}
+        result = {}
+        for product_id, stock, reserved in rows:
+            free = (stock or 0) - (reserved or 0) if self.enabled else (stock or 0)
+            result[product_id] = max(free, 0) + own.get(product_id, 0)
+        return result
+
+    def _acquire(self, conn, product_id, delta):
+        """Условно резервирует delta единиц; при нехватке берет сколько осталось. Возвращает взятое"""
+        p = self.products
+        guarded = p.update().where(p.c.id == product_id, p.c.stock - p.c.reserved >= bindparam('delta')) \
+            .values(reserved=p.c.reserved + bindparam('delta'))
+        if conn.execute(guarded, {'delta': delta}).rowcount:
+            return delta
+
+        free = conn.execute(select(p.c.stock - p.c.reserved).where(p.c.id == product_id)).scalar() or 0
+        if free > 0 and conn.execute(guarded, {'delta': min(free, delta)}).rowcount:
+            return min(free, delta)
+        return 0
+
+    def hold(self, conn, user_id, quantities):
+        """Выставляет удержания пользователя на заданные количества (0 - снять) и продлевает их срок.
+
+        Возвращает {product_id: сколько удалось удержать}; меньше запрошенного,
+        если остальное уже разобрали другие покупатели.
+        """
+        if not self.enabled or not quantities:
+            return dict(quantities)
+
+        h = self.holds
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        current = self.held_by(conn, user_id, quantities)
+
+        granted = {}
+        released = {}
+        for product_id, wanted in quantities.items():
+            have = current.get(product_id, 0)
+            if wanted > have:
+                granted[product_id] = have + self._acquire(conn, product_id, wanted - have)
+            else:
+                granted[product_id] = wanted
+                if have > wanted:
+                    released[product_id] = have - wanted
+        self._release_reserved(conn, released)
+
+        keep = [{'uid': user_id, 'pid': product_id, 'qty': quantity, 'exp': expires_at}
+                for product_id, quantity in granted.items() if quantity > 0 and product_id in current]
+        new = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity,
+                'expires_at': expires_at, 'created_at': now}
+               for product_id, quantity in granted.items() if quantity > 0 and product_id not in current]
+        drop = [product_id for product_id, quantity in granted.items() if quantity == 0 and product_id in current]
+        if keep:
+            conn.execute(
+                h.update().where(h.c.user_id == bindparam('uid'), h.c.product_id == bindparam('pid'))
+                .values(quantity=bindparam('qty'), expires_at=bindparam('exp')),
+                keep
+            )
+        if new:
+            conn.execute(h.insert(), new)
+        if drop:
+            conn.execute(h.delete().where(h.c.user_id == user_id, h.c.product_id.in_(drop)))
+
+        if keep or new:
+            with self._heap_lock:
+                heapq.heappush(self._heap, expires_at)
+        return granted
+
+    def release(self, conn, user_id, product_ids=None):
+        """Снимает удержания пользователя (все или по списку товаров)"""
+        if not self.enabled:
+            return
+        h = self.holds
+        query = h.delete().where(h.c.user_id == user_id)
+        if product_ids is not None:
+            query = query.where(h.c.product_id.in_(list(product_ids)))
+        released = {}
+        for product_id, quantity in self._delete_returning(conn, query):
+            released[product_id] = released.get(product_id, 0) + quantity
+        self._release_reserved(conn, released)
+
+    def consume(self, conn, user_id, quantities):
+        """Списывает товар со склада при оформлении заказа, превращая удержания в продажу.
+
+        Условный UPDATE на каждый товар: stock - quantity и reserved - удержанное,
+        только если без чужих удержаний товара хватает. Иначе OutOfStock.
+        """
+        p = self.products
+        held = self.held_by(conn, user_id, quantities) if self.enabled else {}
+        stmt = p.update().where(
+            p.c.id == bindparam('pid'),
+            p.c.stock - (p.c.reserved - bindparam('held')) >= bindparam('qty')
+        ).values(
+            stock=p.c.stock - bindparam('qty'),
+            reserved=case((p.c.reserved > bindparam('held'), p.c.reserved - bindparam('held')), else_=0)
+        )
+        for product_id, quantity in quantities.items():
+            if not conn.execute(stmt, {'pid': product_id, 'qty': quantity, 'held': held.get(product_id, 0)}).rowcount:
+                raise OutOfStock(product_id)
+        if held:
+            h = self.holds
+            conn.execute(h.delete().where(h.c.user_id == user_id, h.c.product_id.in_(list(held))))
+
+    @staticmethod
+    def _delete_returning(conn, query):
+        """DELETE ... RETURNING product_id, quantity (или SELECT FOR UPDATE + DELETE, где RETURNING нет)"""
+        h = query.table
+        if conn.dialect.delete_returning:
+            return conn.execute(query.returning(h.c.product_id, h.c.quantity)).all()
+        rows = conn.execute(
+            select(h.c.id, h.c.product_id, h.c.quantity).where(query.whereclause).with_for_update()
+        ).all()
+        if rows:
+            conn.execute(h.delete().where(h.c.id.in_([row.id for row in rows])))
+        return [(row.product_id, row.quantity) for row in rows]
+
+    def sweep(self, conn, now=None):
+        """Снимает истекшие удержания пачками по RESERVATION_SWEEP_BATCH; возвращает число снятых"""
+        h = self.holds
+        now = now or datetime.utcnow()
+        total = 0
+        while True:
+            ids = [row[0] for row in conn.execute(
+                select(h.c.id).where(h.c.expires_at <= now).order_by(h.c.expires_at).limit(self.batch_size)
+            )]
+            if not ids:
+                break
+            released = {}
+            # Повторная проверка срока: удержание могли продлить между выборкой и удалением
+            for product_id, quantity in self._delete_returning(
+                    conn, h.delete().where(h.c.id.in_(ids), h.c.expires_at <= now)):
+                released[product_id] = released.get(product_id, 0) + quantity
+            self._release_reserved(conn, released)
+            total += len(ids)
+            if len(ids) < self.batch_size:
+                break
+        if total:
+            metrics.registry.inc('shop_stock_holds_expired_total', total)
+        return total
+
+    def recount(self, conn):
+        """Пересчитывает product.reserved по активным удержаниям (ремонт после сбоев)"""
+        p = self.products
+        h = self.holds
+        conn.execute(p.update().values(reserved=func.coalesce(
+            select(func.sum(h.c.quantity)).where(h.c.product_id == p.c.id).scalar_subquery(), 0
+        )))
+
+    def maybe_sweep(self):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._heap_lock:
+            due = False
+            utcnow = datetime.utcnow()
+            while self._heap and self._heap[0] <= utcnow:
+                heapq.heappop(self._heap)
+                due = True
+        if not due and now - self.last_sweep < self.sweep_interval:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_sweep = now
+            with self.engine_getter().begin() as conn:
+                self.sweep(conn)
+        except Exception as e:
+            self.logger.error(f'Ошибка снятия истекших резервов: {e}')
+        finally:
+            self._sweep_lock.release()
+
+
+reservations = StockReservations()
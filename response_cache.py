@@ -0,0 +1,205 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from datetime import timezone
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+import metrics
+
+
+class LRUStore:
+    """Кеш в памяти процесса с вытеснением давно не использованных записей"""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileSystemStore:
+    """Кеш в файлах - общий для всех воркеров на одной машине"""
+
+    def __init__(self, directory, ttl=300):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Атомарная замена, чтобы соседний воркер не прочитал половину файла
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class RedisStore:
+    """Кеш в Redis или совместимом сервере (KeyDB, Dragonfly, локальный redis-server)"""
+
+    def __init__(self, url, ttl=300, prefix='shop:page:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Для RESPONSE_CACHE_TYPE=redis установите пакет redis')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw else None
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_store(config):
+    cache_type = config.get('RESPONSE_CACHE_TYPE', 'lru')
+    ttl = config.get('RESPONSE_CACHE_TTL', 300)
+
+    if cache_type == 'filesystem':
+        return FileSystemStore(config['RESPONSE_CACHE_DIR'], ttl)
+    if cache_type == 'redis':
+        return RedisStore(config['RESPONSE_CACHE_URL'], ttl)
+    if cache_type == 'lru':
+        return LRUStore(config.get('RESPONSE_CACHE_MAX_ENTRIES', 1000), ttl)
+    return None
+
+
+class ResponseCache:
+    """Кеш страниц для анонимных GET-запросов с ETag/304.
+
+    Ключ складывается из пути, нормализованных параметров запроса и версии
+    каталога, поэтому любое изменение товаров делает старые записи недостижимыми.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.version_getter = None
+        self.cache_control = None
+
+    def init_app(self, app, version_getter):
+        """version_getter() -> (version, updated_at) текущей версии каталога"""
+        self.store = create_store(app.config)
+        self.version_getter = version_getter
+        self.cache_control = app.config.get('RESPONSE_CACHE_CONTROL', 'public, max-age=60')
+
+    def _is_cacheable(self):
+        if self.store is None or request.method not in ('GET', 'HEAD'):
+            return False
+        if current_user.is_authenticated:
+            return False
+        # Страница с flash-сообщением уникальна для посетителя
+        if '_flashes' in session:
+            return False
+        return True
+
+    @staticmethod
+    def _make_key(version):
+        args = sorted((k, v) for k, values in request.args.lists() for v in values if v != '')
+        query = '&'.join(f'{k}={v}' for k, v in args)
+        return f'{version}:{request.path}?{query}'
+
+    def _apply_headers(self, response, etag, updated_at):
+        response.set_etag(etag, weak=True)
+        if updated_at:
+            response.last_modified = updated_at
+        response.headers['Cache-Control'] = self.cache_control
+        response.vary.add('Cookie')
+        return response
+
+    def cached(self, view):
+        """Декоратор для публичных страниц"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self._is_cacheable():
+                return view(*args, **kwargs)
+
+            version, updated_at = self.version_getter()
+            if updated_at is not None and updated_at.tzinfo is None:
+                updated_at = updated_at.replace(tzinfo=timezone.utc)
+            key = self._make_key(version)
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+            # Условный запрос: версия каталога не менялась - отвечаем 304 без рендеринга
+            if request.if_none_match.contains_weak(etag) or (
+                    not request.if_none_match and updated_at and request.if_modified_since
+                    and request.if_modified_since >= updated_at.replace(microsecond=0)):
+                metrics.registry.inc('shop_response_cache_total', result='not_modified')
+                return self._apply_headers(make_response('', 304), etag, updated_at)
+
+            entry = self.store.get(key)
+            if entry is not None:
+                metrics.registry.inc('shop_response_cache_total', result='hit')
+                body, status, mimetype = entry
+                response = make_response(body, status)
+                response.mimetype = mimetype
+                return self._apply_headers(response, etag, updated_at)
+
+            metrics.registry.inc('shop_response_cache_total', result='miss')
+            response = make_response(view(*args, **kwargs))
+
+            if response.status_code == 200 and 'Set-Cookie' not in response.headers:
+                self.store.set(key, (response.get_data(), response.status_code, response.mimetype))
+                self._apply_headers(response, etag, updated_at)
+            return response
+
+        return wrapper
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,125 @@
+"""Профиль SQLite для нескольких воркеров gunicorn на одном файле базы.
+
+На каждое новое соединение выставляются PRAGMA: журнал WAL (читатели не
+блокируют писателя и наоборот), busy_timeout (ждать блокировку, а не
+сразу падать с "database is locked"), synchronous=NORMAL (в режиме WAL
+безопасно при падении процесса), mmap_size и cache_size.
+
+Транзакции начинаются явно (BEGIN в событии begin вместо неявного BEGIN
+драйвера sqlite3). Для маршрутов, помеченных immediate_transaction,
+первая транзакция запроса (в ней же загрузка пользователя и вся работа
+до commit) начинается с BEGIN IMMEDIATE: блокировка записи берется сразу,
+и писатели выстраиваются в короткую очередь через busy_timeout. Иначе
+транзакция, начатая чтением, при попытке записи после чужого commit
+получает SQLITE_BUSY сразу, без ожидания. Если маршрут вышел, не сделав
+commit, транзакция откатывается на выходе из него, чтобы блокировка не
+держалась до конца запроса (after_request тоже пишут в базу). Вне
+запросов то же самое включает execution_options(sqlite_immediate=True).
+
+Маршруты корзины помечены с authenticated_only=True: гость там только
+читает БД и пишет cookie, и BEGIN IMMEDIATE выстроил бы анонимный
+трафик в очередь за блокировкой записи. Вход определяется по _user_id в
+сессии, а не по current_user - его загрузка сама начала бы транзакцию.
+
+Для других СУБД модуль ничего не делает.
+"""
+from functools import wraps
+
+from flask import g, has_request_context, request, session
+from sqlalchemy import event
+
+
+def immediate_transaction(methods=None, authenticated_only=False):
+    """Помечает маршрут как пишущий: транзакции запроса начинаются с BEGIN IMMEDIATE.
+
+    methods - только для этих HTTP-методов (по умолчанию для всех);
+    authenticated_only - только для вошедших пользователей (гость в БД не пишет).
+    Декоратор ставится под @app.route; пометка переживает @login_required.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                return view(*args, **kwargs)
+            finally:
+                sqlite_profile.release()
+        wrapper.immediate_transaction_methods = tuple(methods) if methods else None
+        wrapper.immediate_transaction_authenticated_only = authenticated_only
+        return wrapper
+    return decorator
+
+
+class SQLiteProfile:
+
+    def __init__(self):
+        self.enabled = False
+        self.pragmas = {}
+        self.db = None
+
+    def init_app(self, app, db):
+        with app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'sqlite' or not app.config.get('SQLITE_PROFILE', True):
+            return
+        self.enabled = True
+        self.db = db
+        self.pragmas = {
+            'journal_mode': 'WAL',
+            'busy_timeout': app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000),
+            'synchronous': app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'mmap_size': app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+            # Отрицательное значение - размер в КиБ, а не в страницах
+            'cache_size': -app.config.get('SQLITE_CACHE_SIZE_KB', 64 * 1024),
+        }
+
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'begin', self._on_begin)
+        event.listen(engine, 'commit', self._on_end)
+        event.listen(engine, 'rollback', self._on_end)
+
+        @app.before_request
+        def mark_write_transaction():
+            view = app.view_functions.get(request.endpoint)
+            if view is None or not hasattr(view, 'immediate_transaction_methods'):
+                return
+            methods = view.immediate_transaction_methods
+            if methods is not None and request.method not in methods:
+                return
+            if view.immediate_transaction_authenticated_only and '_user_id' not in session:
+                return
+            g.sqlite_immediate = True
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        # Отключаем неявный BEGIN драйвера, транзакции начинает _on_begin
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    @staticmethod
+    def _on_begin(conn):
+        if conn.get_execution_options().get('isolation_level') == 'AUTOCOMMIT':
+            # VACUUM и прочее, что нельзя выполнять в транзакции
+            return
+        # Только первая транзакция запроса: чтение после commit блокировку не берет
+        in_request = has_request_context() and g.pop('sqlite_immediate', False)
+        # Вне запросов (фоновые задачи) - по execution_options(sqlite_immediate=True)
+        immediate = in_request or conn.get_execution_options().get('sqlite_immediate', False)
+        # Мимо событий курсора: BEGIN не считается SQL-запросом в метриках
+        conn.connection.driver_connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        if in_request:
+            g.sqlite_write_lock = conn
+
+    @staticmethod
+    def _on_end(conn):
+        if has_request_context() and g.get('sqlite_write_lock') is conn:
+            g.pop('sqlite_write_lock')
+
+    def release(self):
+        """Откатывает незавершенную транзакцию с блокировкой записи (маршрут вышел без commit)"""
+        if self.enabled and g.get('sqlite_write_lock') is not None:
+            self.db.session.rollback()
+
+
+sqlite_profile = SQLiteProfile()
@@ -1,5 +1,20 @@
 // AJAX добавление в корзину
 document.addEventListener('DOMContentLoaded', function() {
+    // Счетчик корзины гостя: cookie вида "id:qty|id:qty.<подпись>"
+    const guestCount = document.querySelector('[data-guest-cart-count]');
+    if (guestCount) {
+        const cookie = document.cookie.split('; ').find(row => row.startsWith('guest_cart='));
+        let count = 0;
+        if (cookie) {
+            let value = decodeURIComponent(cookie.substring('guest_cart='.length)).replace(/^"|"$/g, '');
+            value = value.substring(0, value.lastIndexOf('.'));
+            value.split('|').forEach(chunk => {
+                count += parseInt(chunk.split(':')[1], 10) || 0;
+            });
+        }
+        guestCount.textContent = count || '';
+    }
+
     // Обработка форм добавления в корзину
     const cartForms = document.querySelectorAll('form[action*="add_to_cart"]');
 
@@ -40,6 +55,193 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // Изменение количества в корзине: кнопки меняют число сразу, а запросы
+    // копятся и уходят одной пачкой в /api/cart после паузы
+    const cartTable = document.querySelector('[data-cart-api]');
+    if (cartTable) {
+        const apiUrl = cartTable.dataset.cartApi;
+        const pending = {};
+        let timer = null;
+
+        cartTable.querySelectorAll('form[action*="update_cart"] button[name="action"]').forEach(button => {
+            button.addEventListener('click', function(e) {
+                e.preventDefault();
+
+                const row = this.closest('tr[data-product-id]');
+                let quantity = parseInt(row.dataset.quantity, 10);
+                if (this.value === 'increment') {
+                    quantity += 1;
+                } else if (this.value === 'decrement') {
+                    quantity -= 1;
+                } else {
+                    quantity = 0;
+                }
+                quantity = Math.max(quantity, 0);
+
+                row.dataset.quantity = quantity;
+                row.querySelector('.cart-quantity').textContent = quantity;
+                row.classList.toggle('opacity-50', quantity === 0);
+                pending[row.dataset.productId] = quantity;
+
+                clearTimeout(timer);
+                timer = setTimeout(sendCartUpdates, 400);
+            });
+        });
+
+        function sendCartUpdates() {
+            const items = Object.keys(pending).map(productId => ({
+                product_id: parseInt(productId, 10),
+                quantity: pending[productId]
+            }));
+            Object.keys(pending).forEach(productId => delete pending[productId]);
+            if (!items.length) return;
+
+            fetch(apiUrl, {
+                method: 'POST',
+                body: JSON.stringify({items: items}),
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-Requested-With': 'XMLHttpRequest'
+                }
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.cart) {
+                    showNotification(data.message || 'Не удалось обновить корзину', 'danger');
+                    return;
+                }
+                renderCart(data.cart);
+                data.adjusted.forEach(item => showNotification(item.message, 'warning'));
+            })
+            .catch(error => {
+                console.error('Error:', error);
+                // Состояние на странице могло разойтись с сервером - перезагружаем корзину
+                window.location.reload();
+            });
+        }
+
+        function renderCart(cart) {
+            const byId = {};
+            cart.items.forEach(item => { byId[item.product_id] = item; });
+
+            cartTable.querySelectorAll('tr[data-product-id]').forEach(row => {
+                const item = byId[row.dataset.productId];
+                if (!item) {
+                    row.remove();
+                    return;
+                }
+                // Пока ответ шел, пользователь мог снова нажать кнопку - не затираем его ввод
+                if (pending[row.dataset.productId] === undefined) {
+                    row.dataset.quantity = item.quantity;
+                    row.querySelector('.cart-quantity').textContent = item.quantity;
+                }
+                row.querySelector('.cart-subtotal').textContent = `${item.subtotal} ₽`;
+            });
+
+            const positions = document.querySelector('.cart-positions');
+            if (positions) positions.textContent = cart.positions;
+            const total = document.querySelector('.cart-total');
+            if (total) total.textContent = `${cart.total} ₽`;
+            const cartCount = document.querySelector('.cart-count');
+            if (cartCount) cartCount.textContent = cart.cart_count;
+
+            if (!cart.items.length) {
+                window.location.reload();
+            }
+        }
+    }
+
+    // Подсказки поиска: запрос уходит после паузы в наборе, устаревший ответ отменяется
+    const searchInput = document.querySelector('input[data-autocomplete]');
+    if (searchInput) {
+        const apiUrl = searchInput.dataset.autocomplete;
+        const list = document.createElement('div');
+        list.className = 'list-group position-absolute w-100 shadow-sm d-none';
+        list.style.cssText = 'top: 100%; left: 0; z-index: 1050;';
+        searchInput.parentNode.appendChild(list);
+
+        let timer = null;
+        let controller = null;
+        let active = -1;
+
+        searchInput.addEventListener('input', function() {
+            clearTimeout(timer);
+            const query = this.value.trim();
+            if (query.length < 2) {
+                hideSuggestions();
+                return;
+            }
+            timer = setTimeout(() => loadSuggestions(query), 150);
+        });
+
+        searchInput.addEventListener('keydown', function(e) {
+            const items = list.querySelectorAll('a');
+            if (list.classList.contains('d-none') || !items.length) return;
+
+            if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+                e.preventDefault();
+                const step = e.key === 'ArrowDown' ? 1 : -1;
+                active = (active + step + items.length) % items.length;
+                items.forEach((item, i) => item.classList.toggle('active', i === active));
+            } else if (e.key === 'Enter' && active >= 0) {
+                e.preventDefault();
+                window.location.href = items[active].href;
+            } else if (e.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+
+        document.addEventListener('click', function(e) {
+            if (!list.contains(e.target) && e.target !== searchInput) {
+                hideSuggestions();
+            }
+        });
+
+        function loadSuggestions(query) {
+            if (controller) controller.abort();
+            controller = new AbortController();
+
+            fetch(`${apiUrl}?q=${encodeURIComponent(query)}`, {signal: controller.signal})
+            .then(response => response.json())
+            .then(data => renderSuggestions(data.suggestions))
+            .catch(error => {
+                if (error.name !== 'AbortError') console.error('Error:', error);
+            });
+        }
+
+        function renderSuggestions(suggestions) {
+            list.innerHTML = '';
+            active = -1;
+            suggestions.forEach(suggestion => {
+                const item = document.createElement('a');
+                item.className = 'list-group-item list-group-item-action';
+                item.href = suggestion.url;
+                if (suggestion.type === 'category') {
+                    const icon = document.createElement('i');
+                    icon.className = 'fas fa-tags me-2 text-muted';
+                    item.appendChild(icon);
+                    item.appendChild(document.createTextNode(suggestion.name));
+                } else {
+                    item.appendChild(document.createTextNode(suggestion.name));
+                    if (suggestion.category) {
+                        const category = document.createElement('small');
+                        category.className = 'text-muted ms-2';
+                        category.textContent = suggestion.category;
+                        item.appendChild(category);
+                    }
+                }
+                list.appendChild(item);
+            });
+            list.classList.toggle('d-none', !suggestions.length);
+        }
+
+        function hideSuggestions() {
+            if (controller) controller.abort();
+            list.classList.add('d-none');
+            active = -1;
+        }
+    }
+
     // Функция показа уведомлений
     function showNotification(message, type) {
         // Создаем элемент уведомления
@@ -0,0 +1,14 @@
+import argparse
+
+from app import create_app
+from jobs import job_queue
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Воркер фоновых задач')
+    parser.add_argument('--concurrency', type=int, help='потоков (по умолчанию JOBS_CONCURRENCY)')
+    parser.add_argument('--once', action='store_true', help='выполнить готовые задачи и выйти')
+    args = parser.parse_args()
+
+    create_app()
+
+    job_queue.run_worker(concurrency=args.concurrency, once=args.once)